@@ -0,0 +1,496 @@
+"""
+Run the merge logic of Daily_Merge_Table_Update.py in process on DuckDB over Arrow tables, without a Spark cluster.
+The four warehouse tables are read from local parquet, one file or directory of part files per table named after it,
+e.g. <source_dir>/pr_analytics_agg.fact_promotion_expense_daily.parquet.
+
+Every stage mirrors the notebook function of the same name, takes and returns pyarrow tables, and must keep the same semantics:
+a change to a notebook stage needs the same change here, which tests/test_arrow_parity.py verifies, as does
+Benchmark_Merge_Pipeline.py --check-arrow-parity at any scale. The metric columns are not listed here: they come from the Metric tuples
+of get_metrics() in the notebook, passed to run_merge(), so that a metric added to the registry is computed by both engines.
+"""
+
+import duckdb
+import pyarrow as pa
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Tuple
+
+SOURCE_TABLE_NAMES = [
+    "pr_analytics_agg.fact_promotion_expense_daily",
+    "ua.internal_individual_ltv",
+    "pr_analytics_delta.install",
+    "ua.skan_ltv",
+]
+REVENUE_SHARE_RATE_SCHEMA = pa.schema(
+    [
+        ("APPLICATION_FAMILY_NAME", pa.string()),
+        ("MARKET_CD", pa.string()),
+        ("START_DT", pa.date32()),
+        ("END_DT", pa.date32()),
+        ("IAP_RATE", pa.float64()),
+        ("AD_RATE", pa.float64()),
+        ("SUB_RATE", pa.float64()),
+        ("SUB_LTV_RATE", pa.float64()),
+        ("RATE_VERSION", pa.int32()),
+    ]
+)
+CAMPAIGN_COLS = [
+    "APPLICATION_FAMILY_NAME",
+    "MARKET_CD",
+    "USER_SOURCE_TYPE_CD",
+    "CHANNEL_NAME",
+    "PROMOTION_NAME",
+    "CALENDAR_DT",
+]
+CHANNEL_COLS = [
+    "APPLICATION_FAMILY_NAME",
+    "MARKET_CD",
+    "SOURCE",
+    "USER_SOURCE_TYPE_CD",
+    "CHANNEL_NAME",
+    "CALENDAR_DT",
+]
+# the campaign columns skan and non-skan campaigns are matched on
+SKAN_JOIN_COLS = ["APPLICATION_FAMILY_NAME", "MARKET_CD", "CHANNEL_NAME", "PROMOTION_NAME", "CALENDAR_DT"]
+
+
+def to_sql_list(values: List[str]) -> str:
+    return "(" + ", ".join(f"'{value}'" for value in values) + ")"
+
+
+def get_metric_cols(metrics: List[NamedTuple]) -> Tuple[List[str], List[str]]:
+    """
+    Return the published metric columns, SPEND and INSTALL followed by those of metrics, and the ones among them published as int
+    """
+    return (
+        ["SPEND", "INSTALL", *[metric.name for metric in metrics]],
+        ["INSTALL", *[metric.name for metric in metrics if metric.is_int]],
+    )
+
+
+def get_metric_sql(metrics: List[NamedTuple], expr_field: str) -> str:
+    """
+    Return the select expressions aggregating metrics by their expr_field, fact_promo_expr or skan_expr, with the int metrics cast to bigint
+    """
+    exprs = [(metric, getattr(metric, expr_field)) for metric in metrics]
+    return ",\n  ".join(
+        f"({expr})::bigint as {metric.name}" if metric.is_int else f"{expr} as {metric.name}"
+        for metric, expr in exprs
+        if expr is not None
+    )
+
+
+def to_arrow_table(relation: duckdb.DuckDBPyRelation) -> pa.Table:
+    # to_arrow_table() replaces fetch_arrow_table() in newer duckdb releases
+    if hasattr(relation, "to_arrow_table"):
+        return relation.to_arrow_table()
+    return relation.fetch_arrow_table()
+
+
+def run_sql(con: duckdb.DuckDBPyConnection, sql: str, **tables: pa.Table) -> pa.Table:
+    """
+    Run sql with each of tables registered as a view of its keyword name, and return the result as a pyarrow table
+    """
+    for name, table in tables.items():
+        con.register(name, table)
+    try:
+        return to_arrow_table(con.sql(sql))
+    finally:
+        for name in tables:
+            con.unregister(name)
+
+
+def connect(
+    source_dir: str, rate_rows: List[tuple], channel_aliases: Dict[str, str]
+) -> duckdb.DuckDBPyConnection:
+    """
+    Return a duckdb connection with a view for every source table over its parquet under source_dir,
+    and the revenue share rates and channel aliases as the tables revenue_share_rate and channel_alias
+    """
+    con = duckdb.connect()
+    for table_name in SOURCE_TABLE_NAMES:
+        path = Path(source_dir, f"{table_name}.parquet")
+        if path.is_dir():
+            path = path / "**" / "*.parquet"
+        con.sql(f"create schema if not exists {table_name.split('.')[0]}")
+        con.sql(f"create view {table_name} as select * from read_parquet('{path}')")
+
+    rate_table = pa.Table.from_pylist(
+        [dict(zip(REVENUE_SHARE_RATE_SCHEMA.names, row)) for row in rate_rows],
+        REVENUE_SHARE_RATE_SCHEMA,
+    )
+    alias_table = pa.table(
+        {
+            "ALIAS_CHANNEL_NAME": pa.array(list(channel_aliases.keys()), pa.string()),
+            "MAPPED_CHANNEL_NAME": pa.array(list(channel_aliases.values()), pa.string()),
+        }
+    )
+    con.register("revenue_share_rate", rate_table)
+    con.register("channel_alias", alias_table)
+    return con
+
+
+def get_campaign_without_sub_ltv(
+    con: duckdb.DuckDBPyConnection,
+    game_list: List[str],
+    market_list: List[str],
+    compute_start_dt: str,
+    end_dt: str,
+    fact_promo_filter_cond: str,
+    metrics: List[NamedTuple],
+) -> pa.Table:
+    """
+    Return campaign-level daily spend, install and the metrics aggregated from the fact_promo table
+    """
+    sql = f"""
+with pr_promo_tb as (
+  select
+    p.*,
+    case
+      when USER_SOURCE_TYPE_CD in ('MM', 'MK', 'MC') then coalesce(a.MAPPED_CHANNEL_NAME, p.CHANNEL_NAME)
+      else 'ORGANIC'
+    end as CAMPAIGN_CHANNEL_NAME,
+    case
+      when USER_SOURCE_TYPE_CD in ('MM', 'MK', 'MC') then PROMOTION_NAME
+      else 'ORGANIC'
+    end as CAMPAIGN_PROMOTION_NAME
+  from (
+    select *
+    from pr_analytics_agg.fact_promotion_expense_daily
+    where APPLICATION_FAMILY_NAME in {to_sql_list(game_list)} and MARKET_CD in {to_sql_list(market_list)} and {fact_promo_filter_cond} and CALENDAR_DT between '{compute_start_dt}' and '{end_dt}' and MVP_CAMPAIGN_TYPE = 'New Installs'
+  ) p left join channel_alias a
+  on p.CHANNEL_NAME = a.ALIAS_CHANNEL_NAME
+)
+select
+  p.APPLICATION_FAMILY_NAME,
+  p.MARKET_CD,
+  USER_SOURCE_TYPE_CD,
+  CAMPAIGN_CHANNEL_NAME as CHANNEL_NAME,
+  CAMPAIGN_PROMOTION_NAME as PROMOTION_NAME,
+  CALENDAR_DT,
+  sum(EXPENSE_AMT) as SPEND,
+  sum(USER_QTY)::bigint as INSTALL_NUM,
+  {get_metric_sql(metrics, "fact_promo_expr")}
+from pr_promo_tb p left join revenue_share_rate r
+on p.APPLICATION_FAMILY_NAME = r.APPLICATION_FAMILY_NAME and p.MARKET_CD = r.MARKET_CD and p.CALENDAR_DT between r.START_DT and r.END_DT
+group by 1, 2, 3, 4, 5, 6
+having sum(EXPENSE_AMT) > 0 or sum(USER_QTY) > 0
+  """
+    return run_sql(con, sql)
+
+
+def get_campaign_sub_ltv(
+    con: duckdb.DuckDBPyConnection,
+    game_list: List[str],
+    market_list: List[str],
+    compute_start_dt: str,
+    end_dt: str,
+) -> pa.Table:
+    """
+    Return campaign-level daily sub pltv from the latest projection of each installed user
+    """
+    sql = f"""
+with cohort_install as (
+  select
+    APPLICATION_CD,
+    ACCOUNT_ID,
+    USER_ID,
+    APPLICATION_FAMILY_NAME,
+    MARKET_CD,
+    USER_SOURCE_TYPE_CD,
+    CHANNEL_NAME,
+    PROMOTION_NAME,
+    INSTALL_DT as CALENDAR_DT
+  from pr_analytics_delta.install
+  where APPLICATION_FAMILY_NAME in {to_sql_list(game_list)} and MARKET_CD in {to_sql_list(market_list)} and INSTALL_DT between '{compute_start_dt}' and '{end_dt}'
+),
+cohort_indi_ltv as (
+  select
+    a.ACCOUNT_ID,
+    a.USER_ID,
+    a.APPLICATION_CD,
+    a.SUB_PROJECTEDREVENUE_365 as SUB_LTV,
+    rank() over (partition by a.ACCOUNT_ID, a.USER_ID, a.APPLICATION_CD order by a.PROJECTION_DT desc) as PROJECTION_RANK
+  from ua.internal_individual_ltv a semi join cohort_install b
+  on a.APPLICATION_CD = b.APPLICATION_CD and a.ACCOUNT_ID = b.ACCOUNT_ID and a.USER_ID = b.USER_ID
+  where a.PROJECTION_DT is not null
+),
+indi_sub_ltv as (
+  select
+    a.APPLICATION_FAMILY_NAME,
+    a.MARKET_CD,
+    a.USER_SOURCE_TYPE_CD,
+    a.CHANNEL_NAME,
+    a.PROMOTION_NAME,
+    a.CALENDAR_DT,
+    b.SUB_LTV
+  from cohort_install a inner join cohort_indi_ltv b
+  on a.APPLICATION_CD = b.APPLICATION_CD and a.ACCOUNT_ID = b.ACCOUNT_ID and a.USER_ID = b.USER_ID and b.PROJECTION_RANK = 1
+)
+select
+  a.APPLICATION_FAMILY_NAME,
+  a.MARKET_CD,
+  USER_SOURCE_TYPE_CD,
+  case
+    when USER_SOURCE_TYPE_CD in ('MM', 'MK', 'MC') then CHANNEL_NAME
+    else 'ORGANIC'
+  end as CHANNEL_NAME,
+  case
+    when USER_SOURCE_TYPE_CD in ('MM', 'MK', 'MC') then PROMOTION_NAME
+    else 'ORGANIC'
+  end as PROMOTION_NAME,
+  CALENDAR_DT,
+  count(1) as INDIVIDUAL_INSTALLS,
+  sum(ifnull(SUB_LTV * SUB_LTV_RATE, 0)) as SUB_LTV
+from indi_sub_ltv a left join revenue_share_rate r
+on a.APPLICATION_FAMILY_NAME = r.APPLICATION_FAMILY_NAME and a.MARKET_CD = r.MARKET_CD and a.CALENDAR_DT between r.START_DT and r.END_DT
+group by 1, 2, 3, 4, 5, 6
+  """
+    return run_sql(con, sql)
+
+
+def get_campaign_details(
+    con: duckdb.DuckDBPyConnection,
+    campaign_without_sub_pltv_table: pa.Table,
+    campaign_sub_pltv_table: pa.Table,
+) -> pa.Table:
+    """
+    Left join the campaign sub pltv onto the campaign details without it, and add TOTAL_LTV
+    """
+    sql = f"""
+select
+  w.*,
+  coalesce(s.SUB_LTV, 0) as SUB_LTV,
+  w.IAP_LTV + w.AD_LTV + coalesce(s.SUB_LTV, 0) as TOTAL_LTV
+from campaign_without_sub_pltv w left join campaign_sub_pltv s
+using ({", ".join(CAMPAIGN_COLS)})
+  """
+    return run_sql(
+        con,
+        sql,
+        campaign_without_sub_pltv=campaign_without_sub_pltv_table,
+        campaign_sub_pltv=campaign_sub_pltv_table,
+    )
+
+
+def get_skan_campaign_ltv(
+    con: duckdb.DuckDBPyConnection,
+    game_list: List[str],
+    compute_start_dt: str,
+    skan_end_dt: str,
+    skan_filter_cond: str,
+    metrics: List[NamedTuple],
+) -> pa.Table:
+    """
+    Get SKAN campaign level pLTV
+    """
+    sql = f"""
+select
+  s.APPLICATION_FAMILY_NAME,
+  'IT' as MARKET_CD,
+  'SKAN' as SOURCE,
+  CHANNEL_NAME,
+  PROMOTION_CD as PROMOTION_NAME,
+  INSTALL_DT as CALENDAR_DT,
+  sum(INSTALL_NUM)::bigint as INSTALL_NUM,
+  {get_metric_sql(metrics, "skan_expr")}
+from (
+  select *
+  from ua.skan_ltv
+  where APPLICATION_FAMILY_NAME in {to_sql_list(game_list)} and {skan_filter_cond} and INSTALL_DT between '{compute_start_dt}' and '{skan_end_dt}'
+) s left join revenue_share_rate r
+on s.APPLICATION_FAMILY_NAME = r.APPLICATION_FAMILY_NAME and r.MARKET_CD = 'IT' and s.INSTALL_DT between r.START_DT and r.END_DT
+group by 1, 2, 3, 4, 5, 6
+  """
+    return run_sql(con, sql)
+
+
+def adjust_ios_organic(
+    con: duckdb.DuckDBPyConnection,
+    mmp_campaign_details_table: pa.Table,
+    skan_campaign_details_table: pa.Table,
+    other_campaign_details_table: pa.Table,
+) -> pa.Table:
+    """
+    Combine the skan and other campaign details, and adjust iOS organic (user_source_type_cd = US) = MMP_Total - SKAN_Total - MMP_Paid.
+    Negative metrics are clamped to 0
+    """
+    agg_cols = [col for col in mmp_campaign_details_table.column_names if col not in CAMPAIGN_COLS]
+    group_cols = "APPLICATION_FAMILY_NAME, MARKET_CD, CALENDAR_DT"
+    agg_col_list = ", ".join(agg_cols)
+    adjusted_cols = ",\n    ".join(
+        f"sum(case when TAG = 'MMP_TOTAL' then {col} end)"
+        f" - coalesce(sum(case when TAG = 'MMP_PAID' then {col} end), 0)"
+        f" - coalesce(sum(case when TAG = 'SKAN_PAID' then {col} end), 0) as {col}"
+        for col in agg_cols
+    )
+    output_cols = [*CHANNEL_COLS, "PROMOTION_NAME", *agg_cols]
+    clamped_cols = ",\n  ".join(
+        f"case when {col} >= 0 then {col} else 0 end as {col}" if col in agg_cols else col
+        for col in output_cols
+    )
+    sql = f"""
+with tagged as (
+  select {group_cols}, {agg_col_list}, 'MMP_TOTAL' as TAG
+  from mmp_campaign_details
+  where MARKET_CD = 'IT' and USER_SOURCE_TYPE_CD in ('MK', 'US')
+  union all
+  select {group_cols}, {agg_col_list}, 'MMP_PAID' as TAG
+  from other_campaign_details
+  where MARKET_CD = 'IT' and USER_SOURCE_TYPE_CD = 'MK'
+  union all
+  select {group_cols}, {agg_col_list}, 'SKAN_PAID' as TAG
+  from skan_campaign_details
+),
+mmp_ios_organic as (
+  select
+    {group_cols},
+    {adjusted_cols},
+    'US' as USER_SOURCE_TYPE_CD,
+    'Non-SKAN' as SOURCE,
+    'ORGANIC' as CHANNEL_NAME,
+    'ORGANIC' as PROMOTION_NAME
+  from tagged
+  group by {group_cols}
+  having bool_or(TAG = 'MMP_TOTAL')
+),
+campaign_details as (
+  select {", ".join(output_cols)} from mmp_ios_organic
+  union all
+  select {", ".join(output_cols)} from other_campaign_details
+  where MARKET_CD = 'IT' and USER_SOURCE_TYPE_CD != 'US'
+  union all
+  select {", ".join(output_cols)} from skan_campaign_details
+  union all
+  select {", ".join(col if col != "SOURCE" else "'Non-SKAN' as SOURCE" for col in output_cols)} from mmp_campaign_details
+  where MARKET_CD = 'GO'
+)
+select
+  {clamped_cols}
+from campaign_details
+  """
+    return run_sql(
+        con,
+        sql,
+        mmp_campaign_details=mmp_campaign_details_table,
+        skan_campaign_details=skan_campaign_details_table,
+        other_campaign_details=other_campaign_details_table,
+    )
+
+
+def get_complete_campaign_details(
+    con: duckdb.DuckDBPyConnection,
+    campaign_details_table: pa.Table,
+    skan_campaign_ltv_table: pa.Table,
+) -> pa.Table:
+    """
+    For SKAN campaigns, use SKAN LTV and general spend; For non-SKAN campaigns, use general details
+    """
+    join_cols = ", ".join(SKAN_JOIN_COLS)
+    skan_campaign_details_table = run_sql(
+        con,
+        f"""
+select
+  s.*,
+  coalesce(c.USER_SOURCE_TYPE_CD, 'MK') as USER_SOURCE_TYPE_CD,
+  coalesce(c.SPEND, 0) as SPEND
+from skan_campaign_ltv s left join (
+  select {join_cols}, USER_SOURCE_TYPE_CD, SPEND from campaign_details
+) c
+using ({join_cols})
+  """,
+        skan_campaign_ltv=skan_campaign_ltv_table,
+        campaign_details=campaign_details_table,
+    )
+    other_campaign_details_table = run_sql(
+        con,
+        f"""
+select c.*, 'Non-SKAN' as SOURCE
+from campaign_details c anti join skan_campaign_details s
+using ({join_cols})
+  """,
+        campaign_details=campaign_details_table,
+        skan_campaign_details=skan_campaign_details_table,
+    )
+
+    campaign_details_table = adjust_ios_organic(
+        con, campaign_details_table, skan_campaign_details_table, other_campaign_details_table
+    )
+    return campaign_details_table.rename_columns(
+        ["INSTALL" if col == "INSTALL_NUM" else col for col in campaign_details_table.column_names]
+    )
+
+
+def aggregate_campaign_to_channel_details(
+    con: duckdb.DuckDBPyConnection, campaign_details_table: pa.Table, metrics: List[NamedTuple]
+) -> pa.Table:
+    """
+    Aggregate campaign-level details into channel-level details
+    """
+    metric_cols, int_metric_cols = get_metric_cols(metrics)
+    metric_sums = ",\n  ".join(
+        f"sum({col})::bigint as {col}" if col in int_metric_cols else f"sum({col}) as {col}"
+        for col in metric_cols
+    )
+    sql = f"""
+select
+  {", ".join(CHANNEL_COLS)},
+  {metric_sums}
+from campaign_details
+group by {", ".join(CHANNEL_COLS)}
+  """
+    return run_sql(con, sql, campaign_details=campaign_details_table)
+
+
+def revise_schema(con: duckdb.DuckDBPyConnection, table: pa.Table, metrics: List[NamedTuple]) -> pa.Table:
+    """
+    Cast the metrics to the published float and int columns
+    """
+    metric_cols, int_metric_cols = get_metric_cols(metrics)
+    cols = ",\n  ".join(
+        f"{col}::integer as {col}" if col in int_metric_cols
+        else f"{col}::float as {col}" if col in metric_cols
+        else col
+        for col in table.column_names
+    )
+    return run_sql(con, f"select\n  {cols}\nfrom details", details=table)
+
+
+def run_merge(
+    source_dir: str,
+    game_list: List[str],
+    market_list: List[str],
+    compute_start_dt: str,
+    end_dt: str,
+    skan_end_dt: str,
+    fact_promo_filter_cond: str,
+    skan_filter_cond: str,
+    rate_rows: List[tuple],
+    channel_aliases: Dict[str, str],
+    metrics: List[NamedTuple],
+) -> Tuple[pa.Table, pa.Table]:
+    """
+    Run every stage from get_campaign_without_sub_ltv to revise_schema over the parquet under source_dir,
+    and return the campaign and channel details as they are published, with the given Metric tuples of the notebook's get_metrics()
+    """
+    con = connect(source_dir, rate_rows, channel_aliases)
+    try:
+        campaign_without_sub_pltv_table = get_campaign_without_sub_ltv(
+            con, game_list, market_list, compute_start_dt, end_dt, fact_promo_filter_cond, metrics
+        )
+        campaign_sub_pltv_table = get_campaign_sub_ltv(
+            con, game_list, market_list, compute_start_dt, end_dt
+        )
+        campaign_details_table = get_campaign_details(
+            con, campaign_without_sub_pltv_table, campaign_sub_pltv_table
+        )
+        skan_campaign_ltv_table = get_skan_campaign_ltv(
+            con, game_list, compute_start_dt, skan_end_dt, skan_filter_cond, metrics
+        )
+        campaign_details_table = get_complete_campaign_details(
+            con, campaign_details_table, skan_campaign_ltv_table
+        )
+        channel_details_table = aggregate_campaign_to_channel_details(con, campaign_details_table, metrics)
+        return revise_schema(con, campaign_details_table, metrics), revise_schema(con, channel_details_table, metrics)
+    finally:
+        con.close()
+
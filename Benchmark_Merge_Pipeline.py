@@ -0,0 +1,262 @@
+"""
+Time every stage of Daily_Merge_Table_Update.py on a local SparkSession over synthetic source tables, and record the timings as JSON
+so that they can be compared across commits.
+
+With --check-arrow-parity the source tables are also exported to parquet and merged by Arrow_Merge_Engine.py,
+and the run fails unless its campaign and channel details match the spark stages.
+
+Usage:
+    python Benchmark_Merge_Pipeline.py --scale small --output bench_small.json
+    python Benchmark_Merge_Pipeline.py --scale small --check-arrow-parity
+    python Benchmark_Merge_Pipeline.py --scale medium --override SORT_FREE_FLAG=True --output bench_sort_free.json
+"""
+
+import argparse
+import ast
+import json
+import subprocess
+import sys
+import tempfile
+import time
+import pyspark.sql as ps
+from pathlib import Path
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+from Synthetic_Source_Tables import (
+    SOURCE_TABLE_NAMES,
+    SYNTHETIC_SCALES,
+    generate_source_tables,
+    get_date_range,
+    get_game_list,
+)
+
+NOTEBOOK_PATH = Path(__file__).resolve().parent / "Daily_Merge_Table_Update.py"
+
+
+def load_pipeline(spark: ps.SparkSession, overrides: Dict[str, str]) -> dict:
+    """
+    Execute the notebook source with its top-level assignments in overrides replaced by the given python expressions,
+    and return its namespace. ENVIRONMENT is overridden to None, so that neither the development nor the production cells run
+    """
+    source = NOTEBOOK_PATH.read_text()
+    lines = source.splitlines(keepends=True)
+    overrides = {"ENVIRONMENT": "None", **overrides}
+    for node in reversed(ast.parse(source).body):
+        if (
+            isinstance(node, ast.Assign)
+            and len(node.targets) == 1
+            and isinstance(node.targets[0], ast.Name)
+            and node.targets[0].id in overrides
+        ):
+            name = node.targets[0].id
+            lines[node.lineno - 1 : node.end_lineno] = [f"{name} = {overrides[name]}\n"]
+
+    namespace = {"spark": spark, "display": lambda df: None, "__name__": "daily_merge_table_update"}
+    exec(compile("".join(lines), str(NOTEBOOK_PATH), "exec"), namespace)
+    return namespace
+
+
+def get_git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=NOTEBOOK_PATH.parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def time_stage(
+    stage: str, run_stage: Callable, nb: dict, stage_results: List[dict]
+) -> Optional[ps.DataFrame]:
+    """
+    Run one stage and fully compute its output into the cache, so that the next stage only pays for its own work.
+    Append the wall time, output rows and analyzed plan size of the stage to stage_results
+    """
+    start_time = time.perf_counter()
+    result = run_stage()
+    row_num, plan_depth, plan_node_num = None, None, None
+    if isinstance(result, ps.DataFrame):
+        plan_depth, plan_node_num = nb["get_plan_stats"](result)
+        result = result.persist()
+        row_num = result.count()
+    stage_results.append(
+        {
+            "stage": stage,
+            "seconds": round(time.perf_counter() - start_time, 3),
+            "rows": row_num,
+            "plan_depth": plan_depth,
+            "plan_nodes": plan_node_num,
+        }
+    )
+    print(stage_results[-1])
+    return result
+
+
+def check_arrow_parity(
+    spark: ps.SparkSession, nb: dict, campaign_df: ps.DataFrame, channel_df: ps.DataFrame
+) -> dict:
+    """
+    Export the source tables to the parquet read by the arrow engine, run it, and compare its campaign and channel details
+    with the published form of campaign_df and channel_df computed by the spark stages
+    """
+    from Merge_Parity import get_parity_violations
+
+    for table_name in SOURCE_TABLE_NAMES.values():
+        spark.table(table_name).write.mode("overwrite").parquet(
+            str(Path(nb["ARROW_SOURCE_DIR"], f"{table_name}.parquet"))
+        )
+    start_time = time.perf_counter()
+    campaign_table, channel_table = nb["run_arrow_merge"]()
+    arrow_seconds = round(time.perf_counter() - start_time, 3)
+
+    parity = {"arrow_seconds": arrow_seconds}
+    for name, df, table, key_cols in [
+        ("campaign", campaign_df, campaign_table, nb["CAMPAIGN_KEY_COLS"]),
+        ("channel", channel_df, channel_table, nb["CHANNEL_KEY_COLS"]),
+    ]:
+        violation_df = get_parity_violations(
+            nb["revise_schema"](df).toPandas(), table.to_pandas(), key_cols
+        )
+        if len(violation_df) > 0:
+            print(f"{len(violation_df)} {name} parity violations:")
+            print(violation_df[[*key_cols, "VIOLATION"]].head(20).to_string())
+        parity[f"{name}_rows"] = table.num_rows
+        parity[f"{name}_violations"] = len(violation_df)
+    print(parity)
+    return parity
+
+
+def run_benchmark(
+    spark: ps.SparkSession,
+    scale: Dict[str, int],
+    save_dir: str,
+    seed: int = 0,
+    arrow_parity: bool = False,
+    overrides: Optional[Dict[str, str]] = None,
+) -> dict:
+    """
+    Generate the synthetic source tables, then time each stage function of the pipeline from get_campaign_without_sub_ltv to save_result.
+    overrides replaces top-level assignments of the notebook by python expressions, e.g. to time a flag turned on.
+    With arrow_parity, also check the arrow engine against the spark stages
+    """
+    source_rows = generate_source_tables(spark, scale, seed)
+    start_date, _ = get_date_range(scale)
+    nb = load_pipeline(
+        spark,
+        {
+            "GAME_LIST": repr(get_game_list(scale)),
+            "START_DT": repr(start_date.isoformat()),
+            "DBFS_SAVE_DIR": repr(save_dir),
+            "ARROW_SOURCE_DIR": repr(str(Path(save_dir).parent / "arrow_sources")),
+            **(overrides or {}),
+        },
+    )
+
+    stage_results = []
+    without_sub_df = time_stage(
+        "get_campaign_without_sub_ltv", nb["get_campaign_without_sub_ltv"], nb, stage_results
+    )
+    sub_df = time_stage("get_campaign_sub_ltv", nb["get_campaign_sub_ltv"], nb, stage_results)
+    campaign_df = time_stage(
+        "get_campaign_details",
+        lambda: nb["get_campaign_details"](without_sub_df, sub_df),
+        nb,
+        stage_results,
+    )
+    skan_df = time_stage("get_skan_campaign_ltv", nb["get_skan_campaign_ltv"], nb, stage_results)
+    campaign_df = time_stage(
+        "get_complete_campaign_details",
+        lambda: nb["get_complete_campaign_details"](campaign_df, skan_df),
+        nb,
+        stage_results,
+    )
+    channel_df = time_stage(
+        "aggregate_campaign_to_channel_details",
+        lambda: nb["aggregate_campaign_to_channel_details"](campaign_df),
+        nb,
+        stage_results,
+    )
+
+    time_stage(
+        "qa_result",
+        lambda: nb["get_qa_violations"](
+            nb["get_old_game_details_df"](), nb["aggregate_to_game_details"](channel_df)
+        ),
+        nb,
+        stage_results,
+    )
+    time_stage(
+        "save_result", lambda: nb["save_result"](campaign_df, channel_df), nb, stage_results
+    )
+
+    result = {
+        "commit": get_git_commit(),
+        "run_at": datetime.now().isoformat(timespec="seconds"),
+        "spark_version": spark.version,
+        "shuffle_partitions": spark.conf.get("spark.sql.shuffle.partitions"),
+        "scale": scale,
+        "overrides": overrides or {},
+        "source_rows": source_rows,
+        "stages": stage_results,
+        "total_seconds": round(sum(result["seconds"] for result in stage_results), 3),
+    }
+    if arrow_parity:
+        result["arrow_parity"] = check_arrow_parity(spark, nb, campaign_df, channel_df)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scale", choices=sorted(SYNTHETIC_SCALES), default="small")
+    for dimension in ["games", "channels", "promotions", "days", "users", "organic_skew"]:
+        parser.add_argument(f"--{dimension.replace('_', '-')}", type=int, help=f"override the {dimension} of the scale")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--master", default="local[*]")
+    parser.add_argument("--shuffle-partitions", type=int, default=8)
+    parser.add_argument("--work-dir", help="warehouse and output directory, a temporary directory by default")
+    parser.add_argument("--output", default="benchmark_result.json")
+    parser.add_argument(
+        "--check-arrow-parity", action="store_true", help="fail unless the arrow engine matches the spark stages"
+    )
+    parser.add_argument(
+        "--override",
+        action="append",
+        default=[],
+        metavar="NAME=EXPRESSION",
+        help="replace a top-level assignment of the notebook, e.g. SORT_FREE_FLAG=True",
+    )
+    args = parser.parse_args()
+
+    scale = dict(SYNTHETIC_SCALES[args.scale])
+    for dimension in scale:
+        if getattr(args, dimension) is not None:
+            scale[dimension] = getattr(args, dimension)
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="skan_performance_benchmark_")
+
+    spark = (
+        ps.SparkSession.builder.master(args.master)
+        .appName("skan_performance_benchmark")
+        .config("spark.sql.warehouse.dir", str(Path(work_dir, "warehouse")))
+        .config("spark.sql.shuffle.partitions", args.shuffle_partitions)
+        .config("spark.ui.showConsoleProgress", "false")
+        .getOrCreate()
+    )
+    overrides = dict(override.split("=", 1) for override in args.override)
+    result = run_benchmark(
+        spark, scale, str(Path(work_dir, "dbfs")), args.seed, args.check_arrow_parity, overrides
+    )
+    Path(args.output).write_text(json.dumps(result, indent=2))
+    print(f"{result['total_seconds']}s in total, written to {args.output}")
+    if args.check_arrow_parity and (
+        result["arrow_parity"]["campaign_violations"] or result["arrow_parity"]["channel_violations"]
+    ):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,10 +7,25 @@
 
 import pyspark.sql.functions as F
 import pyspark.sql as ps
+from pyspark import StorageLevel
+from pyspark.sql import Window
 import pandas as pd
+import pyarrow as pa
+import uuid
+import hashlib
+import types
+import threading
+import json
+import time
+import math
+import urllib.request
 from enum import Enum
-from typing import List, Tuple, Union
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, NamedTuple, Optional, Tuple, Union
 from pathlib import Path
+from pyspark.sql.utils import AnalysisException
+from pyspark.sql.streaming import StreamingQueryListener
 from datetime import datetime, date, timedelta
 
 # COMMAND ----------
@@ -22,6 +37,62 @@ class Environment(Enum):
 
 ENVIRONMENT = Environment.PRODUCTION
 
+
+class WriteMode(Enum):
+    OVERWRITE = 1
+    INCREMENTAL = 2
+
+
+WRITE_MODE = WriteMode.OVERWRITE
+
+
+class PublishMode(Enum):
+    PARQUET_AND_TABLE = 1
+    VERSIONED_TABLE = 2
+
+
+PUBLISH_MODE = PublishMode.PARQUET_AND_TABLE
+
+
+# how parquet-and-table mode keeps its daily snapshots: FULL_COPY writes a dated copy to CHANNEL_PARQUET_PATH and CAMPAIGN_PARQUET_PATH,
+# CHANGES only writes the rows that changed since the previous day under SNAPSHOT_DIR, see write_snapshot_changes().
+# FULL_COPY by default, until the changes layout and its readers have run against production
+class SnapshotMode(Enum):
+    FULL_COPY = 1
+    CHANGES = 2
+
+
+SNAPSHOT_MODE = SnapshotMode.FULL_COPY
+
+
+class ExecutionMode(Enum):
+    ALL_GAMES = 1
+    PER_GAME_GROUP = 2
+    BACKFILL = 3
+    SKAN_STREAMING = 4
+
+
+EXECUTION_MODE = ExecutionMode.ALL_GAMES
+
+
+class TableLayout(Enum):
+    GAME = 1
+    GAME_AND_INSTALL_MONTH = 2
+
+
+# physical layout of the campaign and channel tables; switching it needs one full overwrite run
+TABLE_LAYOUT = TableLayout.GAME
+
+
+class Engine(Enum):
+    SPARK = 1
+    ARROW = 2
+
+
+# ARROW computes campaign and channel details in process on duckdb from the local parquet copies of the source tables under ARROW_SOURCE_DIR,
+# see Arrow_Merge_Engine.py; QA and publishing still run on spark
+ENGINE = Engine.SPARK
+
 # COMMAND ----------
 
 # MAGIC %md
@@ -30,6 +101,31 @@ ENVIRONMENT = Environment.PRODUCTION
 # COMMAND ----------
 
 SAVE_FLAG = True
+# every stage's analyzed logical plan should stay within these bounds. Stages over them are reported at run time, see check_plan_budget(),
+# and tests/test_plan_budget.py fails on final campaign and channel plans over them
+PLAN_DEPTH_BUDGET = 50
+PLAN_NODE_BUDGET = 1000
+# campaign and channel details are computed once and pinned with this storage level, or checkpointed when CHECKPOINT_DIR is set
+PERSIST_STORAGE_LEVEL = "MEMORY_AND_DISK"
+CHECKPOINT_DIR = None
+# when set, the output of every stage is pinned as well, so that the metrics of the run report are attributed to the stage that did the work.
+# The pins upstream of the complete campaign details are released as soon as those are pinned.
+# Off by default: each pin costs a count and keeps a stage output in memory. Without it, the work of the unpinned stages is reported
+# under the first pinned stage that reads them, the complete campaign details
+INSTRUMENT_STAGES = False
+# a campaign-key join key is heavy when it has more than SKEW_MIN_KEY_ROWS rows and SKEW_KEY_FACTOR times the average rows per key.
+# Heavy keys are reported in the run report, and up to SKEW_MAX_HOT_KEYS of them are joined separately with their matching rows broadcast.
+# Off by default: the campaign keys are nearly unique, and adaptive execution already splits skewed join partitions (spark.sql.adaptive.skewJoin.enabled).
+# When set, the keys are estimated from a SKEW_SAMPLE_FRACTION sample of each join input, which still scans the unpinned inputs once more
+SKEW_JOIN_FLAG = False
+SKEW_SAMPLE_FRACTION = 0.01
+SKEW_MIN_KEY_ROWS = 10000
+SKEW_KEY_FACTOR = 10
+SKEW_MAX_HOT_KEYS = 1000
+# when set, the warehouse queries skip their global sort, since every later join and group-by discards it.
+# The published tables and snapshots are sorted once at write time within their partitions, see apply_table_layout().
+# Off by default: the development displays and direct reads of the stage outputs still show the warehouse queries in key order
+SORT_FREE_FLAG = False
 
 DATE_FORMAT = "%Y-%m-%d"
 
@@ -37,6 +133,16 @@ today = date.today()
 REPORT_DELAY_DAYS = 3
 START_DT = "2021-01-01"
 END_DT = datetime.strftime(today - timedelta(days=REPORT_DELAY_DAYS), DATE_FORMAT)
+# in incremental mode only install dates within the trailing window are recomputed and merged into the existing tables.
+# With the install month layout the window starts on the first of its month, so that whole month partitions are replaced
+INCREMENTAL_WINDOW_DAYS = 35
+if WRITE_MODE == WriteMode.INCREMENTAL:
+    compute_start_date = today - timedelta(days=REPORT_DELAY_DAYS + INCREMENTAL_WINDOW_DAYS)
+    if TABLE_LAYOUT == TableLayout.GAME_AND_INSTALL_MONTH:
+        compute_start_date = compute_start_date.replace(day=1)
+    COMPUTE_START_DT = datetime.strftime(compute_start_date, DATE_FORMAT)
+else:
+    COMPUTE_START_DT = START_DT
 GAME_LIST = [
     "Cookie Jam",
     "Cookie Jam Blast",
@@ -54,11 +160,95 @@ GAME_LIST = [
 ]
 LUDIA_TITLES = ["Jurassic World Alive", "Lovelink", "Jurassic World the Game"]
 MARKET_LIST = ["IT", "GO"]
+# in per-game-group mode each group runs as its own pipeline in a driver thread and fair-scheduler pool (requires spark.scheduler.mode FAIR); None runs every game on its own
+GAME_GROUPS = None
+GAME_PARALLELISM = 4
 FACT_PROMO_FILTER_COND = "CHANNEL_NAME not like '%UNTRUSTED%'"  # may also include PROMOTION_NAME not like 'RT_%' and PROMOTION_NAME not like 'XP_%'
 SKAN_FILTER_COND = "CHANNEL_NAME not like '%UNTRUSTED%'"
+# day horizons of the retention and revenue metrics, see get_metrics(). A new horizon only needs its source columns in the fact_promo table
+RETENTION_HORIZONS = [1, 3, 7]
+REVS_HORIZONS = [1, 3, 7, 14, 28]
+# horizons computed by a run, e.g. (1, 7) for a quick ad-hoc run, which is then not published; None computes all of them
+METRIC_HORIZONS = None
+
+
+# in backfill mode the dates from COMPUTE_START_DT on are recomputed in chunks of BACKFILL_CHUNK_MONTHS months, up to BACKFILL_PARALLELISM at a time.
+# Finished chunks are recorded in the ledger under BACKFILL_ID, and a restart with the same BACKFILL_ID skips them; change it to start a new backfill
+BACKFILL_ID = "backfill_1"
+BACKFILL_CHUNK_MONTHS = 1
+BACKFILL_PARALLELISM = 4
+BACKFILL_LEDGER_TABLE_NAME = "ua.skan_performance_backfill_ledger"
+
+
+class RunConfig(NamedTuple):
+    """
+    The games and install dates computed by one pipeline run. It is passed to every stage, so that several runs can be in flight at once
+    """
+    game_list: List[str]
+    run_dt: date
+    compute_start_dt: str
+    # last install date read from the mmp sources, which report with a delay of REPORT_DELAY_DAYS
+    end_dt: str
+    # last install date read from ua.skan_ltv
+    skan_end_dt: str
+    is_backfill_chunk: bool = False
+    # day horizons of the retention and revenue metrics to compute, None for all
+    metric_horizons: Optional[Tuple[int, ...]] = None
+    # markets read from the mmp sources and replaced in the published tables, e.g. only IT where a skan stream batch changes the SKAN rows.
+    # A tuple, so that no run config shares the module's MARKET_LIST
+    market_list: Tuple[str, ...] = tuple(MARKET_LIST)
+
+
+RUN_CONFIG = RunConfig(
+    game_list=GAME_LIST,
+    run_dt=today,
+    compute_start_dt=COMPUTE_START_DT,
+    end_dt=END_DT,
+    skan_end_dt=datetime.strftime(today - timedelta(days=1), DATE_FORMAT),
+    metric_horizons=METRIC_HORIZONS,
+)
+
 
+def to_sql_list(values: List[str]) -> str:
+    """
+    Format values as a sql list, e.g. ('IT', 'GO'). Unlike str(tuple(values)), this is also valid for a single value
+    """
+    return "(" + ", ".join(f"'{value}'" for value in values) + ")"
+
+
+def get_order_by_clause(col_num: int) -> str:
+    """
+    Return the clause ordering a query by its first col_num columns, or nothing with SORT_FREE_FLAG
+    """
+    if SORT_FREE_FLAG:
+        return ""
+    return "order by " + ", ".join(str(i) for i in range(1, col_num + 1))
+
+
+FACT_PROMO_TABLE_NAME = "pr_analytics_agg.fact_promotion_expense_daily"
+INSTALL_TABLE_NAME = "pr_analytics_delta.install"
+INDIVIDUAL_LTV_TABLE_NAME = "ua.internal_individual_ltv"
+SKAN_LTV_TABLE_NAME = "ua.skan_ltv"
 CHANNEL_TABLE_NAME = "ua.skan_performance_channel_ltv"
 CAMPAIGN_TABLE_NAME = "ua.skan_performance_campaign_ltv"
+CHANNEL_KEY_COLS = [
+    "APPLICATION_FAMILY_NAME",
+    "MARKET_CD",
+    "SOURCE",
+    "USER_SOURCE_TYPE_CD",
+    "CHANNEL_NAME",
+    "CALENDAR_DT",
+]
+CAMPAIGN_KEY_COLS = CHANNEL_KEY_COLS + ["PROMOTION_NAME"]
+# the grain of get_skan_campaign_ltv(), by which SKAN_STREAM_TABLE_NAME is upserted
+SKAN_CAMPAIGN_KEY_COLS = ["APPLICATION_FAMILY_NAME", "MARKET_CD", "SOURCE", "CHANNEL_NAME", "PROMOTION_NAME", "CALENDAR_DT"]
+# daily spend and installs per game, market and source, written at publish time and read by the next run's QA
+QA_SUMMARY_TABLE_NAME = "ua.skan_performance_qa_summary"
+QA_SUMMARY_KEY_COLS = ["APPLICATION_FAMILY_NAME", "MARKET_CD", "SOURCE", "CALENDAR_DT"]
+# serving tables of the game-day, channel-week and channel-month rollups, see get_rollups(). CALENDAR_DT is the first day of the week or month
+GAME_TABLE_NAME = "ua.skan_performance_game_ltv"
+CHANNEL_WEEKLY_TABLE_NAME = "ua.skan_performance_channel_weekly_ltv"
+CHANNEL_MONTHLY_TABLE_NAME = "ua.skan_performance_channel_monthly_ltv"
 DBFS_SAVE_DIR = (
     "/mnt/jc-analytics-databricks-work/home/dongb/UA/SKAN/SKAN_Performance_Merge_PLTV"
 )
@@ -68,6 +258,225 @@ CHANNEL_PARQUET_PATH = str(
 CAMPAIGN_PARQUET_PATH = str(
     Path(DBFS_SAVE_DIR, f"campaign_{datetime.strftime(today, DATE_FORMAT)}.parquet")
 )
+# in versioned-table mode, daily snapshots are kept as delta table versions for this many days instead of dated parquet copies,
+# and in changes mode every day of this many days stays reconstructible
+SNAPSHOT_RETENTION_DAYS = 90
+# in changes mode, the changed, inserted and deleted rows of every day are written under SNAPSHOT_DIR, and a full base of each game every SNAPSHOT_BASE_INTERVAL_DAYS days
+SNAPSHOT_DIR = str(Path(DBFS_SAVE_DIR, "snapshots"))
+SNAPSHOT_BASE_INTERVAL_DAYS = 7
+# published partitions are written in files of up to PARQUET_FILE_MAX_ROWS rows, with row groups of PARQUET_ROW_GROUP_BYTES and
+# bloom filters on PARQUET_BLOOM_FILTER_COLS, so that readers filtering on them skip most row groups
+PARQUET_FILE_MAX_ROWS = 4000000
+PARQUET_ROW_GROUP_BYTES = 32 * 1024 * 1024
+PARQUET_BLOOM_FILTER_COLS = ["CHANNEL_NAME", "PROMOTION_NAME"]
+# every partition is written by one task per PARTITION_WRITE_PERIOD of its install dates, so that a big title's history is written in parallel
+PARTITION_WRITE_PERIOD = "quarter"
+# after a merge into a delta table, the game partitions it touched are compacted into files of up to TARGET_FILE_BYTES and z-ordered by the bloom filter columns.
+# Off by default: the optimize rewrites every touched game partition after each merge, which adds to the run's wall time what the readers save
+COMPACT_TABLES_FLAG = False
+TARGET_FILE_BYTES = 128 * 1024 * 1024
+# per-stage wall time, rows and task metrics of every run are appended to this table and written as json under RUN_REPORT_DIR
+RUN_ID = datetime.now().strftime("%Y%m%d%H%M%S")
+RUN_REPORT_TABLE_NAME = "ua.skan_performance_run_report"
+RUN_REPORT_DIR = str(Path(DBFS_SAVE_DIR, "run_reports"))
+# stage outputs are cached under a fingerprint of their code, their source table versions and the parts of the run config they read, and reused while it is unchanged.
+# The source versions are read once per run, and the window dates are part of the fingerprint, so outputs are reused by runs over the same window
+# while the sources are unchanged, e.g. a rerun of the day after a failure, which then skips publishing what was already published.
+# Off by default: every stage output is also written under STAGE_CACHE_DIR, which only pays off when runs repeat a window over unchanged sources
+STAGE_CACHE_FLAG = False
+STAGE_CACHE_DIR = str(Path(DBFS_SAVE_DIR, "stage_cache"))
+STAGE_CACHE_RETENTION_DAYS = 7
+# when set, every pinned stage runs with shuffle partitions, broadcast threshold and adaptive execution settings derived from the largest input, shuffle
+# and spill bytes it had in the last TUNE_HISTORY_RUNS successful runs over the same games, see get_stage_spark_conf().
+# Shuffle partitions target TUNE_PARTITION_BYTES each, with TUNE_HEADROOM for growth, and stay within the bounds below.
+# Off by default: the settings follow the run history, so a run after an unusually small or large one is tuned for that one
+AUTO_TUNE_FLAG = False
+TUNE_HISTORY_RUNS = 5
+TUNE_HEADROOM = 1.25
+TUNE_PARTITION_BYTES = 128 * 1024 * 1024
+TUNE_MIN_SHUFFLE_PARTITIONS = 8
+TUNE_MAX_SHUFFLE_PARTITIONS = 4000
+TUNE_MAX_BROADCAST_BYTES = 64 * 1024 * 1024
+# stage: {spark conf: value} applied while the stage runs, over the tuned settings, e.g. {"get_campaign_sub_ltv": {"spark.sql.shuffle.partitions": "2000"}}.
+# Like the tuned settings, they are skipped while game groups run in parallel, since the settings are shared by the whole session
+STAGE_SPARK_CONF_OVERRIDES = {}
+# in skan streaming mode, new ua.skan_ltv rows are aggregated every SKAN_STREAM_TRIGGER_MINUTES into the campaign-grain SKAN frame kept in SKAN_STREAM_TABLE_NAME,
+# and the campaign and channel rows of the games and install dates they touch are republished, see run_skan_stream().
+# SKAN_STREAM_SOURCE_DIR reads the new rows from parquet files dropped into a directory instead, e.g. for local tests
+SKAN_STREAM_TABLE_NAME = "ua.skan_performance_skan_stream_ltv"
+SKAN_STREAM_CHECKPOINT_DIR = str(Path(DBFS_SAVE_DIR, "skan_stream_checkpoint"))
+SKAN_STREAM_TRIGGER_MINUTES = 15
+SKAN_STREAM_SOURCE_DIR = None
+# the totals of an install date are final once the stream has seen installs SKAN_STREAM_WATERMARK_DAYS later, which must outlast the last postback of an install.
+# Their state is then dropped, along with any later row of that date, and the rows dropped are printed for every micro-batch
+SKAN_STREAM_WATERMARK_DAYS = 45
+# when set, get_skan_campaign_ltv() reads the SKAN frame kept by the streaming mode instead of rescanning ua.skan_ltv.
+# Off by default: the daily run would then depend on the streaming query having kept up, and miss the in-place corrections it skips
+SKAN_STREAM_FLAG = False
+ARROW_SOURCE_DIR = None
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### Define Revenue Share Rates
+
+# COMMAND ----------
+
+# bump REVENUE_SHARE_VERSION whenever a rate below changes. It is recorded in the RATE_VERSION column of the run report, which traces published numbers
+# back to the rates used, and it invalidates the cached stage outputs computed with other rates
+REVENUE_SHARE_VERSION = 2
+# game: (IAP_RATE, AD_RATE, SUB_FIRST_YEAR_RATE, SUB_AFTER_FIRST_YEAR_RATE); games not listed use "default"
+REVENUE_SHARE_RATES = {
+    "default": (0.7, 1.0, 0.7, 0.85),
+    "Harry Potter": (0.616, 0.88, 0.616, 0.748),
+    "Jurassic World the Game": (0.525, 0.75, 0.525, 0.638),
+    "DC Heroes & Villains": (0.546, 0.78, 0.7, 0.85),
+}
+# GO subscriptions installed from this date on get the after-first-year rate
+GO_SUB_RATE_CHANGE_DT = date(2022, 1, 1)
+# IT subscriptions installed more than this many days before the run date get the after-first-year rate
+IT_SUB_RATE_WINDOW_DAYS = 366
+CHANNEL_ALIASES = {"SKANUAC": "ADWORDS", "SKANFB": "SGNFB"}
+REVENUE_SHARE_RATE_SCHEMA = (
+    "APPLICATION_FAMILY_NAME string, MARKET_CD string, START_DT date, END_DT date, "
+    "IAP_RATE double, AD_RATE double, SUB_RATE double, SUB_LTV_RATE double, RATE_VERSION int"
+)
+
+
+def get_revenue_share_rates(run_config: RunConfig = RUN_CONFIG) -> List[tuple]:
+    """
+    Return one row per game and market of run_config and effective date range with the IAP, AD, SUB and SUB_LTV rates, in the columns of REVENUE_SHARE_RATE_SCHEMA.
+    SUB_RATE applies to realized subscription revenue and SUB_LTV_RATE to projected subscription ltv.
+    The IT rate change date is counted from the run date of run_config, so that a run's rates do not depend on the day it is (re)computed
+    """
+    it_sub_rate_change_dt = run_config.run_dt - timedelta(days=IT_SUB_RATE_WINDOW_DAYS)
+    min_dt, max_dt = date(1900, 1, 1), date(9999, 12, 31)
+    rows = []
+    for game in run_config.game_list:
+        iap_rate, ad_rate, sub_first_year_rate, sub_after_first_year_rate = (
+            REVENUE_SHARE_RATES.get(game, REVENUE_SHARE_RATES["default"])
+        )
+        for market in run_config.market_list:
+            # (START_DT, END_DT, SUB_RATE, SUB_LTV_RATE)
+            if market == "GO":
+                periods = [
+                    (min_dt, GO_SUB_RATE_CHANGE_DT - timedelta(days=1), sub_first_year_rate, sub_first_year_rate),
+                    (GO_SUB_RATE_CHANGE_DT, max_dt, sub_after_first_year_rate, sub_after_first_year_rate),
+                ]
+            elif market == "IT":
+                periods = [
+                    (min_dt, it_sub_rate_change_dt - timedelta(days=1), sub_after_first_year_rate, sub_first_year_rate),
+                    (it_sub_rate_change_dt, max_dt, sub_first_year_rate, sub_first_year_rate),
+                ]
+            else:
+                periods = [(min_dt, max_dt, 0.0, 0.0)]
+            for start_dt, end_dt, sub_rate, sub_ltv_rate in periods:
+                rows.append(
+                    (game, market, start_dt, end_dt, iap_rate, ad_rate, sub_rate, sub_ltv_rate, REVENUE_SHARE_VERSION)
+                )
+    return rows
+
+
+def get_revenue_share_rate_df(run_config: RunConfig = RUN_CONFIG) -> ps.DataFrame:
+    return spark.createDataFrame(get_revenue_share_rates(run_config), REVENUE_SHARE_RATE_SCHEMA)
+
+
+def create_rate_views(run_config: RunConfig = RUN_CONFIG) -> None:
+    """
+    Register the revenue share rates and the channel aliases as the temp views revenue_share_rate and channel_alias, which are broadcast-joined by the warehouse queries
+    """
+    get_revenue_share_rate_df(run_config).createOrReplaceTempView("revenue_share_rate")
+    spark.createDataFrame(
+        list(CHANNEL_ALIASES.items()), "ALIAS_CHANNEL_NAME string, MAPPED_CHANNEL_NAME string"
+    ).createOrReplaceTempView("channel_alias")
+
+# COMMAND ----------
+
+if ENVIRONMENT == Environment.DEVELOPMENT:
+    display(get_revenue_share_rate_df())
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### Define Metrics
+
+# COMMAND ----------
+
+class Metric(NamedTuple):
+    """
+    A metric column of the campaign and channel details, summed from campaign to channel and published as int or float.
+    fact_promo_expr aggregates it in get_campaign_without_sub_ltv() from source_cols of the fact_promo table, and is None for the metrics added by later stages.
+    skan_expr aggregates it in get_skan_campaign_ltv()
+    """
+    name: str
+    source_cols: List[str]
+    fact_promo_expr: Optional[str]
+    skan_expr: str = "0"
+    is_int: bool = False
+    horizon: Optional[int] = None
+
+
+def get_metrics(horizons: Optional[Tuple[int, ...]] = None) -> List[Metric]:
+    """
+    Return the retention and revenue metrics of the given day horizons, or of all of them, followed by the LTV metrics
+    """
+    metrics = [
+        Metric(
+            f"RETENTION_DAY_{day:0>3d}_QTY",
+            [f"RETENTION_DAY_{day:0>3d}_QTY"],
+            f"sum(RETENTION_DAY_{day:0>3d}_QTY)",
+            is_int=True,
+            horizon=day,
+        )
+        for day in RETENTION_HORIZONS
+    ]
+    for day in REVS_HORIZONS:
+        metrics += [
+            Metric(
+                f"IAP_REVS_DAY_{day:0>3d}_AMT",
+                [f"REVS_DAY_{day:0>3d}_AMT"],
+                f"sum(REVS_DAY_{day:0>3d}_AMT * IAP_RATE)",
+                horizon=day,
+            ),
+            Metric(
+                f"AD_REVS_DAY_{day:0>3d}_AMT",
+                [f"AD_REVS_DAY_{day:0>3d}_AMT"],
+                f"sum(AD_REVS_DAY_{day:0>3d}_AMT * AD_RATE)",
+                horizon=day,
+            ),
+            Metric(
+                f"SUB_REVS_DAY_{day:0>3d}_AMT",
+                [f"subscriptions_revs_day_{day:0>3d}_amt"],
+                f"sum(ifnull(subscriptions_revs_day_{day:0>3d}_amt * SUB_RATE, 0))",
+                horizon=day,
+            ),
+        ]
+    metrics = [metric for metric in metrics if horizons is None or metric.horizon in horizons]
+    return metrics + [
+        Metric(
+            "IAP_LTV",
+            ["LTV_365_LASTEST_VAL"],
+            "sum(LTV_365_LASTEST_VAL * IAP_RATE)",
+            skan_expr="sum(GROSS_IAP_LTV_365_LATEST_VAL * IAP_RATE)",
+        ),
+        Metric("AD_LTV", ["AD_LTV_365_LASTEST_VAL"], "sum(AD_LTV_365_LASTEST_VAL * AD_RATE)"),
+        # joined from get_campaign_sub_ltv()
+        Metric("SUB_LTV", [], None),
+        # IAP_LTV + AD_LTV + SUB_LTV, see get_campaign_details()
+        Metric("TOTAL_LTV", [], None, skan_expr="sum(NET_OVERALL_LTV_365_LATEST_VAL)"),
+    ]
+
+
+def get_metric_sql(exprs: List[str]) -> str:
+    """
+    Join select expressions into the indented column list of a warehouse query
+    """
+    return "".join(f",\n  {expr}" for expr in exprs)
+
+
+# SPEND and INSTALL are not in the registry, since they are the grain of every run and are named INSTALL_NUM before get_complete_campaign_details()
+METRIC_COLS = ["SPEND", "INSTALL", *[metric.name for metric in get_metrics()]]
+INT_METRIC_COLS = ["INSTALL", *[metric.name for metric in get_metrics() if metric.is_int]]
 
 # COMMAND ----------
 
@@ -76,24 +485,22 @@ CAMPAIGN_PARQUET_PATH = str(
 
 # COMMAND ----------
 
-def get_campaign_without_sub_ltv() -> ps.DataFrame:
+def get_campaign_without_sub_ltv(run_config: RunConfig = RUN_CONFIG) -> ps.DataFrame:
     """
     Return a dataframe with campaign-level daily spend, install, rev, retention and ltv
     """
+    create_rate_views(run_config)
+    metrics = [metric for metric in get_metrics(run_config.metric_horizons) if metric.fact_promo_expr]
+    source_cols = list(dict.fromkeys(col for metric in metrics for col in metric.source_cols))
     sql = f"""
 with pr_promo_tb as (
-  select
+  select /*+ BROADCAST(a) */
     APPLICATION_FAMILY_NAME,
     MARKET_CD,
     MVP_CAMPAIGN_TYPE,
     USER_SOURCE_TYPE_CD,
     case 
-      when USER_SOURCE_TYPE_CD in ('MM', 'MK', 'MC') then
-        case
-          when CHANNEL_NAME = 'SKANUAC' then 'ADWORDS'
-          when CHANNEL_NAME = 'SKANFB' then 'SGNFB'
-          else CHANNEL_NAME
-        end
+      when USER_SOURCE_TYPE_CD in ('MM', 'MK', 'MC') then coalesce(a.MAPPED_CHANNEL_NAME, p.CHANNEL_NAME)
       else 'ORGANIC'
     end as CHANNEL_NAME,
     case 
@@ -102,218 +509,26 @@ with pr_promo_tb as (
     end as PROMOTION_NAME,
     CALENDAR_DT,
     EXPENSE_AMT,
-    USER_QTY,
-    RETENTION_DAY_001_QTY,
-    RETENTION_DAY_003_QTY,
-    RETENTION_DAY_007_QTY,
-    REVS_DAY_001_AMT,
-    AD_REVS_DAY_001_AMT,
-    subscriptions_revs_day_001_amt,
-    REVS_DAY_003_AMT,
-    AD_REVS_DAY_003_AMT,
-    subscriptions_revs_day_003_amt,
-    REVS_DAY_007_AMT,
-    AD_REVS_DAY_007_AMT,
-    subscriptions_revs_day_007_amt,
-    REVS_DAY_014_AMT,
-    AD_REVS_DAY_014_AMT,
-    subscriptions_revs_day_014_amt,
-    REVS_DAY_028_AMT,
-    AD_REVS_DAY_028_AMT,
-    subscriptions_revs_day_028_amt,
-    LTV_365_LASTEST_VAL,
-    AD_LTV_365_LASTEST_VAL
-  from pr_analytics_agg.fact_promotion_expense_daily
-  where APPLICATION_FAMILY_NAME in {tuple(GAME_LIST)} and MARKET_CD in {tuple(MARKET_LIST)} and {FACT_PROMO_FILTER_COND} and CALENDAR_DT between '{START_DT}' and '{END_DT}' and MVP_CAMPAIGN_TYPE = 'New Installs'
+    USER_QTY{get_metric_sql(source_cols)}
+  from {FACT_PROMO_TABLE_NAME} p left join channel_alias a
+  on p.CHANNEL_NAME = a.ALIAS_CHANNEL_NAME
+  where APPLICATION_FAMILY_NAME in {to_sql_list(run_config.game_list)} and MARKET_CD in {to_sql_list(run_config.market_list)} and {FACT_PROMO_FILTER_COND} and CALENDAR_DT between '{run_config.compute_start_dt}' and '{run_config.end_dt}' and MVP_CAMPAIGN_TYPE = 'New Installs'
 ),
 without_total_pltv as (
-select     
-  APPLICATION_FAMILY_NAME,
-  MARKET_CD,
+select /*+ BROADCAST(r) */
+  p.APPLICATION_FAMILY_NAME,
+  p.MARKET_CD,
   USER_SOURCE_TYPE_CD,
   CHANNEL_NAME,
   PROMOTION_NAME,
   CALENDAR_DT,
   sum(EXPENSE_AMT) as SPEND,
-  sum(USER_QTY) as INSTALL_NUM,
-  sum(RETENTION_DAY_001_QTY) as RETENTION_DAY_001_QTY,
-  sum(RETENTION_DAY_003_QTY) as RETENTION_DAY_003_QTY,
-  sum(RETENTION_DAY_007_QTY) as RETENTION_DAY_007_QTY,
-  sum(
-      case 
-         when APPLICATION_FAMILY_NAME = 'Harry Potter' then REVS_DAY_001_AMT*0.616
-         when APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then REVS_DAY_001_AMT*0.525
-         when APPLICATION_FAMILY_NAME = 'DC Heroes & Villains' then REVS_DAY_001_AMT*0.546
-         else REVS_DAY_001_AMT*0.7 
-      end
-  ) as IAP_REVS_DAY_001_AMT,
-  sum(
-      case 
-         when APPLICATION_FAMILY_NAME = 'Harry Potter' then AD_REVS_DAY_001_AMT*0.88
-         when APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then AD_REVS_DAY_001_AMT*0.75
-         when APPLICATION_FAMILY_NAME = 'DC Heroes & Villains' then AD_REVS_DAY_001_AMT*0.78
-         else AD_REVS_DAY_001_AMT
-      end
-  ) as AD_REVS_DAY_001_AMT,
-  sum(
-       ifnull(case when MARKET_CD = 'GO' and CALENDAR_DT < '2022-01-01' and APPLICATION_FAMILY_NAME = 'Harry Potter' then subscriptions_revs_day_001_amt*0.616 
-             when MARKET_CD = 'GO' and CALENDAR_DT < '2022-01-01' and APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then subscriptions_revs_day_001_amt*0.525
-             when MARKET_CD = 'GO' and CALENDAR_DT < '2022-01-01' then subscriptions_revs_day_001_amt *0.7
-             when MARKET_CD = 'GO' and CALENDAR_DT >= '2022-01-01' and APPLICATION_FAMILY_NAME = 'Harry Potter' then subscriptions_revs_day_001_amt*0.748
-             when MARKET_CD = 'GO' and CALENDAR_DT >= '2022-01-01' and APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then subscriptions_revs_day_001_amt*0.638
-             when MARKET_CD = 'GO' and CALENDAR_DT >= '2022-01-01' then subscriptions_revs_day_001_amt *0.85
-             when MARKET_CD = 'IT' and CALENDAR_DT < date_add(current_date(),-366) and APPLICATION_FAMILY_NAME = 'Harry Potter' then subscriptions_revs_day_001_amt*0.748 
-             when MARKET_CD = 'IT' and CALENDAR_DT < date_add(current_date(),-366) and APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then subscriptions_revs_day_001_amt*0.638
-             when MARKET_CD = 'IT' and CALENDAR_DT < date_add(current_date(),-366) then subscriptions_revs_day_001_amt*0.85
-             when MARKET_CD = 'IT' and CALENDAR_DT >= date_add(current_date(),-366) and APPLICATION_FAMILY_NAME = 'Harry Potter' then subscriptions_revs_day_001_amt*0.616 
-             when MARKET_CD = 'IT' and CALENDAR_DT >= date_add(current_date(),-366) and APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then subscriptions_revs_day_001_amt*0.525
-             when MARKET_CD = 'IT' and CALENDAR_DT >= date_add(current_date(),-366) then subscriptions_revs_day_001_amt*0.7
-             else 0 end, 0)
-  ) as SUB_REVS_DAY_001_AMT,
-  sum(
-      case 
-         when APPLICATION_FAMILY_NAME = 'Harry Potter' then REVS_DAY_003_AMT*0.616
-         when APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then REVS_DAY_003_AMT*0.525
-         when APPLICATION_FAMILY_NAME = 'DC Heroes & Villains' then REVS_DAY_003_AMT*0.546
-         else REVS_DAY_003_AMT*0.7 
-      end
-  ) as IAP_REVS_DAY_003_AMT,
-  sum(
-      case 
-         when APPLICATION_FAMILY_NAME = 'Harry Potter' then AD_REVS_DAY_003_AMT*0.88
-         when APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then AD_REVS_DAY_003_AMT*0.75
-         when APPLICATION_FAMILY_NAME = 'DC Heroes & Villains' then AD_REVS_DAY_003_AMT*0.78
-         else AD_REVS_DAY_003_AMT
-      end
-  ) as AD_REVS_DAY_003_AMT,
-  sum(
-       ifnull(case when MARKET_CD = 'GO' and CALENDAR_DT < '2022-01-01' and APPLICATION_FAMILY_NAME = 'Harry Potter' then subscriptions_revs_day_003_amt*0.616 
-             when MARKET_CD = 'GO' and CALENDAR_DT < '2022-01-01' and APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then subscriptions_revs_day_003_amt*0.525
-             when MARKET_CD = 'GO' and CALENDAR_DT < '2022-01-01' then subscriptions_revs_day_003_amt *0.7
-             when MARKET_CD = 'GO' and CALENDAR_DT >= '2022-01-01' and APPLICATION_FAMILY_NAME = 'Harry Potter' then subscriptions_revs_day_003_amt*0.748
-             when MARKET_CD = 'GO' and CALENDAR_DT >= '2022-01-01' and APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then subscriptions_revs_day_003_amt*0.638
-             when MARKET_CD = 'GO' and CALENDAR_DT >= '2022-01-01' then subscriptions_revs_day_003_amt *0.85
-             when MARKET_CD = 'IT' and CALENDAR_DT < date_add(current_date(),-366) and APPLICATION_FAMILY_NAME = 'Harry Potter' then subscriptions_revs_day_003_amt*0.748 
-             when MARKET_CD = 'IT' and CALENDAR_DT < date_add(current_date(),-366) and APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then subscriptions_revs_day_003_amt*0.638
-             when MARKET_CD = 'IT' and CALENDAR_DT < date_add(current_date(),-366) then subscriptions_revs_day_003_amt*0.85
-             when MARKET_CD = 'IT' and CALENDAR_DT >= date_add(current_date(),-366) and APPLICATION_FAMILY_NAME = 'Harry Potter' then subscriptions_revs_day_003_amt*0.616 
-             when MARKET_CD = 'IT' and CALENDAR_DT >= date_add(current_date(),-366) and APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then subscriptions_revs_day_003_amt*0.525
-             when MARKET_CD = 'IT' and CALENDAR_DT >= date_add(current_date(),-366) then subscriptions_revs_day_003_amt*0.7
-             else 0 end, 0)
-  ) as SUB_REVS_DAY_003_AMT,
-  sum(
-      case 
-         when APPLICATION_FAMILY_NAME = 'Harry Potter' then REVS_DAY_007_AMT*0.616
-         when APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then REVS_DAY_007_AMT*0.525
-         when APPLICATION_FAMILY_NAME = 'DC Heroes & Villains' then REVS_DAY_007_AMT*0.546
-         else REVS_DAY_007_AMT*0.7 
-      end
-  ) as IAP_REVS_DAY_007_AMT,
-  sum(
-      case 
-         when APPLICATION_FAMILY_NAME = 'Harry Potter' then AD_REVS_DAY_007_AMT*0.88
-         when APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then AD_REVS_DAY_007_AMT*0.75
-         when APPLICATION_FAMILY_NAME = 'DC Heroes & Villains' then AD_REVS_DAY_007_AMT*0.78
-         else AD_REVS_DAY_007_AMT
-      end
-  ) as AD_REVS_DAY_007_AMT,
-  sum(
-       ifnull(case when MARKET_CD = 'GO' and CALENDAR_DT < '2022-01-01' and APPLICATION_FAMILY_NAME = 'Harry Potter' then subscriptions_revs_day_007_amt*0.616 
-             when MARKET_CD = 'GO' and CALENDAR_DT < '2022-01-01' and APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then subscriptions_revs_day_007_amt*0.525
-             when MARKET_CD = 'GO' and CALENDAR_DT < '2022-01-01' then subscriptions_revs_day_007_amt *0.7
-             when MARKET_CD = 'GO' and CALENDAR_DT >= '2022-01-01' and APPLICATION_FAMILY_NAME = 'Harry Potter' then subscriptions_revs_day_007_amt*0.748
-             when MARKET_CD = 'GO' and CALENDAR_DT >= '2022-01-01' and APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then subscriptions_revs_day_007_amt*0.638
-             when MARKET_CD = 'GO' and CALENDAR_DT >= '2022-01-01' then subscriptions_revs_day_007_amt *0.85
-             when MARKET_CD = 'IT' and CALENDAR_DT < date_add(current_date(),-366) and APPLICATION_FAMILY_NAME = 'Harry Potter' then subscriptions_revs_day_007_amt*0.748 
-             when MARKET_CD = 'IT' and CALENDAR_DT < date_add(current_date(),-366) and APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then subscriptions_revs_day_007_amt*0.638
-             when MARKET_CD = 'IT' and CALENDAR_DT < date_add(current_date(),-366) then subscriptions_revs_day_007_amt*0.85
-             when MARKET_CD = 'IT' and CALENDAR_DT >= date_add(current_date(),-366) and APPLICATION_FAMILY_NAME = 'Harry Potter' then subscriptions_revs_day_007_amt*0.616 
-             when MARKET_CD = 'IT' and CALENDAR_DT >= date_add(current_date(),-366) and APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then subscriptions_revs_day_007_amt*0.525
-             when MARKET_CD = 'IT' and CALENDAR_DT >= date_add(current_date(),-366) then subscriptions_revs_day_007_amt*0.7
-             else 0 end, 0)
-  ) as SUB_REVS_DAY_007_AMT,
-  sum(
-      case 
-         when APPLICATION_FAMILY_NAME = 'Harry Potter' then REVS_DAY_014_AMT*0.616
-         when APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then REVS_DAY_014_AMT*0.525
-         when APPLICATION_FAMILY_NAME = 'DC Heroes & Villains' then REVS_DAY_001_AMT*0.546
-         else REVS_DAY_014_AMT*0.7 
-      end
-  ) as IAP_REVS_DAY_014_AMT,
-  sum(
-      case 
-         when APPLICATION_FAMILY_NAME = 'Harry Potter' then AD_REVS_DAY_014_AMT*0.88
-         when APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then AD_REVS_DAY_014_AMT*0.75
-         when APPLICATION_FAMILY_NAME = 'DC Heroes & Villains' then AD_REVS_DAY_014_AMT*0.78
-         else AD_REVS_DAY_014_AMT
-      end
-  ) as AD_REVS_DAY_014_AMT,
-  sum(
-       ifnull(case when MARKET_CD = 'GO' and CALENDAR_DT < '2022-01-01' and APPLICATION_FAMILY_NAME = 'Harry Potter' then subscriptions_revs_day_014_amt*0.616 
-             when MARKET_CD = 'GO' and CALENDAR_DT < '2022-01-01' and APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then subscriptions_revs_day_014_amt*0.525
-             when MARKET_CD = 'GO' and CALENDAR_DT < '2022-01-01' then subscriptions_revs_day_014_amt *0.7
-             when MARKET_CD = 'GO' and CALENDAR_DT >= '2022-01-01' and APPLICATION_FAMILY_NAME = 'Harry Potter' then subscriptions_revs_day_014_amt*0.748
-             when MARKET_CD = 'GO' and CALENDAR_DT >= '2022-01-01' and APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then subscriptions_revs_day_014_amt*0.638
-             when MARKET_CD = 'GO' and CALENDAR_DT >= '2022-01-01' then subscriptions_revs_day_014_amt *0.85
-             when MARKET_CD = 'IT' and CALENDAR_DT < date_add(current_date(),-366) and APPLICATION_FAMILY_NAME = 'Harry Potter' then subscriptions_revs_day_014_amt*0.748 
-             when MARKET_CD = 'IT' and CALENDAR_DT < date_add(current_date(),-366) and APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then subscriptions_revs_day_014_amt*0.638
-             when MARKET_CD = 'IT' and CALENDAR_DT < date_add(current_date(),-366) then subscriptions_revs_day_014_amt*0.85
-             when MARKET_CD = 'IT' and CALENDAR_DT >= date_add(current_date(),-366) and APPLICATION_FAMILY_NAME = 'Harry Potter' then subscriptions_revs_day_014_amt*0.616 
-             when MARKET_CD = 'IT' and CALENDAR_DT >= date_add(current_date(),-366) and APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then subscriptions_revs_day_014_amt*0.525
-             when MARKET_CD = 'IT' and CALENDAR_DT >= date_add(current_date(),-366) then subscriptions_revs_day_014_amt*0.7
-             else 0 end, 0)
-  ) as SUB_REVS_DAY_014_AMT,
-  sum(
-      case 
-         when APPLICATION_FAMILY_NAME = 'Harry Potter' then REVS_DAY_028_AMT*0.616
-         when APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then REVS_DAY_028_AMT*0.525
-         when APPLICATION_FAMILY_NAME = 'DC Heroes & Villains' then REVS_DAY_001_AMT*0.546
-         else REVS_DAY_028_AMT*0.7 
-      end
-  ) as IAP_REVS_DAY_028_AMT,
-  sum(
-      case 
-         when APPLICATION_FAMILY_NAME = 'Harry Potter' then AD_REVS_DAY_028_AMT*0.88
-         when APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then AD_REVS_DAY_028_AMT*0.75
-         when APPLICATION_FAMILY_NAME = 'DC Heroes & Villains' then AD_REVS_DAY_028_AMT*0.78
-         else AD_REVS_DAY_028_AMT
-      end
-  ) as AD_REVS_DAY_028_AMT,
-  sum(
-       ifnull(case when MARKET_CD = 'GO' and CALENDAR_DT < '2022-01-01' and APPLICATION_FAMILY_NAME = 'Harry Potter' then subscriptions_revs_day_028_amt*0.616 
-             when MARKET_CD = 'GO' and CALENDAR_DT < '2022-01-01' and APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then subscriptions_revs_day_028_amt*0.525
-             when MARKET_CD = 'GO' and CALENDAR_DT < '2022-01-01' then subscriptions_revs_day_028_amt *0.7
-             when MARKET_CD = 'GO' and CALENDAR_DT >= '2022-01-01' and APPLICATION_FAMILY_NAME = 'Harry Potter' then subscriptions_revs_day_028_amt*0.748
-             when MARKET_CD = 'GO' and CALENDAR_DT >= '2022-01-01' and APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then subscriptions_revs_day_028_amt*0.638
-             when MARKET_CD = 'GO' and CALENDAR_DT >= '2022-01-01' then subscriptions_revs_day_028_amt *0.85
-             when MARKET_CD = 'IT' and CALENDAR_DT < date_add(current_date(),-366) and APPLICATION_FAMILY_NAME = 'Harry Potter' then subscriptions_revs_day_028_amt*0.748 
-             when MARKET_CD = 'IT' and CALENDAR_DT < date_add(current_date(),-366) and APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then subscriptions_revs_day_028_amt*0.638
-             when MARKET_CD = 'IT' and CALENDAR_DT < date_add(current_date(),-366) then subscriptions_revs_day_028_amt*0.85
-             when MARKET_CD = 'IT' and CALENDAR_DT >= date_add(current_date(),-366) and APPLICATION_FAMILY_NAME = 'Harry Potter' then subscriptions_revs_day_028_amt*0.616 
-             when MARKET_CD = 'IT' and CALENDAR_DT >= date_add(current_date(),-366) and APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then subscriptions_revs_day_028_amt*0.525
-             when MARKET_CD = 'IT' and CALENDAR_DT >= date_add(current_date(),-366) then subscriptions_revs_day_028_amt*0.7
-             else 0 end, 0)
-  ) as SUB_REVS_DAY_028_AMT,
-  sum(
-      case 
-         when APPLICATION_FAMILY_NAME = 'Harry Potter' then LTV_365_LASTEST_VAL*0.616
-         when APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then LTV_365_LASTEST_VAL*0.525
-         when APPLICATION_FAMILY_NAME = 'DC Heroes & Villains' then LTV_365_LASTEST_VAL*0.546
-         else LTV_365_LASTEST_VAL*0.7 
-      end
-  ) as IAP_LTV,
-  sum(
-      case 
-        when APPLICATION_FAMILY_NAME = 'Harry Potter' then AD_LTV_365_LASTEST_VAL*0.88
-        when APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then AD_LTV_365_LASTEST_VAL*0.75
-        when APPLICATION_FAMILY_NAME = 'DC Heroes & Villains' then AD_LTV_365_LASTEST_VAL*0.78
-        else AD_LTV_365_LASTEST_VAL 
-      end
-  ) as AD_LTV
-from pr_promo_tb
+  sum(USER_QTY) as INSTALL_NUM{get_metric_sql([f"{metric.fact_promo_expr} as {metric.name}" for metric in metrics])}
+from pr_promo_tb p left join revenue_share_rate r
+on p.APPLICATION_FAMILY_NAME = r.APPLICATION_FAMILY_NAME and p.MARKET_CD = r.MARKET_CD and p.CALENDAR_DT between r.START_DT and r.END_DT
 group by 1, 2, 3, 4, 5, 6
 having sum(EXPENSE_AMT) > 0 or sum(USER_QTY) > 0
-order by 1, 2, 3, 4, 5, 6
+{get_order_by_clause(6)}
 )
 select *
 from without_total_pltv
@@ -334,30 +549,39 @@ if ENVIRONMENT == Environment.DEVELOPMENT:
 
 # COMMAND ----------
 
-def get_campaign_sub_ltv() -> ps.DataFrame:
+def get_campaign_sub_ltv(run_config: RunConfig = RUN_CONFIG) -> ps.DataFrame:
     """
-    Return a dataframe with campaign-level daily sub pltv
+    Return a dataframe with campaign-level daily sub pltv.
+    Installs are filtered to the requested games, markets and dates first, so that only the individual ltv of those users is ranked for the latest projection.
+    A user with several projections on their latest PROJECTION_DT keeps all of them, each counted as an install, as the max-date self-join did before
     """
+    create_rate_views(run_config)
     sql = f"""
-with indi_max_project_dt as (
+with cohort_install as (
   select
-    ACCOUNT_ID, 
-    USER_ID, 
-    APPLICATION_CD, 
-    max(projection_dt) as MAX_PROJECTION_DT
-  from ua.internal_individual_ltv
-  group by 1, 2, 3
+    APPLICATION_CD,
+    ACCOUNT_ID,
+    USER_ID,
+    APPLICATION_FAMILY_NAME,
+    MARKET_CD,
+    USER_SOURCE_TYPE_CD,
+    CHANNEL_NAME,
+    PROMOTION_NAME,
+    INSTALL_DT as CALENDAR_DT
+  from {INSTALL_TABLE_NAME}
+  where APPLICATION_FAMILY_NAME in {to_sql_list(run_config.game_list)} and MARKET_CD in {to_sql_list(run_config.market_list)} and INSTALL_DT between '{run_config.compute_start_dt}' and '{run_config.end_dt}'
 ),
-latest_sub_ltv as (
-  select 
-    a.ACCOUNT_ID, 
-    a.USER_ID, 
-    a.APPLICATION_CD, 
-    IAP_PROJECTEDREVENUE_365 as IAP_LTV,
-    AD_PROJECTEDREVENUE_365 as AD_LTV,
-    SUB_PROJECTEDREVENUE_365 as SUB_LTV
-  from ua.internal_individual_ltv a inner join indi_max_project_dt b
-  on a.ACCOUNT_ID = b.ACCOUNT_ID and a.USER_ID = b.USER_ID and a.APPLICATION_CD = b.APPLICATION_CD and a.PROJECTION_DT = b.MAX_PROJECTION_DT
+cohort_indi_ltv as (
+  -- rank rather than row_number: tied latest projections are all kept, like the max-date self-join this replaced
+  select
+    a.ACCOUNT_ID,
+    a.USER_ID,
+    a.APPLICATION_CD,
+    a.SUB_PROJECTEDREVENUE_365 as SUB_LTV,
+    rank() over (partition by a.ACCOUNT_ID, a.USER_ID, a.APPLICATION_CD order by a.PROJECTION_DT desc) as PROJECTION_RANK
+  from {INDIVIDUAL_LTV_TABLE_NAME} a left semi join cohort_install b
+  on a.APPLICATION_CD = b.APPLICATION_CD and a.ACCOUNT_ID = b.ACCOUNT_ID and a.USER_ID = b.USER_ID
+  where a.PROJECTION_DT is not null
 ),
 indi_sub_ltv as (
   select
@@ -366,16 +590,14 @@ indi_sub_ltv as (
     a.USER_SOURCE_TYPE_CD,
     a.CHANNEL_NAME,
     a.PROMOTION_NAME,
-    a.INSTALL_DT as CALENDAR_DT,
-    b.IAP_LTV,
-    b.AD_LTV,
+    a.CALENDAR_DT,
     b.SUB_LTV
-  from pr_analytics_delta.install a inner join latest_sub_ltv b
-  on a.APPLICATION_CD = b.APPLICATION_CD and a.ACCOUNT_ID = b.ACCOUNT_ID and a.USER_ID = b.USER_ID
+  from cohort_install a inner join cohort_indi_ltv b
+  on a.APPLICATION_CD = b.APPLICATION_CD and a.ACCOUNT_ID = b.ACCOUNT_ID and a.USER_ID = b.USER_ID and b.PROJECTION_RANK = 1
 )
-select 
-  APPLICATION_FAMILY_NAME,
-  MARKET_CD,
+select /*+ BROADCAST(r) */
+  a.APPLICATION_FAMILY_NAME,
+  a.MARKET_CD,
   USER_SOURCE_TYPE_CD,
   case
     when USER_SOURCE_TYPE_CD in ('MM', 'MK', 'MC') then CHANNEL_NAME 
@@ -387,22 +609,11 @@ select
   end as PROMOTION_NAME,
   CALENDAR_DT,
   count(1) as INDIVIDUAL_INSTALLS,
-  sum(
-       ifnull(case when MARKET_CD = 'GO' and CALENDAR_DT < '2022-01-01' and APPLICATION_FAMILY_NAME = 'Harry Potter' then SUB_LTV*0.616 
-             when MARKET_CD = 'GO' and CALENDAR_DT < '2022-01-01' and APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then SUB_LTV*0.525
-             when MARKET_CD = 'GO' and CALENDAR_DT < '2022-01-01' then SUB_LTV *0.7
-             when MARKET_CD = 'GO' and CALENDAR_DT >= '2022-01-01' and APPLICATION_FAMILY_NAME = 'Harry Potter' then SUB_LTV*0.748
-             when MARKET_CD = 'GO' and CALENDAR_DT >= '2022-01-01' and APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then SUB_LTV*0.638
-             when MARKET_CD = 'GO' and CALENDAR_DT >= '2022-01-01' then SUB_LTV *0.85
-             when MARKET_CD = 'IT' and APPLICATION_FAMILY_NAME = 'Harry Potter' then SUB_LTV*0.616 
-             when MARKET_CD = 'IT' and APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then SUB_LTV*0.525
-             when MARKET_CD = 'IT' then SUB_LTV*0.7
-             else 0 end, 0)
-  ) as SUB_LTV
-from indi_sub_ltv
-where APPLICATION_FAMILY_NAME in {tuple(GAME_LIST)} and MARKET_CD in {tuple(MARKET_LIST)} and CALENDAR_DT between '{START_DT}' and '{END_DT}'
+  sum(ifnull(SUB_LTV * SUB_LTV_RATE, 0)) as SUB_LTV
+from indi_sub_ltv a left join revenue_share_rate r
+on a.APPLICATION_FAMILY_NAME = r.APPLICATION_FAMILY_NAME and a.MARKET_CD = r.MARKET_CD and a.CALENDAR_DT between r.START_DT and r.END_DT
 group by 1, 2, 3, 4, 5, 6
-order by 1, 2, 3, 4, 5, 6
+{get_order_by_clause(6)}
   """
     df = spark.sql(sql)
     return df
@@ -415,6 +626,77 @@ if ENVIRONMENT == Environment.DEVELOPMENT:
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC ### Skew-Tolerant Joins
+
+# COMMAND ----------
+
+# heavy keys found while a stage runs are collected here by run_instrumented_stage(), per driver thread
+STAGE_CONTEXT = threading.local()
+
+
+def get_heavy_keys(df: ps.DataFrame, key_cols: List[str]) -> pd.DataFrame:
+    """
+    Return the keys of df with more than SKEW_MIN_KEY_ROWS rows and SKEW_KEY_FACTOR times the average rows per key, heaviest first, with their ROW_NUM.
+    The row counts are estimated from a SKEW_SAMPLE_FRACTION sample of df, in a single job
+    """
+    key_count_df = (
+        df.sample(fraction=SKEW_SAMPLE_FRACTION, seed=0)
+        .groupby(*key_cols)
+        .agg(F.round(F.count(F.lit(1)) / SKEW_SAMPLE_FRACTION).cast("long").alias("ROW_NUM"))
+    )
+    threshold = F.greatest(F.lit(SKEW_MIN_KEY_ROWS), SKEW_KEY_FACTOR * F.avg("ROW_NUM").over(Window.partitionBy()))
+    return (
+        key_count_df.withColumn("THRESHOLD", threshold)
+        .where(F.col("ROW_NUM") > F.col("THRESHOLD"))
+        .drop("THRESHOLD")
+        .orderBy(F.desc("ROW_NUM"))
+        .limit(SKEW_MAX_HOT_KEYS)
+        .toPandas()
+    )
+
+
+def report_heavy_keys(join_name: str, side: str, heavy_key_df: pd.DataFrame) -> None:
+    if len(heavy_key_df) == 0:
+        return
+    print(f"{join_name}: {len(heavy_key_df)} heavy keys on the {side} side")
+    print(heavy_key_df.head(10).to_string())
+    heavy_keys = getattr(STAGE_CONTEXT, "heavy_keys", None)
+    if heavy_keys is not None:
+        heavy_keys.extend(
+            {"JOIN": join_name, "SIDE": side, **row}
+            for row in heavy_key_df.astype(str).to_dict("records")
+        )
+
+
+def skew_tolerant_join(
+    left_df: ps.DataFrame, right_df: ps.DataFrame, on: List[str], how: str, join_name: str
+) -> ps.DataFrame:
+    """
+    Same result as left_df.join(right_df, on, how) for the left, inner and leftanti joins of the pipeline.
+    Heavy keys of both sides are reported. The rows of the heavy left keys are joined apart from the rest, against their matching right rows broadcast,
+    so that no single shuffle task receives a heavy key. Heavy right keys are only reported, since their rows are what a left join outputs
+    """
+    if not SKEW_JOIN_FLAG:
+        return left_df.join(right_df, on=on, how=how)
+    left_heavy_key_df = get_heavy_keys(left_df, on)
+    report_heavy_keys(join_name, "left", left_heavy_key_df)
+    report_heavy_keys(join_name, "right", get_heavy_keys(right_df, on))
+    if len(left_heavy_key_df) == 0:
+        return left_df.join(right_df, on=on, how=how)
+
+    # keys with a null never match, so their rows stay in the shuffled part
+    hot_key_df = F.broadcast(
+        spark.createDataFrame(left_heavy_key_df[on], left_df.select(*on).schema)
+    )
+    hot_df = left_df.join(hot_key_df, on=on, how="leftsemi").join(
+        F.broadcast(right_df.join(hot_key_df, on=on, how="leftsemi")), on=on, how=how
+    )
+    cold_df = left_df.join(hot_key_df, on=on, how="leftanti").join(right_df, on=on, how=how)
+    return hot_df.unionByName(cold_df)
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC ### Merge campaign_sub_ltv and campaign_without_sub to get campaign_details
 
@@ -426,7 +708,8 @@ def get_campaign_details(
     """
     Merge campaign_without_sub_pltv_df and campaign_sub_pltv_df to get campaign details.
     """
-    df = campaign_without_sub_pltv_df.join(
+    df = skew_tolerant_join(
+        campaign_without_sub_pltv_df,
         campaign_sub_pltv_df,
         on=[
             "APPLICATION_FAMILY_NAME",
@@ -437,6 +720,7 @@ def get_campaign_details(
             "CALENDAR_DT",
         ],
         how="left",
+        join_name="campaign_sub_ltv",
     )
     df = df.na.fill(0, subset=["INDIVIDUAL_INSTALLS", "SUB_LTV"])
     # ludia_df = df.where(F.col('APPLICATION_FAMILY_NAME').isin(LUDIA_TITLES))
@@ -463,52 +747,35 @@ if ENVIRONMENT == Environment.DEVELOPMENT:
 
 # COMMAND ----------
 
-def get_skan_campaign_ltv() -> ps.DataFrame:
+def get_skan_campaign_ltv(
+    run_config: RunConfig = RUN_CONFIG, source_table: str = SKAN_LTV_TABLE_NAME
+) -> ps.DataFrame:
     """
-    Get SKAN campaign level pLTV
+    Get SKAN campaign level pLTV from source_table, which is a streaming view of ua.skan_ltv in skan streaming mode.
+    With SKAN_STREAM_FLAG, the frame kept up to date by the streaming mode is read instead
     """
+    metric_cols = [metric.name for metric in get_metrics(run_config.metric_horizons)]
+    if SKAN_STREAM_FLAG and source_table == SKAN_LTV_TABLE_NAME:
+        return spark.table(SKAN_STREAM_TABLE_NAME).where(
+            F.col("APPLICATION_FAMILY_NAME").isin(run_config.game_list)
+            & F.col("CALENDAR_DT").between(run_config.compute_start_dt, run_config.skan_end_dt)
+        ).select(*SKAN_CAMPAIGN_KEY_COLS, "INSTALL_NUM", *metric_cols)
+    # SKAN rows are all IT, whatever the markets of the run
+    create_rate_views(run_config._replace(market_list=("IT",)))
     sql = f"""
-  select
-    APPLICATION_FAMILY_NAME,
+  select /*+ BROADCAST(r) */
+    s.APPLICATION_FAMILY_NAME,
     'IT' as MARKET_CD,
     'SKAN' as SOURCE,
     CHANNEL_NAME,
     PROMOTION_CD as PROMOTION_NAME,
     INSTALL_DT as CALENDAR_DT,
-    sum(INSTALL_NUM) as INSTALL_NUM,
-    0 as RETENTION_DAY_001_QTY,
-    0 as RETENTION_DAY_003_QTY,
-    0 as RETENTION_DAY_007_QTY,
-    0 as IAP_REVS_DAY_001_AMT,
-    0 as AD_REVS_DAY_001_AMT,
-    0 as SUB_REVS_DAY_001_AMT,
-    0 as IAP_REVS_DAY_003_AMT,
-    0 as AD_REVS_DAY_003_AMT,
-    0 as SUB_REVS_DAY_003_AMT,
-    0 as IAP_REVS_DAY_007_AMT,
-    0 as AD_REVS_DAY_007_AMT,
-    0 as SUB_REVS_DAY_007_AMT,
-    0 as IAP_REVS_DAY_014_AMT,
-    0 as AD_REVS_DAY_014_AMT,
-    0 as SUB_REVS_DAY_014_AMT,
-    0 as IAP_REVS_DAY_028_AMT,
-    0 as AD_REVS_DAY_028_AMT,
-    0 as SUB_REVS_DAY_028_AMT,
-    sum(
-      case 
-         when APPLICATION_FAMILY_NAME = 'Harry Potter' then GROSS_IAP_LTV_365_LATEST_VAL*0.616
-         when APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then GROSS_IAP_LTV_365_LATEST_VAL*0.525
-         when APPLICATION_FAMILY_NAME = 'DC Heroes & Villains' then GROSS_IAP_LTV_365_LATEST_VAL*0.546
-         else GROSS_IAP_LTV_365_LATEST_VAL*0.7 
-      end
-    ) as IAP_LTV,
-    0 as AD_LTV,
-    0 as SUB_LTV,
-    sum(NET_OVERALL_LTV_365_LATEST_VAL) as TOTAL_LTV
-  from ua.skan_ltv
-  where APPLICATION_FAMILY_NAME in {tuple(GAME_LIST)} and {SKAN_FILTER_COND} and INSTALL_DT >= '{START_DT}' and INSTALL_DT < current_date()
+    sum(INSTALL_NUM) as INSTALL_NUM{get_metric_sql([f"{metric.skan_expr} as {metric.name}" for metric in get_metrics(run_config.metric_horizons)])}
+  from {source_table} s left join revenue_share_rate r
+  on s.APPLICATION_FAMILY_NAME = r.APPLICATION_FAMILY_NAME and r.MARKET_CD = 'IT' and s.INSTALL_DT between r.START_DT and r.END_DT
+  where s.APPLICATION_FAMILY_NAME in {to_sql_list(run_config.game_list)} and {SKAN_FILTER_COND} and INSTALL_DT between '{run_config.compute_start_dt}' and '{run_config.skan_end_dt}'
   group by 1, 2, 3, 4, 5, 6
-  order by 1, 2, 3, 4, 5, 6
+  {get_order_by_clause(6) if not spark.table(source_table).isStreaming else ""}
   """
     df = spark.sql(sql)
     return df
@@ -557,44 +824,50 @@ def adjust_ios_organic(
             "CALENDAR_DT",
         }
     )
-    mmp_ios_total_df = (
+    # tag the three inputs and aggregate them together, so that the adjustment costs one shuffle and no joins
+    tag_col = "ORGANIC_ADJUSTMENT_TAG"
+    tagged_df = (
         mmp_ios_campaign_df.where(F.col("USER_SOURCE_TYPE_CD").isin(["MK", "US"]))
-        .groupby(group_cols)
-        .agg(*[F.sum(agg_col).alias("MMP_TOTAL_" + agg_col) for agg_col in agg_cols])
-    )
-    mmp_ios_paid_df = (
-        other_campaign_details_df.where(
-            (F.col("MARKET_CD") == "IT") & (F.col("USER_SOURCE_TYPE_CD") == "MK")
-        )
-        .groupby(group_cols)
-        .agg(*[F.sum(agg_col).alias("MMP_PAID_" + agg_col) for agg_col in agg_cols])
-    )
-    skan_total_df = skan_campaign_details_df.groupby(group_cols).agg(
-        *[F.sum(agg_col).alias("SKAN_PAID_" + agg_col) for agg_col in agg_cols]
-    )
-
-    # adjust mmp_ios_organic = mmp_ios_total - mmp_ios_paid_total - skan_ios_paid_total
-    mmp_ios_organic_df = mmp_ios_total_df.join(
-        mmp_ios_paid_df, on=group_cols, how="left"
-    ).join(skan_total_df, on=group_cols, how="left")
-    for agg_col in agg_cols:
-        mmp_ios_organic_df = mmp_ios_organic_df.withColumn(
-            agg_col,
-            F.expr(
-                f"MMP_TOTAL_{agg_col} - coalesce(MMP_PAID_{agg_col}, 0) - coalesce(SKAN_PAID_{agg_col}, 0)"
-            ),
+        .select(*group_cols, *agg_cols, F.lit("MMP_TOTAL").alias(tag_col))
+        .unionByName(
+            other_campaign_details_df.where(
+                (F.col("MARKET_CD") == "IT") & (F.col("USER_SOURCE_TYPE_CD") == "MK")
+            ).select(*group_cols, *agg_cols, F.lit("MMP_PAID").alias(tag_col))
         )
-        mmp_ios_organic_df = mmp_ios_organic_df.drop(
-            *[prefix + agg_col for prefix in ["MMP_TOTAL_", "MMP_PAID_", "SKAN_PAID_"]]
+        .unionByName(
+            skan_campaign_details_df.select(
+                *group_cols, *agg_cols, F.lit("SKAN_PAID").alias(tag_col)
+            )
         )
+    )
 
-    mmp_ios_organic_df = mmp_ios_organic_df.withColumn(
-        "USER_SOURCE_TYPE_CD", F.lit("US")
+    def tagged_sum(tag: str, agg_col: str) -> ps.Column:
+        return F.sum(F.when(F.col(tag_col) == tag, F.col(agg_col)))
+
+    # adjust mmp_ios_organic = mmp_ios_total - mmp_ios_paid_total - skan_ios_paid_total, only where mmp_ios_total exists
+    mmp_ios_organic_df = (
+        tagged_df.groupby(group_cols)
+        .agg(
+            F.max(F.col(tag_col) == "MMP_TOTAL").alias("HAS_MMP_TOTAL"),
+            *[
+                (
+                    tagged_sum("MMP_TOTAL", agg_col)
+                    - F.coalesce(tagged_sum("MMP_PAID", agg_col), F.lit(0))
+                    - F.coalesce(tagged_sum("SKAN_PAID", agg_col), F.lit(0))
+                ).alias(agg_col)
+                for agg_col in agg_cols
+            ],
+        )
+        .where(F.col("HAS_MMP_TOTAL"))
+        .drop("HAS_MMP_TOTAL")
     )
-    mmp_ios_organic_df = mmp_ios_organic_df.withColumn("SOURCE", F.lit("Non-SKAN"))
-    mmp_ios_organic_df = mmp_ios_organic_df.withColumn("CHANNEL_NAME", F.lit("ORGANIC"))
-    mmp_ios_organic_df = mmp_ios_organic_df.withColumn(
-        "PROMOTION_NAME", F.lit("ORGANIC")
+
+    mmp_ios_organic_df = mmp_ios_organic_df.select(
+        "*",
+        F.lit("US").alias("USER_SOURCE_TYPE_CD"),
+        F.lit("Non-SKAN").alias("SOURCE"),
+        F.lit("ORGANIC").alias("CHANNEL_NAME"),
+        F.lit("ORGANIC").alias("PROMOTION_NAME"),
     )
 
     # concatenate mmp_ios_organic, mmp_non_organic and skan into ios_df
@@ -608,12 +881,15 @@ def adjust_ios_organic(
     go_campaign_details_df = go_campaign_details_df.withColumn("SOURCE", F.lit("Non-SKAN"))
     campaign_details_df = ios_campaign_details_df.unionByName(go_campaign_details_df)
     
-    # deal with negative aggregated values
-    for agg_col in agg_cols:
-        tmp_col = "tmp_"+agg_col
-        campaign_details_df = campaign_details_df.withColumnRenamed(agg_col, tmp_col)
-        campaign_details_df = campaign_details_df.withColumn(agg_col, F.when(F.col(tmp_col) >= 0, F.col(tmp_col)).otherwise(0))
-        campaign_details_df = campaign_details_df.drop(tmp_col)
+    # deal with negative aggregated values in a single projection
+    campaign_details_df = campaign_details_df.select(
+        *[
+            F.when(F.col(col) >= 0, F.col(col)).otherwise(0).alias(col)
+            if col in agg_cols
+            else F.col(col)
+            for col in campaign_details_df.columns
+        ]
+    )
 
     return campaign_details_df
 
@@ -634,7 +910,8 @@ def get_complete_campaign_details(
         "CALENDAR_DT",
         "SPEND",
     )
-    skan_campaign_details_df = skan_campaign_ltv_df.join(
+    skan_campaign_details_df = skew_tolerant_join(
+        skan_campaign_ltv_df,
         campaign_spend_df,
         on=[
             "APPLICATION_FAMILY_NAME",
@@ -644,14 +921,16 @@ def get_complete_campaign_details(
             "CALENDAR_DT",
         ],
         how="left",
+        join_name="skan_campaign_spend",
     )
     skan_campaign_details_df = skan_campaign_details_df.na.fill(
         {"USER_SOURCE_TYPE_CD": "MK", "SPEND": 0}
     )
 
-    # get non-skan campaign details
-    other_campaign_details_df = campaign_details_df.join(
-        skan_campaign_details_df,
+    # get non-skan campaign details. The left join keeps the keys of skan_campaign_ltv_df, which is anti-joined directly to keep the plan shallow
+    other_campaign_details_df = skew_tolerant_join(
+        campaign_details_df,
+        skan_campaign_ltv_df,
         on=[
             "APPLICATION_FAMILY_NAME",
             "MARKET_CD",
@@ -660,6 +939,7 @@ def get_complete_campaign_details(
             "CALENDAR_DT",
         ],
         how="leftanti",
+        join_name="non_skan_campaign",
     )
     other_campaign_details_df = other_campaign_details_df.withColumn(
         "SOURCE", F.lit("Non-SKAN")
@@ -685,6 +965,133 @@ if ENVIRONMENT == Environment.DEVELOPMENT:
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC ### Rollups
+
+# COMMAND ----------
+
+class Rollup(NamedTuple):
+    """
+    A grain of get_rollups(), published to table_name. period_col is CALENDAR_DT truncated to the grain's period, and is published as CALENDAR_DT
+    """
+    name: str
+    group_cols: Tuple[str, ...]
+    period_col: str
+    table_name: str
+
+
+CHANNEL_DAY_ROLLUP = Rollup("CHANNEL_DAY", tuple(CHANNEL_KEY_COLS), "CALENDAR_DT", CHANNEL_TABLE_NAME)
+GAME_DAY_ROLLUP = Rollup("GAME_DAY", tuple(QA_SUMMARY_KEY_COLS), "CALENDAR_DT", GAME_TABLE_NAME)
+CHANNEL_WEEK_ROLLUP = Rollup("CHANNEL_WEEK", tuple(CHANNEL_KEY_COLS), "WEEK_START_DT", CHANNEL_WEEKLY_TABLE_NAME)
+CHANNEL_MONTH_ROLLUP = Rollup(
+    "CHANNEL_MONTH", tuple(CHANNEL_KEY_COLS), "MONTH_START_DT", CHANNEL_MONTHLY_TABLE_NAME
+)
+DAY_ROLLUPS = [CHANNEL_DAY_ROLLUP, GAME_DAY_ROLLUP]
+PERIOD_ROLLUPS = [CHANNEL_WEEK_ROLLUP, CHANNEL_MONTH_ROLLUP]
+
+
+def get_rollup_cols(rollup: Rollup) -> List[str]:
+    return [rollup.period_col if col == "CALENDAR_DT" else col for col in rollup.group_cols]
+
+
+def get_rollup_start_dt(run_config: RunConfig) -> str:
+    """
+    Return the first day of the week or month of compute_start_dt, whichever is earlier, where the period rollups of run_config start
+    """
+    compute_start_dt = datetime.strptime(run_config.compute_start_dt, DATE_FORMAT)
+    rollup_start_dt = min(
+        compute_start_dt - timedelta(days=compute_start_dt.weekday()), compute_start_dt.replace(day=1)
+    )
+    return datetime.strftime(rollup_start_dt, DATE_FORMAT)
+
+
+def get_published_campaign_df(game_list: List[str], start_dt: str, end_dt: str) -> ps.DataFrame:
+    sql = f"select * from {CAMPAIGN_TABLE_NAME} where APPLICATION_FAMILY_NAME in {to_sql_list(game_list)} and CALENDAR_DT between '{start_dt}' and '{end_dt}'"
+    return spark.sql(sql)
+
+
+def get_rollups(
+    campaign_details_df: ps.DataFrame, rollups: List[Rollup], run_config: RunConfig = RUN_CONFIG
+) -> ps.DataFrame:
+    """
+    Sum the metrics of campaign_details_df up to every grain of rollups in a single grouping-sets aggregation, so in one shuffle.
+    The ROLLUP column names the grain of each row, see get_rollup_df().
+    In an incremental run, the weeks and months cut by the start of the window are completed with the published campaign rows before it
+    """
+    is_partial_window = run_config.compute_start_dt != START_DT
+    has_head = (
+        is_partial_window
+        and any(rollup in PERIOD_ROLLUPS for rollup in rollups)
+        and spark.catalog.tableExists(CAMPAIGN_TABLE_NAME)
+    )
+    if has_head:
+        head_end_dt = datetime.strptime(run_config.compute_start_dt, DATE_FORMAT) - timedelta(days=1)
+        head_df = get_published_campaign_df(
+            run_config.game_list, get_rollup_start_dt(run_config), datetime.strftime(head_end_dt, DATE_FORMAT)
+        )
+        campaign_details_df = campaign_details_df.unionByName(
+            head_df.select(*campaign_details_df.columns)
+        )
+
+    group_cols = list(dict.fromkeys(col for rollup in rollups for col in get_rollup_cols(rollup)))
+    metric_cols = [col for col in METRIC_COLS if col in campaign_details_df.columns]
+    # the periods are grouped by expression rather than projected first, which keeps the plan a level shallower
+    period_exprs = {
+        "WEEK_START_DT": "cast(date_trunc('week', CALENDAR_DT) as date)",
+        "MONTH_START_DT": "trunc(CALENDAR_DT, 'month')",
+    }
+
+    def get_group_exprs(cols: List[str]) -> List[str]:
+        return [period_exprs.get(col, col) for col in cols]
+
+    def get_grouping_id(rollup: Rollup) -> int:
+        rollup_cols = get_rollup_cols(rollup)
+        return sum(
+            1 << (len(group_cols) - 1 - i) for i, col in enumerate(group_cols) if col not in rollup_cols
+        )
+
+    grouping_id = f"grouping_id({', '.join(get_group_exprs(group_cols))})"
+    rollup_case = " ".join(
+        f"when {grouping_id} = {get_grouping_id(rollup)} then '{rollup.name}'" for rollup in rollups
+    )
+    grouping_sets = ", ".join(f"({', '.join(get_group_exprs(get_rollup_cols(rollup)))})" for rollup in rollups)
+    # the day grains only cover the recomputed window
+    having_clause = (
+        f"having grouping(CALENDAR_DT) = 1 or CALENDAR_DT >= '{run_config.compute_start_dt}'"
+        if has_head and "CALENDAR_DT" in group_cols
+        else ""
+    )
+    # the view is resolved when the query is analyzed, so it can be dropped right after
+    view_name = f"rollup_input_{uuid.uuid4().hex}"
+    campaign_details_df.createOrReplaceTempView(view_name)
+    sql = f"""
+select
+  case {rollup_case} end as ROLLUP,
+  {", ".join(f"{expr} as {col}" if expr != col else col for expr, col in zip(get_group_exprs(group_cols), group_cols))}{get_metric_sql([f"sum({col}) as {col}" for col in metric_cols])}
+from {view_name}
+group by grouping sets ({grouping_sets})
+{having_clause}
+  """
+    df = spark.sql(sql)
+    spark.catalog.dropTempView(view_name)
+    return df
+
+
+def get_rollup_df(rollup_df: ps.DataFrame, rollup: Rollup) -> ps.DataFrame:
+    """
+    Return the rows of the grain rollup from the output of get_rollups(), with its group columns and metrics
+    """
+    metric_cols = [col for col in METRIC_COLS if col in rollup_df.columns]
+    return rollup_df.where(F.col("ROLLUP") == rollup.name).select(
+        *[
+            F.col(rollup.period_col).alias(col) if col == "CALENDAR_DT" else F.col(col)
+            for col in rollup.group_cols
+        ],
+        *metric_cols,
+    )
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC ### Aggregate campaign_details_df on Channel
 
@@ -695,40 +1102,11 @@ def aggregate_campaign_to_channel_details(
 ) -> ps.DataFrame:
     """
     Take a campaign-level detail df and aggregate into channel-level details
-    The input df includes 'APPLICATION_FAMILY_NAME', 'MARKET_CD', 'SOURCE', 'USER_SOURCE_TYPE_CD', 'CHANNEL_NAME', 'CALENDAR_DT', spend, install_num, retention, rev, and ltv
+    The input df includes 'APPLICATION_FAMILY_NAME', 'MARKET_CD', 'SOURCE', 'USER_SOURCE_TYPE_CD', 'CHANNEL_NAME', 'CALENDAR_DT', spend, install_num, retention, rev, and ltv.
+    Every metric of METRIC_COLS in the input is summed. The pipeline gets the channel details together with its other rollups from get_rollups()
     """
-    channel_details_df = campaign_details_df.groupby(
-        "APPLICATION_FAMILY_NAME",
-        "MARKET_CD",
-        "SOURCE",
-        "USER_SOURCE_TYPE_CD",
-        "CHANNEL_NAME",
-        "CALENDAR_DT",
-    ).agg(
-        F.sum("SPEND").alias("SPEND"),
-        F.sum("INSTALL").alias("INSTALL"),
-        F.sum("RETENTION_DAY_001_QTY").alias("RETENTION_DAY_001_QTY"),
-        F.sum("RETENTION_DAY_003_QTY").alias("RETENTION_DAY_003_QTY"),
-        F.sum("RETENTION_DAY_007_QTY").alias("RETENTION_DAY_007_QTY"),
-        F.sum("IAP_REVS_DAY_001_AMT").alias("IAP_REVS_DAY_001_AMT"),
-        F.sum("AD_REVS_DAY_001_AMT").alias("AD_REVS_DAY_001_AMT"),
-        F.sum("SUB_REVS_DAY_001_AMT").alias("SUB_REVS_DAY_001_AMT"),
-        F.sum("IAP_REVS_DAY_003_AMT").alias("IAP_REVS_DAY_003_AMT"),
-        F.sum("AD_REVS_DAY_003_AMT").alias("AD_REVS_DAY_003_AMT"),
-        F.sum("SUB_REVS_DAY_003_AMT").alias("SUB_REVS_DAY_003_AMT"),
-        F.sum("IAP_REVS_DAY_007_AMT").alias("IAP_REVS_DAY_007_AMT"),
-        F.sum("AD_REVS_DAY_007_AMT").alias("AD_REVS_DAY_007_AMT"),
-        F.sum("SUB_REVS_DAY_007_AMT").alias("SUB_REVS_DAY_007_AMT"),
-        F.sum("IAP_REVS_DAY_014_AMT").alias("IAP_REVS_DAY_014_AMT"),
-        F.sum("AD_REVS_DAY_014_AMT").alias("AD_REVS_DAY_014_AMT"),
-        F.sum("SUB_REVS_DAY_014_AMT").alias("SUB_REVS_DAY_014_AMT"),
-        F.sum("IAP_REVS_DAY_028_AMT").alias("IAP_REVS_DAY_028_AMT"),
-        F.sum("AD_REVS_DAY_028_AMT").alias("AD_REVS_DAY_028_AMT"),
-        F.sum("SUB_REVS_DAY_028_AMT").alias("SUB_REVS_DAY_028_AMT"),
-        F.sum("IAP_LTV").alias("IAP_LTV"),
-        F.sum("AD_LTV").alias("AD_LTV"),
-        F.sum("SUB_LTV").alias("SUB_LTV"),
-        F.sum("TOTAL_LTV").alias("TOTAL_LTV"),
+    channel_details_df = get_rollup_df(
+        get_rollups(campaign_details_df, [CHANNEL_DAY_ROLLUP]), CHANNEL_DAY_ROLLUP
     )
     return channel_details_df
 
@@ -745,6 +1123,17 @@ if ENVIRONMENT == Environment.DEVELOPMENT:
 
 # COMMAND ----------
 
+def aggregate_to_daily_game_details(channel_details_df: ps.DataFrame) -> ps.DataFrame:
+    """
+    Aggregate campaign- or channel-level performance into daily game-level spend and installs, which is the grain of the QA summary table
+    """
+    daily_game_agg_df = channel_details_df.groupby(*QA_SUMMARY_KEY_COLS).agg(
+        F.sum("SPEND").alias("SPEND"),
+        F.sum("INSTALL").alias("INSTALL"),
+    )
+    return daily_game_agg_df
+
+
 def aggregate_to_game_details(channel_details_df: ps.DataFrame) -> ps.DataFrame:
     """
     Aggregate campaign- or channel-level performance into game-level metrics, which includes market_cd, source, last_install_dt, total_spend, total_installs and total_ltv
@@ -786,69 +1175,115 @@ class PredictionError(Exception):
     def __str__(self):
         msg = f"""
         Prediction error for {self.game} {self.market_cd} {self.source}:
-        Before prediction, there are {self.exist_total_install_num} installs up to {datetime.strftime(self.exist_max_install_dt, DATE_FORMAT)} for ${self.exist_total_spend:.2f}.
-        After prediction, there are {self.new_total_install_num} installs up to {datetime.strftime(self.new_max_install_dt, DATE_FORMAT)} for ${self.new_total_spend:.2f}.
+        Before prediction, there are {self.exist_total_install_num} installs up to {self.exist_max_install_dt.strftime(DATE_FORMAT)} for ${self.exist_total_spend:.2f}.
+        After prediction, there are {self.new_total_install_num} installs up to {self.new_max_install_dt.strftime(DATE_FORMAT)} for ${self.new_total_spend:.2f}.
          """
         return msg
 
 
-def get_old_channel_details_df() -> ps.DataFrame:
-    sql = f"select * from {CAMPAIGN_TABLE_NAME}"
+class QAError(Exception):
+    def __init__(self, violation_df: pd.DataFrame):
+        self.violation_df = violation_df
+        super().__init__()
+
+    def __str__(self):
+        errors = [
+            PredictionError(
+                row["APPLICATION_FAMILY_NAME"],
+                row["MARKET_CD"],
+                row["SOURCE"],
+                row["OLD_LAST_INSTALL_DT"],
+                row["OLD_TOTAL_SPEND"],
+                row["OLD_TOTAL_INSTALL"],
+                row["NEW_LAST_INSTALL_DT"],
+                row["NEW_TOTAL_SPEND"],
+                row["NEW_TOTAL_INSTALL"],
+            )
+            for _, row in self.violation_df.iterrows()
+        ]
+        return f"{len(errors)} QA violations:" + "".join(str(error) for error in errors)
+
+
+def get_old_channel_details_df(run_config: RunConfig = RUN_CONFIG) -> ps.DataFrame:
+    sql = f"select * from {CHANNEL_TABLE_NAME} where APPLICATION_FAMILY_NAME in {to_sql_list(run_config.game_list)} and CALENDAR_DT between '{run_config.compute_start_dt}' and '{run_config.skan_end_dt}'"
     df = spark.sql(sql)
     return df
 
 
-def qa_result_by_game(row: pd.Series) -> None:
-    if (row["NEW_LAST_INSTALL_DT"] < row["OLD_LAST_INSTALL_DT"]) or (
-        row["NEW_TOTAL_INSTALL"] < (row["OLD_TOTAL_INSTALL"] - 1)
-    ):
-        raise PredictionError(
-            row["APPLICATION_FAMILY_NAME"],
-            row["MARKET_CD"],
-            row["SOURCE"],
-            row["OLD_LAST_INSTALL_DT"],
-            row["OLD_TOTAL_SPEND"],
-            row["OLD_TOTAL_INSTALL"],
-            row["NEW_LAST_INSTALL_DT"],
-            row["NEW_TOTAL_SPEND"],
-            row["NEW_TOTAL_INSTALL"],
+def get_old_game_details_df(run_config: RunConfig = RUN_CONFIG) -> ps.DataFrame:
+    """
+    Return the game-level details of the published result within the recomputed window.
+    They are read from the QA summary table, only fall back to the channel table before the summary table exists, and are empty before either exists
+    """
+    if spark.catalog.tableExists(QA_SUMMARY_TABLE_NAME):
+        sql = f"select * from {QA_SUMMARY_TABLE_NAME} where APPLICATION_FAMILY_NAME in {to_sql_list(run_config.game_list)} and CALENDAR_DT between '{run_config.compute_start_dt}' and '{run_config.skan_end_dt}'"
+        df = spark.sql(sql)
+    elif spark.catalog.tableExists(CHANNEL_TABLE_NAME):
+        df = get_old_channel_details_df(run_config)
+    else:
+        df = spark.createDataFrame(
+            [], "APPLICATION_FAMILY_NAME string, MARKET_CD string, SOURCE string, CALENDAR_DT date, SPEND double, INSTALL long"
         )
+    return aggregate_to_game_details(df)
 
 
-def qa_result(
-    old_channel_details_df: ps.DataFrame, new_channel_details_df: ps.DataFrame
-) -> None:
+def get_qa_violations(
+    old_game_details_df: ps.DataFrame, new_game_details_df: ps.DataFrame
+) -> pd.DataFrame:
     """
-    QA the new merge result. If on any platform, we find a smaller last_install_dt, or a smaller spend, or a smaller install_num, report an error
+    Compare old and new game-level details, and return every (game, market, source) whose last_install_dt or install_num shrank, with a VIOLATION column describing why
     """
-    old_agg_df = aggregate_to_game_details(old_channel_details_df).toPandas()
-    old_agg_df = old_agg_df.rename(
+    old_agg_df = old_game_details_df.toPandas().rename(
         columns={
             "LAST_INSTALL_DT": "OLD_LAST_INSTALL_DT",
             "TOTAL_SPEND": "OLD_TOTAL_SPEND",
             "TOTAL_INSTALL": "OLD_TOTAL_INSTALL",
         }
     )
-
-    new_agg_df = aggregate_to_game_details(new_channel_details_df).toPandas()
-    new_agg_df = new_agg_df.rename(
+    new_agg_df = new_game_details_df.toPandas().rename(
         columns={
             "LAST_INSTALL_DT": "NEW_LAST_INSTALL_DT",
             "TOTAL_SPEND": "NEW_TOTAL_SPEND",
             "TOTAL_INSTALL": "NEW_TOTAL_INSTALL",
         }
     )
-
     comp_agg_df = old_agg_df.merge(
         new_agg_df, on=["APPLICATION_FAMILY_NAME", "MARKET_CD", "SOURCE"], how="inner"
     )
-    comp_agg_df.apply(qa_result_by_game, axis=1)
+
+    last_install_dt_shrank = (
+        comp_agg_df["NEW_LAST_INSTALL_DT"] < comp_agg_df["OLD_LAST_INSTALL_DT"]
+    )
+    install_shrank = comp_agg_df["NEW_TOTAL_INSTALL"] < (
+        comp_agg_df["OLD_TOTAL_INSTALL"] - 1
+    )
+    comp_agg_df["VIOLATION"] = (
+        last_install_dt_shrank.map({True: "smaller last_install_dt; ", False: ""})
+        + install_shrank.map({True: "smaller install_num; ", False: ""})
+    ).str.rstrip("; ")
+    violation_df = comp_agg_df[last_install_dt_shrank | install_shrank]
+    return violation_df.reset_index(drop=True)
+
+
+def qa_result(
+    old_game_details_df: ps.DataFrame, new_game_details_df: ps.DataFrame
+) -> pd.DataFrame:
+    """
+    QA the new merge result. If on any platform, we find a smaller last_install_dt, or a smaller install_num, report all of them in one QAError
+    """
+    violation_df = get_qa_violations(old_game_details_df, new_game_details_df)
+    if len(violation_df) > 0:
+        raise QAError(violation_df)
+    return violation_df
 
 # COMMAND ----------
 
 if ENVIRONMENT == Environment.DEVELOPMENT:
-    old_channel_details_df = get_old_channel_details_df()
-    qa_result(old_channel_details_df, channel_details_df)
+    display(
+        get_qa_violations(
+            get_old_game_details_df(), aggregate_to_game_details(channel_details_df)
+        )
+    )
 
 # COMMAND ----------
 
@@ -859,80 +1294,1632 @@ if ENVIRONMENT == Environment.DEVELOPMENT:
 
 def revise_schema(df: ps.DataFrame) -> ps.DataFrame:
     """
-    Change certain column names to lower case
+    Cast the metric columns of df to float, or to int for INT_METRIC_COLS, in one projection
     """
-    float_columns = (
-        [f"{metric}_REVS_DAY_{day:0>3d}_AMT" for day in [1, 3, 7, 14, 28] for metric in ['IAP', 'AD', 'SUB']] 
-        + [f"{metric}_LTV" for metric in ['IAP', 'AD', 'SUB', 'TOTAL']]
-        + ['SPEND']
+    float_columns = [column for column in METRIC_COLS if column not in INT_METRIC_COLS]
+    int_columns = INT_METRIC_COLS
+
+    # cast all columns in one projection instead of one withColumn per column
+    df = df.select(
+        *[
+            df[column].cast('float').alias(column) if column in float_columns
+            else df[column].cast('int').alias(column) if column in int_columns
+            else df[column]
+            for column in df.columns
+        ]
     )
-    for column in float_columns:
-        df = df.withColumn(column, df[column].cast('float'))
-        
-    int_columns = ['INSTALL'] + [f"RETENTION_DAY_{day:0>3d}_QTY" for day in [1, 3, 7]]
-    for column in int_columns:
-        df = df.withColumn(column, df[column].cast('int')) 
-    
     return df
 
 
-def save_result(
-    campaign_details_df: ps.DataFrame, channel_details_df: ps.DataFrame
+def merge_into_table(
+    df: ps.DataFrame, table_name: str, key_cols: List[str], run_config: RunConfig
 ) -> None:
-    campaign_details_df = revise_schema(campaign_details_df)
-    campaign_details_df.write.format("parquet").mode("overwrite").partitionBy(
-        "APPLICATION_FAMILY_NAME"
-    ).save(CAMPAIGN_PARQUET_PATH)
-    campaign_details_df.write.mode("overwrite").partitionBy(
-        "APPLICATION_FAMILY_NAME"
-    ).saveAsTable(CAMPAIGN_TABLE_NAME)
-
-    channel_details_df = revise_schema(channel_details_df)
-    channel_details_df.write.format("parquet").mode("overwrite").partitionBy(
-        "APPLICATION_FAMILY_NAME"
-    ).save(CHANNEL_PARQUET_PATH)
-    channel_details_df.write.mode("overwrite").partitionBy(
-        "APPLICATION_FAMILY_NAME"
-    ).saveAsTable(CHANNEL_TABLE_NAME)
+    """
+    Upsert df into table_name by key_cols. Rows of the run's games and markets inside its recomputed window (CALENDAR_DT from compute_start_dt to skan_end_dt)
+    that no longer exist in df are deleted, and all other rows are left untouched
+    """
+    # game groups merge concurrently, so every merge needs its own view
+    view_name = f"updates_{table_name.replace('.', '_')}_{uuid.uuid4().hex}"
+    df.createOrReplaceTempView(view_name)
+    target_cond = (
+        f"t.APPLICATION_FAMILY_NAME in {to_sql_list(run_config.game_list)} and t.MARKET_CD in {to_sql_list(run_config.market_list)}"
+        f" and t.CALENDAR_DT between '{run_config.compute_start_dt}' and '{run_config.skan_end_dt}'"
+    )
+    on_cond = " and ".join(f"t.{col} <=> s.{col}" for col in key_cols)
+    sql = f"""
+merge into {table_name} t
+using {view_name} s
+on {target_cond} and {on_cond}
+when matched then update set *
+when not matched then insert *
+when not matched by source and {target_cond} then delete
+  """
+    spark.sql(sql)
+    spark.catalog.dropTempView(view_name)
 
-# COMMAND ----------
 
-# MAGIC %md
-# MAGIC ### Main Function
+def set_missing_table_properties(table_name: str, properties: dict) -> None:
+    """
+    Set the properties of the delta table table_name that it lacks or holds another value of.
+    They are only set once after the table is created, or after a change of their value, since a metadata change conflicts with the writes of concurrent game groups
+    """
+    table_properties = {row.key: row.value for row in spark.sql(f"show tblproperties {table_name}").collect()}
+    if all(table_properties.get(key) == value for key, value in properties.items()):
+        return
+    spark.sql(
+        f"""
+alter table {table_name} set tblproperties (
+  {", ".join(f"'{key}' = '{value}'" for key, value in properties.items())}
+)
+  """
+    )
 
-# COMMAND ----------
 
-def merge_skan_performance_channel_details():
-    # get campaign details
-    campaign_without_sub_pltv_df = get_campaign_without_sub_ltv()
-    campaign_sub_pltv_df = get_campaign_sub_ltv()
-    campaign_details_df = get_campaign_details(
-        campaign_without_sub_pltv_df, campaign_sub_pltv_df
+def apply_snapshot_retention(table_name: str) -> None:
+    """
+    Keep the versions of table_name readable by time travel for SNAPSHOT_RETENTION_DAYS
+    """
+    retention = f"interval {SNAPSHOT_RETENTION_DAYS} days"
+    set_missing_table_properties(
+        table_name, {"delta.logRetentionDuration": retention, "delta.deletedFileRetentionDuration": retention}
     )
 
-    # get skan channel details
-    skan_campaign_ltv_df = get_skan_campaign_ltv()
 
-    # Join SKAN with Non-SKAN to Get Complete LTV Info
-    campaign_details_df = get_complete_campaign_details(
-        campaign_details_df, skan_campaign_ltv_df
+PUBLISHED_TABLE_NAMES = [
+    CAMPAIGN_TABLE_NAME,
+    CHANNEL_TABLE_NAME,
+    QA_SUMMARY_TABLE_NAME,
+    GAME_TABLE_NAME,
+    CHANNEL_WEEKLY_TABLE_NAME,
+    CHANNEL_MONTHLY_TABLE_NAME,
+]
+
+
+def vacuum_published_tables() -> None:
+    """
+    Vacuum the data files of the published delta tables that no version of the last SNAPSHOT_RETENTION_DAYS reads.
+    It runs once per run, after all of its game groups or backfill chunks have published
+    """
+    for table_name in PUBLISHED_TABLE_NAMES:
+        if spark.catalog.tableExists(table_name) and get_table_provider(table_name) == "delta":
+            spark.sql(f"vacuum {table_name} retain {SNAPSHOT_RETENTION_DAYS * 24} hours")
+
+
+# the user metadata that save_result() tags the delta commits of a run with, followed by its run date
+RUN_DT_METADATA_PREFIX = "run_dt="
+
+
+def get_snapshot_version(table_name: str, snapshot_dt: str) -> int:
+    """
+    Return the latest version of table_name written by a run on or before snapshot_dt, from the run dates its commits are tagged with.
+    Unlike a timestamp, it is found for the current day and any day after the last commit
+    """
+    run_dt_col = F.expr(f"substring(userMetadata, {len(RUN_DT_METADATA_PREFIX) + 1})")
+    version = (
+        spark.sql(f"describe history {table_name}")
+        .where(F.col("userMetadata").startswith(RUN_DT_METADATA_PREFIX) & (run_dt_col <= snapshot_dt))
+        .agg(F.max("version"))
+        .first()[0]
     )
+    if version is None:
+        raise ValueError(f"no version of {table_name} was written by a run on or before {snapshot_dt}")
+    return version
 
-    # Aggregate campaign_details_df on Channel
-    channel_details_df = aggregate_campaign_to_channel_details(campaign_details_df)
 
-    # qa
-    old_channel_details_df = get_old_channel_details_df()
-    qa_result(old_channel_details_df, channel_details_df)
+def get_snapshot_df(table_name: str, snapshot_dt: str) -> ps.DataFrame:
+    """
+    Return table_name as published by the last run on or before snapshot_dt, read from the delta table history
+    """
+    return spark.read.option("versionAsOf", get_snapshot_version(table_name, snapshot_dt)).table(table_name)
 
-    # save result
-    if SAVE_FLAG:
-        save_result(campaign_details_df, channel_details_df)
 
-    return campaign_details_df, channel_details_df
+def get_snapshot_store_path(kind: str, store: str) -> str:
+    """
+    Return the path of the base or changes store of the channel or campaign snapshots, partitioned by SNAPSHOT_DT and game
+    """
+    return str(Path(SNAPSHOT_DIR, f"{kind}_{store}.parquet"))
 
-# COMMAND ----------
 
-if ENVIRONMENT == Environment.PRODUCTION:
-    campaign_details_df, channel_details_df = merge_skan_performance_channel_details()
-    display(channel_details_df)
+def read_snapshot_store(kind: str, store: str) -> Optional[ps.DataFrame]:
+    fs, store_path = get_hadoop_path(get_snapshot_store_path(kind, store))
+    if not fs.exists(store_path):
+        return None
+    try:
+        return spark.read.parquet(get_snapshot_store_path(kind, store))
+    except AnalysisException:
+        # no partition has been written yet
+        return None
+
+
+def get_snapshot_base_dts(kind: str, snapshot_dt: date, game_list: Optional[List[str]] = None) -> dict:
+    """
+    Return the date of the latest base snapshot of kind on or before snapshot_dt of each game of game_list, or of every game
+    """
+    base_df = read_snapshot_store(kind, "base")
+    if base_df is None:
+        return {}
+    base_df = base_df.where(F.col("SNAPSHOT_DT") <= F.lit(snapshot_dt))
+    if game_list is not None:
+        base_df = base_df.where(F.col("APPLICATION_FAMILY_NAME").isin(game_list))
+    # only the partition columns are read
+    base_dt_df = base_df.groupby("APPLICATION_FAMILY_NAME").agg(F.max("SNAPSHOT_DT").alias("BASE_DT"))
+    return {row.APPLICATION_FAMILY_NAME: row.BASE_DT for row in base_dt_df.collect()}
+
+
+def get_changes_snapshot_df(
+    kind: str, snapshot_dt: date, key_cols: List[str], game_list: Optional[List[str]] = None
+) -> Optional[ps.DataFrame]:
+    """
+    Reconstruct the snapshot of kind as of snapshot_dt in changes mode, from the latest base of each game on or before it and the changes written since,
+    of which the last one of each key by key_cols wins. Return None when no game has a base yet
+    """
+    base_dts = get_snapshot_base_dts(kind, snapshot_dt, game_list)
+    if not base_dts:
+        return None
+    base_cond, changes_cond = F.lit(False), F.lit(False)
+    for game, base_dt in base_dts.items():
+        is_game = F.col("APPLICATION_FAMILY_NAME") == game
+        base_cond = base_cond | (is_game & (F.col("SNAPSHOT_DT") == F.lit(base_dt)))
+        changes_cond = changes_cond | (is_game & (F.col("SNAPSHOT_DT") > F.lit(base_dt)))
+    snapshot_df = read_snapshot_store(kind, "base").where(base_cond)
+    changes_df = read_snapshot_store(kind, "changes")
+    if changes_df is not None:
+        snapshot_df = snapshot_df.unionByName(
+            changes_df.where(changes_cond & (F.col("SNAPSHOT_DT") <= F.lit(snapshot_dt)))
+        )
+    latest_window = Window.partitionBy(*key_cols).orderBy(F.col("SNAPSHOT_DT").desc())
+    return (
+        snapshot_df.withColumn("RECORD_NUM", F.row_number().over(latest_window))
+        .where("RECORD_NUM = 1 and CHANGE_TYPE != 'delete'")
+        .drop("RECORD_NUM", "SNAPSHOT_DT", "CHANGE_TYPE")
+    )
+
+
+def write_snapshot_changes(df: ps.DataFrame, kind: str, key_cols: List[str], run_config: RunConfig) -> None:
+    """
+    Write the snapshot of kind as of the run date of run_config, where df is what the run published: the rows of the recomputed window that were inserted or changed,
+    or deleted, by key_cols since the previous day's snapshot, and a full base for the games without one in the last SNAPSHOT_BASE_INTERVAL_DAYS days.
+    The changes are written on base days as well, so that they always answer what changed since the day before. A rerun on the same day replaces what the first run wrote for its games
+    """
+    snapshot_dt = run_config.run_dt
+    previous_dt = snapshot_dt - timedelta(days=1)
+    previous_df = get_changes_snapshot_df(kind, previous_dt, key_cols, run_config.game_list)
+    base_dts = get_snapshot_base_dts(kind, previous_dt, run_config.game_list)
+    base_games = [
+        game
+        for game in run_config.game_list
+        if game not in base_dts or (snapshot_dt - base_dts[game]).days >= SNAPSHOT_BASE_INTERVAL_DAYS
+    ]
+    is_base_game = F.col("APPLICATION_FAMILY_NAME").isin(base_games)
+    is_window = F.lit(True)
+    if run_config.compute_start_dt != START_DT:
+        is_window = F.col("CALENDAR_DT").between(run_config.compute_start_dt, run_config.skan_end_dt)
+
+    base_df, changes_df = df, None
+    # games without any base have no previous snapshot to carry their rows outside a partial window, so their first base takes them
+    # from the published table, which still holds what the previous runs published. A game never published has no rows outside the window
+    seed_games = [game for game in base_games if game not in base_dts]
+    table_name = CAMPAIGN_TABLE_NAME if kind == "campaign" else CHANNEL_TABLE_NAME
+    if seed_games and run_config.compute_start_dt != START_DT and spark.catalog.tableExists(table_name):
+        base_df = base_df.unionByName(
+            spark.table(table_name)
+            .where(F.col("APPLICATION_FAMILY_NAME").isin(seed_games) & ~is_window)
+            .select(*df.columns)
+        )
+    if previous_df is not None:
+        previous_df = previous_df.select(*df.columns)
+        # the rows outside the recomputed window are unchanged since the previous day
+        base_df = base_df.unionByName(previous_df.where(~is_window))
+        window_df = previous_df.where(is_window)
+        upsert_df = df.subtract(window_df).withColumn("CHANGE_TYPE", F.lit("upsert"))
+        delete_df = window_df.join(
+            df, [window_df[col].eqNullSafe(df[col]) for col in key_cols], "leftanti"
+        ).withColumn("CHANGE_TYPE", F.lit("delete"))
+        changes_df = upsert_df.unionByName(delete_df)
+
+    fs, _ = get_hadoop_path(SNAPSHOT_DIR)
+    escape_path_name = spark._jvm.org.apache.spark.sql.catalyst.catalog.ExternalCatalogUtils.escapePathName
+    for store, store_df in [
+        ("base", base_df.where(is_base_game).withColumn("CHANGE_TYPE", F.lit("base"))),
+        ("changes", changes_df),
+    ]:
+        # a game may write nothing to a store on a rerun, so what the first run wrote is deleted rather than overwritten
+        for game in run_config.game_list:
+            _, partition_path = get_hadoop_path(
+                str(Path(get_snapshot_store_path(kind, store), f"SNAPSHOT_DT={snapshot_dt}", f"APPLICATION_FAMILY_NAME={escape_path_name(game)}"))
+            )
+            fs.delete(partition_path, True)
+        if store_df is None:
+            continue
+        store_df, partition_cols = apply_table_layout(
+            store_df.withColumn("SNAPSHOT_DT", F.lit(snapshot_dt)), TableLayout.GAME
+        )
+        # dynamic partition overwrite, so that game groups can write concurrently
+        store_df.write.format("parquet").mode("overwrite").option(
+            "partitionOverwriteMode", "dynamic"
+        ).options(**get_parquet_options(store_df)).partitionBy("SNAPSHOT_DT", *partition_cols).save(
+            get_snapshot_store_path(kind, store)
+        )
+    prune_snapshot_store(kind, run_config)
+
+
+def prune_snapshot_store(kind: str, run_config: RunConfig) -> None:
+    """
+    Delete the snapshots of kind written before the base that the oldest day within SNAPSHOT_RETENTION_DAYS of the run date is reconstructed from
+    """
+    base_dts = get_snapshot_base_dts(kind, run_config.run_dt - timedelta(days=SNAPSHOT_RETENTION_DAYS))
+    if not base_dts:
+        return
+    min_snapshot_dt = min(base_dts.values())
+    for store in ["base", "changes"]:
+        fs, store_path = get_hadoop_path(get_snapshot_store_path(kind, store))
+        if not fs.exists(store_path):
+            continue
+        for entry in fs.listStatus(store_path):
+            name = entry.getPath().getName()
+            if name.startswith("SNAPSHOT_DT=") and datetime.strptime(name.split("=")[1], DATE_FORMAT).date() < min_snapshot_dt:
+                fs.delete(entry.getPath(), True)
+
+
+def write_snapshot(df: ps.DataFrame, kind: str, key_cols: List[str], run_config: RunConfig) -> None:
+    """
+    Write the daily snapshot of the channel or campaign details df in SNAPSHOT_MODE, once df has been published.
+    A full copy holds every published row of the run's games, which is read back from the published table, since an incremental run's df only covers its window
+    """
+    if SNAPSHOT_MODE == SnapshotMode.CHANGES:
+        write_snapshot_changes(df, kind, key_cols, run_config)
+        return
+    table_name = CAMPAIGN_TABLE_NAME if kind == "campaign" else CHANNEL_TABLE_NAME
+    published_df = spark.table(table_name).where(F.col("APPLICATION_FAMILY_NAME").isin(run_config.game_list))
+    # dynamic partition overwrite, so that game groups only replace their own partitions of the snapshot
+    snapshot_df, partition_cols = apply_table_layout(published_df.select(*df.columns), TableLayout.GAME)
+    snapshot_df.write.format("parquet").mode("overwrite").option(
+        "partitionOverwriteMode", "dynamic"
+    ).options(**get_parquet_options(snapshot_df)).partitionBy(*partition_cols).save(
+        CAMPAIGN_PARQUET_PATH if kind == "campaign" else CHANNEL_PARQUET_PATH
+    )
+
+
+def apply_table_layout(
+    df: ps.DataFrame, layout: TableLayout
+) -> Tuple[ps.DataFrame, List[str]]:
+    """
+    Add the partition columns of layout to df, and cluster its rows by channel and date within each partition. Each partition is written by one task
+    per PARTITION_WRITE_PERIOD of CALENDAR_DT, into files of up to PARQUET_FILE_MAX_ROWS by the maxRecordsPerFile option. Return the laid-out df and its partition columns
+    """
+    partition_cols = ["APPLICATION_FAMILY_NAME"]
+    if layout == TableLayout.GAME_AND_INSTALL_MONTH:
+        df = df.withColumn("INSTALL_MONTH", F.date_format("CALENDAR_DT", "yyyy-MM"))
+        partition_cols = ["APPLICATION_FAMILY_NAME", "INSTALL_MONTH"]
+    # without it, every task of the last shuffle would write a small file into each partition it holds rows of.
+    # The period bounds the files per partition, while keeping a game's history from being written by a single task
+    period_cols = [F.trunc("CALENDAR_DT", PARTITION_WRITE_PERIOD)] if "CALENDAR_DT" in df.columns else []
+    df = df.repartition(*partition_cols, *period_cols)
+    sort_cols = [col for col in ["CHANNEL_NAME", "CALENDAR_DT"] if col in df.columns]
+    df = df.sortWithinPartitions(*partition_cols, *sort_cols)
+    return df, partition_cols
+
+
+def get_parquet_options(df: ps.DataFrame) -> dict:
+    """
+    Return the writer options of a published df: file and row group sizes, and bloom filters on its PARQUET_BLOOM_FILTER_COLS.
+    Parquet only writes a bloom filter for a column chunk that outgrows its dictionary, since readers skip the other chunks by their dictionary.
+    Min/max statistics are written for every column by default
+    """
+    return {
+        "maxRecordsPerFile": str(PARQUET_FILE_MAX_ROWS),
+        "parquet.block.size": str(PARQUET_ROW_GROUP_BYTES),
+        **{
+            f"parquet.bloom.filter.enabled#{col}": "true"
+            for col in PARQUET_BLOOM_FILTER_COLS
+            if col in df.columns
+        },
+    }
+
+
+def get_table_detail(table_name: str, detail: str) -> Optional[str]:
+    detail_rows = spark.sql(f"describe table extended {table_name}").where(F.col("col_name") == detail).collect()
+    return detail_rows[0].data_type if detail_rows else None
+
+
+DYNAMIC_OVERWRITE_SPARK_CONF = {
+    "spark.sql.sources.partitionOverwriteMode": "dynamic",
+    "hive.exec.dynamic.partition": "true",
+    "hive.exec.dynamic.partition.mode": "nonstrict",
+}
+
+
+def get_table_provider(table_name: str) -> Optional[str]:
+    provider = get_table_detail(table_name, "Provider")
+    return provider.lower() if provider else None
+
+
+def compact_table(table_name: str, run_config: RunConfig) -> None:
+    """
+    Rewrite the game partitions of run_config in the delta table table_name into files of up to TARGET_FILE_BYTES,
+    z-ordered by its PARQUET_BLOOM_FILTER_COLS, to compact the small files left by merge_into_table().
+    The file size is a property of the table rather than a session setting, which concurrent game groups would overwrite
+    """
+    set_missing_table_properties(table_name, {"delta.targetFileSize": str(TARGET_FILE_BYTES)})
+    zorder_cols = [col for col in PARQUET_BLOOM_FILTER_COLS if col in spark.table(table_name).columns]
+    zorder_clause = f"zorder by ({', '.join(zorder_cols)})" if zorder_cols else ""
+    spark.sql(f"optimize {table_name} where APPLICATION_FAMILY_NAME in {to_sql_list(run_config.game_list)} {zorder_clause}")
+
+
+SHARED_CONF_LOCK = threading.Lock()
+# per session setting, the number of open shared_session_conf() scopes setting it, and its value before the first of them opened
+SHARED_CONF_STATE = {}
+
+
+@contextmanager
+def shared_session_conf(spark_conf: dict):
+    """
+    Set the spark settings of spark_conf on the session within the scope. Game groups publish concurrently with the same settings,
+    so the first scope to open sets a setting and the last one to close restores its previous value
+    """
+    with SHARED_CONF_LOCK:
+        for key, value in spark_conf.items():
+            state = SHARED_CONF_STATE.setdefault(key, {"scope_num": 0, "previous": None})
+            if state["scope_num"] == 0:
+                state["previous"] = spark.conf.get(key, None)
+                spark.conf.set(key, value)
+            state["scope_num"] += 1
+    try:
+        yield
+    finally:
+        with SHARED_CONF_LOCK:
+            for key in spark_conf:
+                state = SHARED_CONF_STATE[key]
+                state["scope_num"] -= 1
+                if state["scope_num"] == 0:
+                    if state["previous"] is None:
+                        spark.conf.unset(key)
+                    else:
+                        spark.conf.set(key, state["previous"])
+
+
+def publish_table(
+    df: ps.DataFrame,
+    table_name: str,
+    key_cols: List[str],
+    run_config: RunConfig,
+    layout: TableLayout = TABLE_LAYOUT,
+) -> None:
+    """
+    Write df into table_name with the given layout.
+    A run over all games and all dates overwrites the table. Any other run only replaces the partitions it recomputed by dynamic partition overwrite,
+    except incremental runs and backfill chunks with the game layout, whose window is merged into the table since it does not line up with the partitions,
+    and runs over some of the markets, whose rows share the partitions of the other markets.
+    saveAsTable would drop and recreate an existing table that is not a delta table, so its partitions are overwritten with insertInto instead
+    """
+    is_partial_window = run_config.compute_start_dt != START_DT or run_config.is_backfill_chunk
+    is_partial_markets = set(run_config.market_list) != set(MARKET_LIST)
+    if (is_partial_window and layout == TableLayout.GAME) or is_partial_markets:
+        merge_into_table(df, table_name, key_cols, run_config)
+        # overwrites are written at the target file size already, merges leave small files behind
+        if COMPACT_TABLES_FLAG and get_table_provider(table_name) == "delta":
+            compact_table(table_name, run_config)
+    else:
+        df, partition_cols = apply_table_layout(df, layout)
+        is_full_overwrite = set(run_config.game_list) == set(GAME_LIST) and not is_partial_window
+        provider = get_table_provider(table_name) if spark.catalog.tableExists(table_name) else None
+        if not is_full_overwrite and provider is not None and provider != "delta":
+            # insertInto writes through the metastore, so it also serves hive serde tables, which have no data source to save a path with.
+            # The per-write partitionOverwriteMode option does not reach it, so dynamic overwrite is set on the session, and hive's strict mode is lifted
+            with shared_session_conf(DYNAMIC_OVERWRITE_SPARK_CONF):
+                # insertInto matches columns by position
+                df.select(*spark.table(table_name).columns).write.insertInto(table_name, overwrite=True)
+            spark.catalog.refreshTable(table_name)
+            return
+        writer = df.write.mode("overwrite").partitionBy(*partition_cols).options(**get_parquet_options(df))
+        if PUBLISH_MODE == PublishMode.VERSIONED_TABLE or provider == "delta":
+            writer = writer.format("delta")
+        if is_full_overwrite:
+            # static explicitly, since concurrent inserts into non-delta tables may have set dynamic on the session
+            writer = writer.option("overwriteSchema", "true").option("partitionOverwriteMode", "static")
+        else:
+            writer = writer.option("partitionOverwriteMode", "dynamic")
+        writer.saveAsTable(table_name)
+    if PUBLISH_MODE == PublishMode.VERSIONED_TABLE:
+        apply_snapshot_retention(table_name)
+
+
+def publish_rollups(rollup_dfs: dict, run_config: RunConfig) -> None:
+    """
+    Publish every rollup df of rollup_dfs but the channel details to the serving table of its grain.
+    Incremental runs merge the period rollups from the start of their first period, which get_rollups() completed with published rows
+    """
+    for rollup, df in rollup_dfs.items():
+        if rollup == CHANNEL_DAY_ROLLUP:
+            continue
+        rollup_run_config = run_config
+        if rollup in PERIOD_ROLLUPS and run_config.compute_start_dt != START_DT:
+            rollup_run_config = run_config._replace(compute_start_dt=get_rollup_start_dt(run_config))
+        publish_table(
+            revise_schema(df), rollup.table_name, list(rollup.group_cols), rollup_run_config, TableLayout.GAME
+        )
+
+
+BACKFILL_PUBLISH_LOCK = threading.Lock()
+COMMIT_METADATA_KEY = "spark.databricks.delta.commitInfo.userMetadata"
+
+
+def commit_user_metadata(user_metadata: str):
+    """
+    Tag the delta commits of the session with user_metadata within the scope, see shared_session_conf()
+    """
+    return shared_session_conf({COMMIT_METADATA_KEY: user_metadata})
+
+
+def save_result(
+    campaign_details_df: ps.DataFrame,
+    channel_details_df: ps.DataFrame,
+    run_config: RunConfig = RUN_CONFIG,
+    rollup_dfs: Optional[dict] = None,
+) -> None:
+    """
+    Save the table for both campaign and channel details, and the serving tables of the other rollups of rollup_dfs, keyed by Rollup.
+    In parquet-and-table mode a daily snapshot is written as well after each table is published, see write_snapshot(), which backfill chunks leave alone.
+    In versioned-table mode each result is written once, and the snapshot of a day is read back with get_snapshot_df()
+    """
+    # backfill chunks of the same games would conflict when merging into the same files, so they publish one at a time
+    publish_lock = BACKFILL_PUBLISH_LOCK if run_config.is_backfill_chunk else nullcontext()
+    # tag the table versions written by this run with the run date
+    run_metadata = (
+        commit_user_metadata(f"{RUN_DT_METADATA_PREFIX}{datetime.strftime(run_config.run_dt, DATE_FORMAT)}")
+        if PUBLISH_MODE == PublishMode.VERSIONED_TABLE
+        else nullcontext()
+    )
+    with publish_lock, run_metadata:
+        campaign_details_df = revise_schema(campaign_details_df)
+        check_plan_budget("revise_schema(campaign_details_df)", campaign_details_df)
+        publish_table(campaign_details_df, CAMPAIGN_TABLE_NAME, CAMPAIGN_KEY_COLS, run_config)
+        if PUBLISH_MODE == PublishMode.PARQUET_AND_TABLE and not run_config.is_backfill_chunk:
+            write_snapshot(campaign_details_df, "campaign", CAMPAIGN_KEY_COLS, run_config)
+
+        channel_details_df = revise_schema(channel_details_df)
+        check_plan_budget("revise_schema(channel_details_df)", channel_details_df)
+        publish_table(channel_details_df, CHANNEL_TABLE_NAME, CHANNEL_KEY_COLS, run_config)
+        if PUBLISH_MODE == PublishMode.PARQUET_AND_TABLE and not run_config.is_backfill_chunk:
+            write_snapshot(channel_details_df, "channel", CHANNEL_KEY_COLS, run_config)
+
+        # persist the qa summary of what was just published for the next run, which the game-day rollup already holds
+        if rollup_dfs and GAME_DAY_ROLLUP in rollup_dfs:
+            qa_summary_df = rollup_dfs[GAME_DAY_ROLLUP].select(*QA_SUMMARY_KEY_COLS, "SPEND", "INSTALL")
+        else:
+            qa_summary_df = aggregate_to_daily_game_details(channel_details_df)
+        publish_table(
+            qa_summary_df,
+            QA_SUMMARY_TABLE_NAME,
+            QA_SUMMARY_KEY_COLS,
+            run_config,
+            TableLayout.GAME,
+        )
+        if rollup_dfs:
+            publish_rollups(rollup_dfs, run_config)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### Plan Budget
+
+# COMMAND ----------
+
+def get_plan_stats(df: ps.DataFrame) -> Tuple[int, int]:
+    """
+    Return the depth and the node count of the analyzed logical plan of df
+    """
+    plan_lines = df._jdf.queryExecution().analyzed().treeString().splitlines()
+    # each tree level is indented by three characters of "   ", ":  " or "+- "
+    plan_depths = [(len(line) - len(line.lstrip(" :+-"))) // 3 for line in plan_lines]
+    return max(plan_depths) + 1, len(plan_lines)
+
+
+def check_plan_budget(stage: str, df: ps.DataFrame) -> Tuple[int, int]:
+    """
+    Return the analyzed plan depth and node count of a pipeline stage, with a warning if either exceeds its budget.
+    The run goes on regardless, since a plan that grew without harm should not stop the daily publish
+    """
+    plan_depth, plan_node_num = get_plan_stats(df)
+    if plan_depth > PLAN_DEPTH_BUDGET or plan_node_num > PLAN_NODE_BUDGET:
+        print(
+            f"warning: the plan of {stage} has depth {plan_depth} and {plan_node_num} nodes, "
+            f"over its budget of depth {PLAN_DEPTH_BUDGET} and {PLAN_NODE_BUDGET} nodes"
+        )
+    return plan_depth, plan_node_num
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### Materialization
+
+# COMMAND ----------
+
+def materialize(df: ps.DataFrame, materialized_dfs: List[ps.DataFrame]) -> Tuple[ps.DataFrame, int]:
+    """
+    Compute df once and pin the result, so that later actions do not re-run its lineage back to the warehouse queries.
+    The pinned df is appended to materialized_dfs, to be released by release_materialized(), and returned with its row count
+    """
+    if CHECKPOINT_DIR:
+        # every call of setCheckpointDir() creates a new directory under CHECKPOINT_DIR, so it is only set once per session
+        if spark.sparkContext._jsc.sc().getCheckpointDir().isEmpty():
+            spark.sparkContext.setCheckpointDir(CHECKPOINT_DIR)
+        df = df.checkpoint(eager=True)
+        # counts the checkpoint files, not the lineage
+        row_num = df.count()
+    else:
+        df = df.persist(getattr(StorageLevel, PERSIST_STORAGE_LEVEL))
+        row_num = df.count()
+    materialized_dfs.append(df)
+    return df, row_num
+
+
+def get_checkpoint_path(df: ps.DataFrame) -> Optional[str]:
+    """
+    Return the directory of the checkpoint files of a df pinned by checkpoint(), or None for any other df
+    """
+    plan = df._jdf.logicalPlan()
+    if plan.getClass().getSimpleName() != "LogicalRDD":
+        return None
+    checkpoint_file = plan.rdd().getCheckpointFile()
+    return checkpoint_file.get() if checkpoint_file.isDefined() else None
+
+
+def release_materialized(materialized_dfs: List[ps.DataFrame], keep: Optional[List[ps.DataFrame]] = None) -> None:
+    """
+    Unpersist every df pinned by materialize() but those in keep, and delete the files of the checkpointed ones, which spark keeps until the application ends.
+    The kept dfs stay in materialized_dfs
+    """
+    keep = keep or []
+    kept_dfs = [df for df in materialized_dfs if any(df is kept_df for kept_df in keep)]
+    for df in materialized_dfs:
+        if any(df is kept_df for kept_df in kept_dfs):
+            continue
+        checkpoint_path = get_checkpoint_path(df)
+        if checkpoint_path is None:
+            df.unpersist()
+        else:
+            fs, hadoop_path = get_hadoop_path(checkpoint_path)
+            fs.delete(hadoop_path, True)
+    materialized_dfs[:] = kept_dfs
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### Stage Cache
+
+# COMMAND ----------
+
+def get_code_version(fn: Callable) -> str:
+    """
+    Hash the bytecode and constants of fn, together with every notebook function and config value it references, transitively.
+    Editing the sql or logic of a stage, of a helper it calls or of a config value it reads changes the hash, while moving cells around does not
+    """
+    namespace = globals()
+    code_parts, visited_names = [], set()
+
+    def add_code(code: types.CodeType) -> None:
+        code_parts.append(code.co_code.hex())
+        for const in code.co_consts:
+            if isinstance(const, types.CodeType):
+                add_code(const)
+            else:
+                code_parts.append(repr(sorted(const) if isinstance(const, frozenset) else const))
+        for name in code.co_names:
+            if name in visited_names or name not in namespace:
+                continue
+            visited_names.add(name)
+            value = namespace[name]
+            if isinstance(value, types.FunctionType):
+                add_code(value.__code__)
+            elif value is None or isinstance(value, (str, int, float, date, Enum, list, tuple, dict)):
+                code_parts.append(f"{name}={value!r}")
+
+    add_code(fn.__code__)
+    return hashlib.sha256("\n".join(code_parts).encode()).hexdigest()
+
+
+def get_source_version(table_name: str) -> Optional[str]:
+    """
+    Return the latest delta version of table_name, or for other tables a hash of the data files it currently reads, which every rewrite changes.
+    Return None when neither is available
+    """
+    try:
+        return f"delta:{spark.sql(f'describe history {table_name} limit 1').first()['version']}"
+    except AnalysisException:
+        pass
+    try:
+        input_files = sorted(spark.table(table_name).inputFiles())
+    except AnalysisException:
+        return None
+    return "files:" + hashlib.sha256("\n".join(input_files).encode()).hexdigest()
+
+
+def get_source_versions(table_names: List[str]) -> dict:
+    """
+    Return the version of every source table of table_names, read once per run and shared by the fingerprints of all of its stages.
+    Empty when the stage cache is off
+    """
+    if not STAGE_CACHE_FLAG:
+        return {}
+    return {table_name: get_source_version(table_name) for table_name in table_names}
+
+
+def get_window_rates(run_config: RunConfig, markets: List[str], rate_cols: List[str], date_range: Tuple[date, date]) -> List[tuple]:
+    """
+    Return the rate_cols of the revenue share rates of the run's games in markets over date_range, as (first date, game, market, rates) rows.
+    Periods are clipped to date_range and consecutive periods with the same rates are merged, so that a rate change date moving outside the data,
+    like the IT change date counted from the run date, leaves them unchanged
+    """
+    col_names = [col.split()[0] for col in REVENUE_SHARE_RATE_SCHEMA.split(", ")]
+    start_dt, end_dt = date_range
+    window_rates = []
+    for rate_row in get_revenue_share_rates(run_config._replace(market_list=tuple(markets))):
+        rate = dict(zip(col_names, rate_row))
+        if rate["END_DT"] < start_dt or rate["START_DT"] > end_dt:
+            continue
+        rates = (rate["APPLICATION_FAMILY_NAME"], rate["MARKET_CD"], *[rate[col] for col in [*rate_cols, "RATE_VERSION"]])
+        # the rows of a game and market are in date order
+        if window_rates and window_rates[-1][1:] == rates:
+            continue
+        window_rates.append((max(rate["START_DT"], start_dt), *rates))
+    return window_rates
+
+
+def get_window_fingerprint_parts(
+    run_config: RunConfig, end_dt: str, markets: List[str], rate_cols: List[str]
+) -> Optional[dict]:
+    """
+    Return the parts of run_config that a warehouse stage reading its window from compute_start_dt to end_dt depends on: its games, metric horizons
+    and window, and the rate_cols of markets over the window. Return None when the stage cache is off
+    """
+    if not STAGE_CACHE_FLAG:
+        return None
+    date_range = tuple(datetime.strptime(dt, DATE_FORMAT).date() for dt in [run_config.compute_start_dt, end_dt])
+    return {
+        "game_list": sorted(run_config.game_list),
+        "metric_horizons": run_config.metric_horizons,
+        "date_range": date_range,
+        "rates": get_window_rates(run_config, markets, rate_cols, date_range),
+    }
+
+
+def get_stage_fingerprint(
+    stage_fn: Callable,
+    run_config_parts: Optional[dict],
+    source_versions: dict,
+    input_fingerprints: List[Optional[str]],
+) -> Optional[str]:
+    """
+    Fingerprint the output of stage_fn from its code version, the parts of the run config it reads, the versions of the source tables it reads,
+    taken from get_source_versions(), and the fingerprints of the stage outputs it takes.
+    Return None, i.e. uncacheable, when the stage cache is off or any of them is unknown
+    """
+    if not STAGE_CACHE_FLAG or run_config_parts is None or None in input_fingerprints:
+        return None
+    if None in source_versions.values():
+        return None
+    fingerprint_parts = {
+        "stage": stage_fn.__name__,
+        "code_version": get_code_version(stage_fn),
+        "run_config": run_config_parts,
+        "source_versions": source_versions,
+        "input_fingerprints": input_fingerprints,
+    }
+    return hashlib.sha256(
+        json.dumps(fingerprint_parts, default=str, sort_keys=True).encode()
+    ).hexdigest()[:16]
+
+
+def get_hadoop_path(path: str):
+    hadoop_path = spark._jvm.org.apache.hadoop.fs.Path(path)
+    return hadoop_path.getFileSystem(spark._jsc.hadoopConfiguration()), hadoop_path
+
+
+def is_stage_cached(stage: str, fingerprint: str) -> bool:
+    fs, success_path = get_hadoop_path(str(Path(STAGE_CACHE_DIR, stage, fingerprint, "_SUCCESS")))
+    return fs.exists(success_path)
+
+
+def mark_stage_cached(stage: str, fingerprint: str) -> None:
+    """
+    Record a stage without a df output, e.g. save_result, as done for fingerprint
+    """
+    fs, success_path = get_hadoop_path(str(Path(STAGE_CACHE_DIR, stage, fingerprint, "_SUCCESS")))
+    fs.create(success_path, True).close()
+
+
+def prune_stage_cache(stage: str) -> None:
+    """
+    Delete the cached outputs of stage written more than STAGE_CACHE_RETENTION_DAYS ago
+    """
+    fs, stage_path = get_hadoop_path(str(Path(STAGE_CACHE_DIR, stage)))
+    min_modification_time = (time.time() - STAGE_CACHE_RETENTION_DAYS * 24 * 3600) * 1000
+    for entry in fs.listStatus(stage_path):
+        success_path = spark._jvm.org.apache.hadoop.fs.Path(entry.getPath(), "_SUCCESS")
+        if fs.exists(success_path) and fs.getFileStatus(success_path).getModificationTime() < min_modification_time:
+            fs.delete(entry.getPath(), True)
+
+
+def load_or_compute_stage(stage: str, run_stage: Callable, fingerprint: Optional[str]) -> ps.DataFrame:
+    """
+    Read the output of stage from the stage cache if it holds fingerprint. Otherwise run the stage, and store its output under fingerprint on the way out
+    """
+    if not STAGE_CACHE_FLAG or fingerprint is None:
+        return run_stage()
+    cache_path = str(Path(STAGE_CACHE_DIR, stage, fingerprint))
+    if is_stage_cached(stage, fingerprint):
+        print(f"{stage}: reusing the cached output {fingerprint}")
+        return spark.read.parquet(cache_path)
+
+    df = run_stage()
+    # the df read back from the cache has no lineage, so the plan budget is checked on the computed one
+    check_plan_budget(stage, df)
+    df.write.mode("overwrite").parquet(cache_path)
+    prune_stage_cache(stage)
+    return spark.read.parquet(cache_path)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### Run Report
+
+# COMMAND ----------
+
+RUN_REPORT_SCHEMA = """
+    RUN_ID string, RUN_DT date, GAMES string, STAGE string, STATUS string, WALL_SEC double, ROWS long,
+    NUM_JOBS int, NUM_STAGES int, NUM_TASKS int, NUM_FAILED_TASKS int, INPUT_BYTES long,
+    SHUFFLE_READ_BYTES long, SHUFFLE_WRITE_BYTES long, MEMORY_SPILL_BYTES long, DISK_SPILL_BYTES long, HEAVY_KEYS string,
+    SPARK_CONF string, RATE_VERSION int
+"""
+# stage metrics of the spark status rest api, summed over all attempts of the stages of a job group
+STAGE_METRIC_COLS = {
+    "inputBytes": "INPUT_BYTES",
+    "shuffleReadBytes": "SHUFFLE_READ_BYTES",
+    "shuffleWriteBytes": "SHUFFLE_WRITE_BYTES",
+    "memoryBytesSpilled": "MEMORY_SPILL_BYTES",
+    "diskBytesSpilled": "DISK_SPILL_BYTES",
+}
+
+
+def get_job_group_metrics(job_group: str) -> dict:
+    """
+    Collect the job, stage and task counts of all jobs tagged with job_group from the status tracker, and their input, shuffle and spill bytes
+    from the status rest api of the spark ui. The byte metrics are None when the spark ui is disabled or unreachable
+    """
+    sc = spark.sparkContext
+    tracker = sc.statusTracker()
+    job_ids = tracker.getJobIdsForGroup(job_group)
+    stage_ids = sorted(
+        {
+            stage_id
+            for job_id in job_ids
+            if tracker.getJobInfo(job_id) is not None
+            for stage_id in tracker.getJobInfo(job_id).stageIds
+        }
+    )
+    stage_infos = [tracker.getStageInfo(stage_id) for stage_id in stage_ids]
+    metrics = {
+        "NUM_JOBS": len(job_ids),
+        "NUM_STAGES": len(stage_ids),
+        "NUM_TASKS": sum(info.numCompletedTasks for info in stage_infos if info is not None),
+        "NUM_FAILED_TASKS": sum(info.numFailedTasks for info in stage_infos if info is not None),
+        **{col: None for col in STAGE_METRIC_COLS.values()},
+    }
+
+    if sc.uiWebUrl is None:
+        return metrics
+    try:
+        for col in STAGE_METRIC_COLS.values():
+            metrics[col] = 0
+        for stage_id in stage_ids:
+            url = f"{sc.uiWebUrl}/api/v1/applications/{sc.applicationId}/stages/{stage_id}?details=false"
+            with urllib.request.urlopen(url, timeout=10) as response:
+                for attempt in json.load(response):
+                    for metric, col in STAGE_METRIC_COLS.items():
+                        metrics[col] += attempt.get(metric, 0)
+    except (OSError, ValueError) as e:
+        print(f"stage metrics of {job_group} are not available: {e}")
+        for col in STAGE_METRIC_COLS.values():
+            metrics[col] = None
+    return metrics
+
+
+def run_instrumented_stage(
+    stage: str,
+    run_stage: Callable,
+    job_group_prefix: str,
+    pin: bool,
+    materialized_dfs: List[ps.DataFrame],
+    stage_reports: List[dict],
+    spark_conf: Optional[dict] = None,
+):
+    """
+    Run one pipeline stage with its spark jobs tagged by the job group "{job_group_prefix}_{stage}", and append its wall time, output rows
+    and job group metrics to stage_reports, also when the stage fails.
+    A df output is checked against the plan budget, and pinned by materialize() when pin is set, so that the stage's own jobs compute it.
+    The stage runs with the spark settings of spark_conf, which are recorded as json in SPARK_CONF.
+    Heavy join keys reported by skew_tolerant_join() during the stage are recorded as json in HEAVY_KEYS
+    """
+    sc = spark.sparkContext
+    job_group = f"{job_group_prefix}_{stage}"
+    sc.setJobGroup(job_group, stage)
+    STAGE_CONTEXT.heavy_keys = []
+    start_time = time.perf_counter()
+    status, row_num = "FAILED", None
+    try:
+        with stage_spark_conf(spark_conf or {}):
+            result = run_stage()
+            if isinstance(result, ps.DataFrame):
+                check_plan_budget(stage, result)
+                if pin:
+                    result, row_num = materialize(result, materialized_dfs)
+        status = "SUCCESS"
+    finally:
+        sc.setLocalProperty("spark.jobGroup.id", None)
+        sc.setLocalProperty("spark.job.description", None)
+        stage_reports.append(
+            {
+                "STAGE": stage,
+                "STATUS": status,
+                "WALL_SEC": round(time.perf_counter() - start_time, 3),
+                "ROWS": row_num,
+                **get_job_group_metrics(job_group),
+                "HEAVY_KEYS": json.dumps(STAGE_CONTEXT.heavy_keys) if STAGE_CONTEXT.heavy_keys else None,
+                "SPARK_CONF": json.dumps(spark_conf) if spark_conf else None,
+            }
+        )
+        STAGE_CONTEXT.heavy_keys = None
+    return result
+
+
+def save_run_report(stage_reports: List[dict], run_config: RunConfig, report_id: str) -> ps.DataFrame:
+    """
+    Append the stage reports of one pipeline run to RUN_REPORT_TABLE_NAME, and write them as json to RUN_REPORT_DIR
+    """
+    report_df = spark.createDataFrame(
+        [
+            {
+                "RUN_ID": RUN_ID,
+                "RUN_DT": run_config.run_dt,
+                "GAMES": ", ".join(run_config.game_list),
+                "RATE_VERSION": REVENUE_SHARE_VERSION,
+                **stage_report,
+            }
+            for stage_report in stage_reports
+        ],
+        RUN_REPORT_SCHEMA,
+    )
+    report_df.coalesce(1).write.mode("overwrite").json(str(Path(RUN_REPORT_DIR, f"{report_id}.json")))
+    report_df.write.mode("append").option("mergeSchema", "true").saveAsTable(RUN_REPORT_TABLE_NAME)
+    return report_df
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### Spark Tuning
+
+# COMMAND ----------
+
+def get_pipeline_parallelism() -> int:
+    """
+    Return the number of pipelines EXECUTION_MODE runs at a time on the shared spark session
+    """
+    if EXECUTION_MODE == ExecutionMode.PER_GAME_GROUP:
+        return GAME_PARALLELISM
+    if EXECUTION_MODE == ExecutionMode.BACKFILL:
+        return BACKFILL_PARALLELISM
+    return 1
+
+
+def get_tuning_history_df(run_config: RunConfig = RUN_CONFIG) -> pd.DataFrame:
+    """
+    Return the run report rows of the last TUNE_HISTORY_RUNS successful runs of every stage over the games of run_config
+    that have byte metrics, i.e. ran with the spark ui enabled
+    """
+    if not AUTO_TUNE_FLAG or not spark.catalog.tableExists(RUN_REPORT_TABLE_NAME):
+        return pd.DataFrame(columns=["STAGE", *STAGE_METRIC_COLS.values()])
+    metric_cols = ", ".join(STAGE_METRIC_COLS.values())
+    sql = f"""
+    select STAGE, {metric_cols}
+    from (
+        select *, row_number() over (partition by STAGE order by RUN_ID desc) as RUN_RANK
+        from {RUN_REPORT_TABLE_NAME}
+        where GAMES = '{", ".join(run_config.game_list)}' and STATUS = 'SUCCESS' and SHUFFLE_READ_BYTES is not null
+    )
+    where RUN_RANK <= {TUNE_HISTORY_RUNS}
+    """
+    return spark.sql(sql).toPandas()
+
+
+def get_stage_spark_conf(stage: str, tuning_history_df: pd.DataFrame) -> dict:
+    """
+    Return the spark settings to run stage with, from the run of tuning_history_df that shuffled the most in it, so that cached runs are not undersized:
+    - shuffle partitions of TUNE_PARTITION_BYTES each over its shuffle bytes and TUNE_HEADROOM, doubled when it spilled, within the partition bounds.
+      Adaptive execution coalesces them down to TUNE_PARTITION_BYTES when the data shrank, and splits skewed join partitions
+    - a broadcast threshold of TUNE_MAX_BROADCAST_BYTES when its input and shuffle bytes fit in it without spilling, so that none of its joins shuffles
+    STAGE_SPARK_CONF_OVERRIDES of the stage apply over the tuned settings.
+    Nothing is set while several pipelines run at a time, since the settings are shared by the whole session and the stages of concurrent game groups would overwrite them
+    """
+    if get_pipeline_parallelism() > 1:
+        return {}
+    spark_conf = {}
+    history_df = tuning_history_df[tuning_history_df["STAGE"] == stage]
+    if AUTO_TUNE_FLAG and len(history_df) > 0:
+        shuffle_bytes = history_df[["SHUFFLE_READ_BYTES", "SHUFFLE_WRITE_BYTES"]].max(axis=1)
+        largest = history_df.loc[shuffle_bytes.idxmax()]
+        largest_shuffle_bytes = shuffle_bytes.max() * TUNE_HEADROOM
+        spilled = largest["MEMORY_SPILL_BYTES"] > 0 or largest["DISK_SPILL_BYTES"] > 0
+        partition_num = math.ceil(largest_shuffle_bytes / TUNE_PARTITION_BYTES) * (2 if spilled else 1)
+        partition_num = min(max(partition_num, TUNE_MIN_SHUFFLE_PARTITIONS), TUNE_MAX_SHUFFLE_PARTITIONS)
+        spark_conf = {
+            "spark.sql.shuffle.partitions": str(partition_num),
+            "spark.sql.adaptive.enabled": "true",
+            "spark.sql.adaptive.coalescePartitions.enabled": "true",
+            "spark.sql.adaptive.coalescePartitions.initialPartitionNum": str(partition_num),
+            "spark.sql.adaptive.advisoryPartitionSizeInBytes": str(TUNE_PARTITION_BYTES),
+            "spark.sql.adaptive.skewJoin.enabled": "true",
+        }
+        if not spilled and largest["INPUT_BYTES"] + largest_shuffle_bytes <= TUNE_MAX_BROADCAST_BYTES:
+            spark_conf["spark.sql.autoBroadcastJoinThreshold"] = str(TUNE_MAX_BROADCAST_BYTES)
+        # executor memory is fixed when the cluster starts, so a stage spilling at the largest partition count is only reported
+        if largest["DISK_SPILL_BYTES"] > 0 and partition_num == TUNE_MAX_SHUFFLE_PARTITIONS:
+            print(f"{stage} spilled {largest['DISK_SPILL_BYTES']} bytes to disk at {partition_num} partitions, consider larger executors")
+    return {**spark_conf, **STAGE_SPARK_CONF_OVERRIDES.get(stage, {})}
+
+
+@contextmanager
+def stage_spark_conf(spark_conf: dict):
+    """
+    Set the spark settings of spark_conf on the session, and restore their previous values on exit
+    """
+    previous_conf = {key: spark.conf.get(key, None) for key in spark_conf}
+    for key, value in spark_conf.items():
+        spark.conf.set(key, value)
+    try:
+        yield
+    finally:
+        for key, value in previous_conf.items():
+            if value is None:
+                spark.conf.unset(key)
+            else:
+                spark.conf.set(key, value)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### Arrow Engine
+
+# COMMAND ----------
+
+def run_arrow_merge(run_config: RunConfig = RUN_CONFIG) -> Tuple[pa.Table, pa.Table]:
+    """
+    Compute the published campaign and channel details of run_config in process on duckdb, from the parquet copies of the source tables under ARROW_SOURCE_DIR
+    """
+    # duckdb is only needed by the arrow engine
+    from Arrow_Merge_Engine import run_merge
+
+    return run_merge(
+        ARROW_SOURCE_DIR,
+        run_config.game_list,
+        run_config.market_list,
+        run_config.compute_start_dt,
+        run_config.end_dt,
+        run_config.skan_end_dt,
+        FACT_PROMO_FILTER_COND,
+        SKAN_FILTER_COND,
+        # one rate table serves every stage, and the skan stage joins the IT rates
+        get_revenue_share_rates(run_config._replace(market_list=tuple(sorted({*run_config.market_list, "IT"})))),
+        CHANNEL_ALIASES,
+        get_metrics(run_config.metric_horizons),
+    )
+
+
+def get_arrow_campaign_and_channel_details(
+    run_config: RunConfig = RUN_CONFIG,
+) -> Tuple[ps.DataFrame, ps.DataFrame]:
+    """
+    Run run_arrow_merge() and hand its result to spark for QA and publishing
+    """
+    return tuple(spark.createDataFrame(table.to_pandas()) for table in run_arrow_merge(run_config))
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### Main Function
+
+# COMMAND ----------
+
+def merge_skan_performance_channel_details(
+    run_config: RunConfig = RUN_CONFIG, materialized_dfs: Optional[List[ps.DataFrame]] = None
+) -> Tuple[ps.DataFrame, ps.DataFrame]:
+    """
+    Compute, QA and publish the campaign and channel details of run_config, and return them.
+    The stage outputs pinned by the run are released before it returns, unless materialized_dfs is given: they are then appended to it,
+    so that the caller releases them with release_materialized() after its last action on the returned dfs
+    """
+    report_id = f"{RUN_ID}_{uuid.uuid4().hex[:8]}"
+    release_on_return = materialized_dfs is None
+    materialized_dfs = [] if release_on_return else materialized_dfs
+    stage_reports = []
+    tuning_history_df = get_tuning_history_df(run_config)
+
+    def instrument(
+        stage: str,
+        run_stage: Callable,
+        pin: bool = INSTRUMENT_STAGES,
+        fingerprint: Optional[str] = None,
+    ):
+        if fingerprint is not None:
+            compute_stage = run_stage
+            run_stage = lambda: load_or_compute_stage(stage, compute_stage, fingerprint)
+        return run_instrumented_stage(
+            stage,
+            run_stage,
+            f"skan_performance_{report_id}",
+            pin,
+            materialized_dfs,
+            stage_reports,
+            get_stage_spark_conf(stage, tuning_history_df) if pin else None,
+        )
+
+    try:
+        if ENGINE == Engine.ARROW:
+            # the channel details are rolled up below with the other grains
+            campaign_details_df, _ = instrument(
+                "run_arrow_merge", lambda: get_arrow_campaign_and_channel_details(run_config)
+            )
+            complete_fingerprint = None
+        else:
+            # the skan stage reads the frame kept by the streaming mode with SKAN_STREAM_FLAG
+            skan_table_name = SKAN_STREAM_TABLE_NAME if SKAN_STREAM_FLAG else SKAN_LTV_TABLE_NAME
+            source_versions = get_source_versions(
+                [FACT_PROMO_TABLE_NAME, INSTALL_TABLE_NAME, INDIVIDUAL_LTV_TABLE_NAME, skan_table_name]
+            )
+
+            def get_versions(*table_names: str) -> dict:
+                return {table_name: source_versions.get(table_name) for table_name in table_names}
+
+            # get campaign details
+            without_sub_fingerprint = get_stage_fingerprint(
+                get_campaign_without_sub_ltv,
+                get_window_fingerprint_parts(
+                    run_config, run_config.end_dt, run_config.market_list, ["IAP_RATE", "AD_RATE", "SUB_RATE"]
+                ),
+                get_versions(FACT_PROMO_TABLE_NAME),
+                [],
+            )
+            campaign_without_sub_pltv_df = instrument(
+                "get_campaign_without_sub_ltv",
+                lambda: get_campaign_without_sub_ltv(run_config),
+                fingerprint=without_sub_fingerprint,
+            )
+            sub_fingerprint = get_stage_fingerprint(
+                get_campaign_sub_ltv,
+                get_window_fingerprint_parts(run_config, run_config.end_dt, run_config.market_list, ["SUB_LTV_RATE"]),
+                get_versions(INSTALL_TABLE_NAME, INDIVIDUAL_LTV_TABLE_NAME),
+                [],
+            )
+            campaign_sub_pltv_df = instrument(
+                "get_campaign_sub_ltv",
+                lambda: get_campaign_sub_ltv(run_config),
+                fingerprint=sub_fingerprint,
+            )
+            details_fingerprint = get_stage_fingerprint(
+                get_campaign_details, {}, {}, [without_sub_fingerprint, sub_fingerprint]
+            )
+            campaign_details_df = instrument(
+                "get_campaign_details",
+                lambda: get_campaign_details(campaign_without_sub_pltv_df, campaign_sub_pltv_df),
+                fingerprint=details_fingerprint,
+            )
+
+            # get skan channel details
+            skan_fingerprint = get_stage_fingerprint(
+                get_skan_campaign_ltv,
+                get_window_fingerprint_parts(run_config, run_config.skan_end_dt, ["IT"], ["IAP_RATE"]),
+                get_versions(skan_table_name),
+                [],
+            )
+            skan_campaign_ltv_df = instrument(
+                "get_skan_campaign_ltv",
+                lambda: get_skan_campaign_ltv(run_config),
+                fingerprint=skan_fingerprint,
+            )
+
+            # Join SKAN with Non-SKAN to Get Complete LTV Info
+            complete_fingerprint = get_stage_fingerprint(
+                get_complete_campaign_details, {}, {}, [details_fingerprint, skan_fingerprint]
+            )
+            campaign_details_df = instrument(
+                "get_complete_campaign_details",
+                lambda: get_complete_campaign_details(campaign_details_df, skan_campaign_ltv_df),
+                pin=True,
+                fingerprint=complete_fingerprint,
+            )
+            # the upstream stages are only read by get_complete_campaign_details(), whose output is now pinned
+            release_materialized(materialized_dfs, keep=[campaign_details_df])
+
+        # roll campaign_details_df up to the channel, game, week and month grains in one aggregation.
+        # Backfill chunks cut weeks and months, whose rollups are refreshed by run_backfill() once all chunks are done
+        rollups = DAY_ROLLUPS if run_config.is_backfill_chunk else DAY_ROLLUPS + PERIOD_ROLLUPS
+        # the published campaign rows completing the first week and month are outside the window, which no run rewrites, so they are not fingerprinted
+        rollup_fingerprint = get_stage_fingerprint(
+            get_rollups,
+            {
+                "game_list": sorted(run_config.game_list),
+                "compute_start_dt": run_config.compute_start_dt,
+                "rollups": [rollup.name for rollup in rollups],
+            },
+            {},
+            [complete_fingerprint],
+        )
+        rollup_df = instrument(
+            "get_rollups",
+            lambda: get_rollups(campaign_details_df, rollups, run_config),
+            pin=True,
+            fingerprint=rollup_fingerprint,
+        )
+        rollup_dfs = {rollup: get_rollup_df(rollup_df, rollup) for rollup in rollups}
+        channel_details_df = rollup_dfs[CHANNEL_DAY_ROLLUP]
+
+        # the rollup fingerprint covers the campaign details, so an unchanged one that was already published leaves nothing to do
+        # the merge window and the snapshots written depend on the run, and dated full copies on its run date as well
+        save_run_config_parts = {
+            "game_list": sorted(run_config.game_list),
+            "compute_start_dt": run_config.compute_start_dt,
+            "is_backfill_chunk": run_config.is_backfill_chunk,
+            "metric_horizons": run_config.metric_horizons,
+            "market_list": sorted(run_config.market_list),
+        }
+        if SNAPSHOT_MODE == SnapshotMode.FULL_COPY:
+            save_run_config_parts["run_dt"] = run_config.run_dt
+        save_fingerprint = get_stage_fingerprint(save_result, save_run_config_parts, {}, [rollup_fingerprint])
+        if STAGE_CACHE_FLAG and save_fingerprint is not None and is_stage_cached("save_result", save_fingerprint):
+            print(f"nothing changed upstream since {save_fingerprint} was published, skipping qa and save")
+            return campaign_details_df, channel_details_df
+
+        # qa
+        instrument(
+            "qa_result",
+            lambda: qa_result(
+                get_old_game_details_df(run_config),
+                aggregate_to_game_details(rollup_dfs[GAME_DAY_ROLLUP]),
+            ),
+        )
+
+        # save result. A run over a subset of the metric horizons would drop the other metrics from the published tables
+        if SAVE_FLAG and run_config.metric_horizons is not None:
+            print(f"not publishing, the run only computed the metric horizons {run_config.metric_horizons}")
+        elif SAVE_FLAG:
+            instrument(
+                "save_result",
+                lambda: save_result(campaign_details_df, channel_details_df, run_config, rollup_dfs),
+            )
+            if STAGE_CACHE_FLAG and save_fingerprint is not None:
+                mark_stage_cached("save_result", save_fingerprint)
+    finally:
+        if release_on_return:
+            release_materialized(materialized_dfs)
+        # a failing report write must not mask the outcome of the run
+        try:
+            save_run_report(stage_reports, run_config, report_id)
+        except Exception as e:
+            print(f"run report {report_id} was not saved: {e}")
+
+    return campaign_details_df, channel_details_df
+
+
+class GameGroupError(Exception):
+    def __init__(self, failed_report_df: pd.DataFrame):
+        self.failed_report_df = failed_report_df
+        super().__init__()
+
+    def __str__(self):
+        msg = f"{len(self.failed_report_df)} game groups failed:"
+        for _, row in self.failed_report_df.iterrows():
+            msg += f"""
+        {row["GAMES"]} in pool {row["POOL"]}: {row["ERROR"]}"""
+        return msg
+
+
+def merge_skan_performance_by_game_group() -> pd.DataFrame:
+    """
+    Run merge_skan_performance_channel_details() for every group of GAME_GROUPS as an independent pipeline, up to GAME_PARALLELISM at a time.
+    Each group runs in its own driver thread and fair-scheduler pool and only overwrites its own partitions, so a failing group does not block the others from publishing.
+    Return one report row per group, and raise a GameGroupError for the failed groups once all groups are done
+    """
+    game_groups = GAME_GROUPS or [[game] for game in GAME_LIST]
+
+    def run_game_group(group_id: int, game_list: List[str]) -> dict:
+        pool_name = f"skan_performance_{group_id}"
+        spark.sparkContext.setLocalProperty("spark.scheduler.pool", pool_name)
+        start_time = datetime.now()
+        status, error = "SUCCESS", None
+        try:
+            merge_skan_performance_channel_details(RUN_CONFIG._replace(game_list=game_list))
+        except Exception as e:
+            status, error = "FAILED", f"{type(e).__name__}: {e}"
+        finally:
+            spark.sparkContext.setLocalProperty("spark.scheduler.pool", None)
+        return {
+            "POOL": pool_name,
+            "GAMES": ", ".join(game_list),
+            "STATUS": status,
+            "ERROR": error,
+            "DURATION_SEC": (datetime.now() - start_time).total_seconds(),
+        }
+
+    with ThreadPoolExecutor(max_workers=GAME_PARALLELISM) as executor:
+        reports = list(executor.map(run_game_group, range(len(game_groups)), game_groups))
+    report_df = pd.DataFrame(reports)
+
+    failed_report_df = report_df[report_df["STATUS"] == "FAILED"]
+    if len(failed_report_df) > 0:
+        raise GameGroupError(failed_report_df)
+    return report_df
+
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### Backfill
+
+# COMMAND ----------
+
+BACKFILL_LEDGER_SCHEMA = """
+    BACKFILL_ID string, CHUNK_START_DT string, CHUNK_END_DT string, GAMES string, STATUS string, ERROR string,
+    DURATION_SEC double, RUN_ID string, FINISHED_AT timestamp
+"""
+
+
+class BackfillError(Exception):
+    def __init__(self, failed_report_df: pd.DataFrame):
+        self.failed_report_df = failed_report_df
+        super().__init__()
+
+    def __str__(self):
+        msg = f"{len(self.failed_report_df)} backfill chunks of {BACKFILL_ID} failed, rerun to retry them:"
+        for _, row in self.failed_report_df.iterrows():
+            msg += f"""
+        {row["CHUNK_START_DT"]} to {row["CHUNK_END_DT"]}: {row["ERROR"]}"""
+        return msg
+
+
+def get_first_of_month(dt: date, months: int = 0) -> date:
+    """
+    Return the first day of the month that is the given number of months after the month of dt
+    """
+    month_num = dt.year * 12 + dt.month - 1 + months
+    return date(month_num // 12, month_num % 12 + 1, 1)
+
+
+def get_backfill_chunks(run_config: RunConfig = RUN_CONFIG) -> List[RunConfig]:
+    """
+    Split the install dates of run_config into consecutive chunks of BACKFILL_CHUNK_MONTHS calendar months, each one a run config of its own
+    """
+    chunks = []
+    chunk_start_date = datetime.strptime(run_config.compute_start_dt, DATE_FORMAT).date()
+    last_date = datetime.strptime(run_config.skan_end_dt, DATE_FORMAT).date()
+    while chunk_start_date <= last_date:
+        chunk_end_date = min(
+            get_first_of_month(chunk_start_date, BACKFILL_CHUNK_MONTHS) - timedelta(days=1), last_date
+        )
+        chunk_start_dt = datetime.strftime(chunk_start_date, DATE_FORMAT)
+        chunk_end_dt = datetime.strftime(chunk_end_date, DATE_FORMAT)
+        chunks.append(
+            run_config._replace(
+                compute_start_dt=chunk_start_dt,
+                end_dt=min(chunk_end_dt, run_config.end_dt),
+                skan_end_dt=chunk_end_dt,
+                is_backfill_chunk=True,
+            )
+        )
+        chunk_start_date = chunk_end_date + timedelta(days=1)
+    return chunks
+
+
+def get_completed_chunks() -> set:
+    """
+    Return the (CHUNK_START_DT, CHUNK_END_DT, GAMES) of every chunk of BACKFILL_ID that the ledger records as done
+    """
+    sql = f"select CHUNK_START_DT, CHUNK_END_DT, GAMES from {BACKFILL_LEDGER_TABLE_NAME} where BACKFILL_ID = '{BACKFILL_ID}' and STATUS = 'SUCCESS'"
+    return {tuple(row) for row in spark.sql(sql).collect()}
+
+
+def refresh_period_rollups(run_config: RunConfig = RUN_CONFIG) -> None:
+    """
+    Recompute the week and month rollups of run_config from the published campaign table, and publish them
+    """
+    campaign_df = get_published_campaign_df(
+        run_config.game_list, run_config.compute_start_dt, run_config.skan_end_dt
+    )
+    rollup_df = get_rollups(campaign_df, PERIOD_ROLLUPS, run_config)
+    publish_rollups({rollup: get_rollup_df(rollup_df, rollup) for rollup in PERIOD_ROLLUPS}, run_config)
+
+
+def run_backfill(run_config: RunConfig = RUN_CONFIG) -> pd.DataFrame:
+    """
+    Recompute run_config chunk by chunk, up to BACKFILL_PARALLELISM chunks at a time, each in its own driver thread and fair-scheduler pool.
+    Every finished chunk is appended to the ledger, and chunks the ledger already records as done are skipped, so a rerun resumes where the last one stopped.
+    Return one report row per chunk run, and raise a BackfillError for the failed chunks once all chunks are done.
+    Once all chunks succeeded, the week and month rollups of the whole backfill are refreshed
+    """
+    # the ledger is created before the chunks run, since concurrent first appends would race to create it
+    if not spark.catalog.tableExists(BACKFILL_LEDGER_TABLE_NAME):
+        spark.createDataFrame([], BACKFILL_LEDGER_SCHEMA).write.saveAsTable(BACKFILL_LEDGER_TABLE_NAME)
+    games = ", ".join(run_config.game_list)
+    chunks = get_backfill_chunks(run_config)
+    completed_chunks = get_completed_chunks()
+    pending_chunks = [
+        chunk
+        for chunk in chunks
+        if (chunk.compute_start_dt, chunk.skan_end_dt, games) not in completed_chunks
+    ]
+    print(f"{BACKFILL_ID}: {len(chunks) - len(pending_chunks)} of {len(chunks)} chunks already done")
+
+    def run_chunk(chunk_id: int, chunk: RunConfig) -> dict:
+        spark.sparkContext.setLocalProperty("spark.scheduler.pool", f"skan_performance_backfill_{chunk_id}")
+        start_time = datetime.now()
+        status, error = "SUCCESS", None
+        try:
+            merge_skan_performance_channel_details(chunk)
+        except Exception as e:
+            status, error = "FAILED", f"{type(e).__name__}: {e}"
+        finally:
+            spark.sparkContext.setLocalProperty("spark.scheduler.pool", None)
+        report = {
+            "BACKFILL_ID": BACKFILL_ID,
+            "CHUNK_START_DT": chunk.compute_start_dt,
+            "CHUNK_END_DT": chunk.skan_end_dt,
+            "GAMES": games,
+            "STATUS": status,
+            "ERROR": error,
+            "DURATION_SEC": (datetime.now() - start_time).total_seconds(),
+            "RUN_ID": RUN_ID,
+            "FINISHED_AT": datetime.now(),
+        }
+        spark.createDataFrame([report], BACKFILL_LEDGER_SCHEMA).write.mode("append").saveAsTable(
+            BACKFILL_LEDGER_TABLE_NAME
+        )
+        return report
+
+    with ThreadPoolExecutor(max_workers=BACKFILL_PARALLELISM) as executor:
+        reports = list(executor.map(run_chunk, range(len(pending_chunks)), pending_chunks))
+    report_df = pd.DataFrame(
+        reports, columns=[col.split()[0] for col in BACKFILL_LEDGER_SCHEMA.split(",")]
+    )
+
+    failed_report_df = report_df[report_df["STATUS"] == "FAILED"]
+    if len(failed_report_df) > 0:
+        raise BackfillError(failed_report_df)
+    if SAVE_FLAG:
+        refresh_period_rollups(run_config)
+    return report_df
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ### SKAN Streaming
+
+# COMMAND ----------
+
+def upsert_into_table(df: ps.DataFrame, table_name: str, key_cols: List[str]) -> None:
+    """
+    Upsert df into table_name by key_cols, creating the table on the first call
+    """
+    if not spark.catalog.tableExists(table_name):
+        df.write.saveAsTable(table_name)
+        return
+    view_name = f"upserts_{table_name.replace('.', '_')}_{uuid.uuid4().hex}"
+    df.createOrReplaceTempView(view_name)
+    on_cond = " and ".join(f"t.{col} <=> s.{col}" for col in key_cols)
+    spark.sql(
+        f"""
+merge into {table_name} t
+using {view_name} s
+on {on_cond}
+when matched then update set *
+when not matched then insert *
+  """
+    )
+    spark.catalog.dropTempView(view_name)
+
+
+def get_skan_stream_df(run_config: RunConfig = RUN_CONFIG) -> ps.DataFrame:
+    """
+    Return the streaming aggregation of ua.skan_ltv, or of the parquet files under SKAN_STREAM_SOURCE_DIR, into the SKAN frame of get_skan_campaign_ltv().
+    Its state holds the running totals of every campaign key, and each micro-batch emits the keys whose totals it changed.
+    Every new row is added to the totals, so only appends to ua.skan_ltv are streamed
+    """
+    if SKAN_STREAM_SOURCE_DIR is None:
+        # commits that update or delete rows in place, e.g. a restatement of postbacks, are skipped instead of failing the stream.
+        # Their changes reach the published tables only through a daily run without SKAN_STREAM_FLAG, which rescans ua.skan_ltv
+        source_df = spark.readStream.option("skipChangeCommits", "true").table(SKAN_LTV_TABLE_NAME)
+    else:
+        # parquet files are picked up anywhere under the directory, e.g. in the directory of part files written by one spark job
+        source_df = (
+            spark.readStream.schema(spark.table(SKAN_LTV_TABLE_NAME).schema)
+            .option("recursiveFileLookup", "true")
+            .parquet(SKAN_STREAM_SOURCE_DIR)
+        )
+    # the install date is the event time, which the aggregation groups by, so that the state of final install dates is dropped
+    source_df = source_df.withColumn("INSTALL_DT", F.col("INSTALL_DT").cast("timestamp")).withWatermark(
+        "INSTALL_DT", f"{SKAN_STREAM_WATERMARK_DAYS} days"
+    )
+    source_view_name = f"skan_ltv_stream_{uuid.uuid4().hex}"
+    source_df.createOrReplaceTempView(source_view_name)
+    # postbacks of the current day are aggregated as they land, and published once the day is over, see refresh_skan_stream_batch()
+    stream_run_config = run_config._replace(compute_start_dt=START_DT, skan_end_dt="9999-12-31", metric_horizons=None)
+    skan_campaign_ltv_df = get_skan_campaign_ltv(stream_run_config, source_view_name)
+    return skan_campaign_ltv_df.withColumn("CALENDAR_DT", F.col("CALENDAR_DT").cast("date"))
+
+
+def get_run_config_as_of(run_config: RunConfig, run_dt: date) -> RunConfig:
+    """
+    Return run_config with the run date and the last mmp and skan install dates of a daily run on run_dt
+    """
+    return run_config._replace(
+        run_dt=run_dt,
+        end_dt=datetime.strftime(run_dt - timedelta(days=REPORT_DELAY_DAYS), DATE_FORMAT),
+        skan_end_dt=datetime.strftime(run_dt - timedelta(days=1), DATE_FORMAT),
+    )
+
+
+def get_date_runs(dates: List[date]) -> List[Tuple[date, date]]:
+    """
+    Return the first and last day of each run of consecutive days in dates
+    """
+    date_runs = []
+    for dt in sorted(set(dates)):
+        if date_runs and dt - date_runs[-1][1] == timedelta(days=1):
+            date_runs[-1] = (date_runs[-1][0], dt)
+        else:
+            date_runs.append((dt, dt))
+    return date_runs
+
+
+def refresh_skan_stream_batch(skan_update_df: ps.DataFrame, batch_id: int, run_config: RunConfig = RUN_CONFIG) -> None:
+    """
+    Upsert the SKAN totals updated by a micro-batch into SKAN_STREAM_TABLE_NAME, and recompute the IT campaign details of every run of consecutive install dates
+    they touch in a game, with their organic adjustment and channel and game rollups. SKAN rows are all IT, and the organic row of an IT install date
+    subtracts all of its paid campaigns, so no narrower rows can be recomputed. Installs after the run's skan_end_dt are left to the next day, like the daily run does.
+    Each window is published like a backfill chunk: merged into the tables, without a snapshot, and with the week and month rollups left to the daily run.
+    QA is left to the daily run as well. The stream runs for days, so the run dates of run_config are those of the day the batch runs,
+    and the mmp rows are recomputed up to the same date as the daily run's
+    """
+    skan_update_df = skan_update_df.persist()
+    try:
+        touched_rows = skan_update_df.select("APPLICATION_FAMILY_NAME", "CALENDAR_DT").distinct().collect()
+        if not touched_rows:
+            return
+        upsert_into_table(skan_update_df, SKAN_STREAM_TABLE_NAME, SKAN_CAMPAIGN_KEY_COLS)
+    finally:
+        skan_update_df.unpersist()
+
+    run_config = get_run_config_as_of(run_config, date.today())
+    skan_end_date = datetime.strptime(run_config.skan_end_dt, DATE_FORMAT).date()
+    game_dates = {}
+    for row in touched_rows:
+        if row.CALENDAR_DT <= skan_end_date:
+            game_dates.setdefault(row.APPLICATION_FAMILY_NAME, []).append(row.CALENDAR_DT)
+    for game, start_dt, skan_end_dt in [
+        (game, *(datetime.strftime(dt, DATE_FORMAT) for dt in date_run))
+        for game, dates in sorted(game_dates.items())
+        for date_run in get_date_runs(dates)
+    ]:
+        game_run_config = run_config._replace(
+            game_list=[game],
+            market_list=("IT",),
+            compute_start_dt=start_dt,
+            end_dt=min(skan_end_dt, run_config.end_dt),
+            skan_end_dt=skan_end_dt,
+            is_backfill_chunk=True,
+        )
+        print(f"skan stream batch {batch_id}: refreshing {game} from {start_dt} to {skan_end_dt}")
+        materialized_dfs = []
+        try:
+            campaign_details_df = get_campaign_details(
+                get_campaign_without_sub_ltv(game_run_config), get_campaign_sub_ltv(game_run_config)
+            )
+            skan_campaign_ltv_df = spark.table(SKAN_STREAM_TABLE_NAME).where(
+                (F.col("APPLICATION_FAMILY_NAME") == game) & F.col("CALENDAR_DT").between(start_dt, skan_end_dt)
+            )
+            campaign_details_df, _ = materialize(
+                get_complete_campaign_details(campaign_details_df, skan_campaign_ltv_df), materialized_dfs
+            )
+            rollup_df, _ = materialize(get_rollups(campaign_details_df, DAY_ROLLUPS, game_run_config), materialized_dfs)
+            rollup_dfs = {rollup: get_rollup_df(rollup_df, rollup) for rollup in DAY_ROLLUPS}
+            if SAVE_FLAG:
+                save_result(campaign_details_df, rollup_dfs[CHANNEL_DAY_ROLLUP], game_run_config, rollup_dfs)
+        finally:
+            release_materialized(materialized_dfs)
+
+
+def print_watermark_drops(progress: dict) -> None:
+    """
+    Print the rows that a micro-batch of the skan streaming query dropped as later than the watermark, from the query's progress.
+    The rows are counted after the partial aggregation that runs before the state, so each is at least one late ua.skan_ltv row of a campaign key
+    """
+    dropped_row_num = sum(state_operator["numRowsDroppedByWatermark"] for state_operator in progress["stateOperators"])
+    print(
+        f"skan stream batch {progress['batchId']}: {dropped_row_num} rows dropped, "
+        f"with install dates over {SKAN_STREAM_WATERMARK_DAYS} days before the latest"
+    )
+
+
+class SkanStreamProgressListener(StreamingQueryListener):
+    """
+    Print the rows dropped by the watermark after every micro-batch of the skan streaming query named query_name
+    """
+
+    def __init__(self, query_name: str):
+        self.query_name = query_name
+
+    def onQueryStarted(self, event):
+        pass
+
+    def onQueryProgress(self, event):
+        progress = json.loads(event.progress.json)
+        if progress["name"] == self.query_name:
+            print_watermark_drops(progress)
+
+    def onQueryIdle(self, event):
+        pass
+
+    def onQueryTerminated(self, event):
+        pass
+
+
+def run_skan_stream(run_config: RunConfig = RUN_CONFIG, available_now: bool = False):
+    """
+    Start the skan streaming query, which resumes from SKAN_STREAM_CHECKPOINT_DIR and runs refresh_skan_stream_batch() every SKAN_STREAM_TRIGGER_MINUTES.
+    With available_now, process the rows that landed so far and return once they are published, e.g. for a scheduled job or a local test.
+    Changing the metrics or revenue share rates needs a new checkpoint dir and SKAN_STREAM_TABLE_NAME, since the state holds totals with the rates applied
+    """
+    # the state holds every campaign key since START_DT, which rocksdb keeps off the jvm heap
+    spark.conf.set(
+        "spark.sql.streaming.stateStore.providerClass",
+        "org.apache.spark.sql.execution.streaming.state.RocksDBStateStoreProvider",
+    )
+    query_name = f"skan_stream_{uuid.uuid4().hex}"
+    writer = (
+        get_skan_stream_df(run_config)
+        .writeStream.queryName(query_name)
+        .outputMode("update")
+        .option("checkpointLocation", SKAN_STREAM_CHECKPOINT_DIR)
+        .foreachBatch(lambda skan_update_df, batch_id: refresh_skan_stream_batch(skan_update_df, batch_id, run_config))
+    )
+    if available_now:
+        query = writer.trigger(availableNow=True).start()
+        query.awaitTermination()
+        # the progress of every micro-batch is kept by the finished query, so no listener is left registered
+        for progress in query.recentProgress:
+            print_watermark_drops(progress)
+    else:
+        spark.streams.addListener(SkanStreamProgressListener(query_name))
+        query = writer.trigger(processingTime=f"{SKAN_STREAM_TRIGGER_MINUTES} minutes").start()
+    return query
+
+# COMMAND ----------
+
+if ENVIRONMENT == Environment.PRODUCTION:
+    if EXECUTION_MODE == ExecutionMode.PER_GAME_GROUP:
+        display(merge_skan_performance_by_game_group())
+    elif EXECUTION_MODE == ExecutionMode.BACKFILL:
+        display(run_backfill())
+    elif EXECUTION_MODE == ExecutionMode.SKAN_STREAMING:
+        run_skan_stream().awaitTermination()
+    else:
+        materialized_dfs = []
+        try:
+            campaign_details_df, channel_details_df = merge_skan_performance_channel_details(
+                materialized_dfs=materialized_dfs
+            )
+            display(channel_details_df)
+        finally:
+            release_materialized(materialized_dfs)
+
+    # the retained versions are vacuumed once, after every pipeline of the run has published
+    if SAVE_FLAG and PUBLISH_MODE == PublishMode.VERSIONED_TABLE:
+        vacuum_published_tables()
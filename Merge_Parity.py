@@ -0,0 +1,43 @@
+"""
+Comparison of two published details dfs, shared by the tests and by check_arrow_parity() in Benchmark_Merge_Pipeline.py.
+It only needs pandas, so the tests comparing two spark runs do not depend on the arrow engine
+"""
+
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+
+def get_parity_violations(
+    expected_df: pd.DataFrame, actual_df: pd.DataFrame, key_cols: List[str], rtol: float = 1e-5
+) -> pd.DataFrame:
+    """
+    Compare two published details dfs by key_cols, with metrics summed per key, and return one row per key that is missing from either side
+    or whose metrics differ by more than rtol, with a VIOLATION column describing why.
+    The metrics are the numeric columns of expected_df outside key_cols
+    """
+    metric_cols = [col for col in expected_df.select_dtypes("number").columns if col not in key_cols]
+
+    def sum_by_key(df: pd.DataFrame) -> pd.DataFrame:
+        return (
+            df.assign(ROW_NUM=1, CALENDAR_DT=pd.to_datetime(df["CALENDAR_DT"]))
+            .groupby(key_cols, dropna=False)[["ROW_NUM", *metric_cols]]
+            .sum(min_count=1)
+            .reset_index()
+        )
+
+    comp_df = sum_by_key(expected_df).merge(
+        sum_by_key(actual_df), on=key_cols, how="outer", suffixes=("_EXPECTED", "_ACTUAL"), indicator=True
+    )
+    violations = pd.Series("", index=comp_df.index)
+    violations[comp_df["_merge"] == "left_only"] = "missing; "
+    violations[comp_df["_merge"] == "right_only"] = "unexpected; "
+    for col in ["ROW_NUM", *metric_cols]:
+        expected, actual = comp_df[f"{col}_EXPECTED"], comp_df[f"{col}_ACTUAL"]
+        differs = (comp_df["_merge"] == "both") & ~np.isclose(
+            expected.astype(float), actual.astype(float), rtol=rtol, atol=1e-3, equal_nan=True
+        )
+        violations[differs] += f"{col} differs; "
+    comp_df["VIOLATION"] = violations.str.rstrip("; ")
+    return comp_df[comp_df["VIOLATION"] != ""].drop(columns="_merge").reset_index(drop=True)
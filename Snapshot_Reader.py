@@ -0,0 +1,340 @@
+"""
+Read slices of the daily parquet snapshots written by save_result() in Daily_Merge_Table_Update.py, without a Spark session.
+In changes mode the snapshots are laid out as <save_dir>/snapshots/<kind>_{base,changes}.parquet/SNAPSHOT_DT=<yyyy-mm-dd>/APPLICATION_FAMILY_NAME=<game>/,
+see write_snapshot_changes(), and the snapshot of a day is reconstructed from the latest base of each game and the changes written since.
+In full-copy mode they are laid out as <save_dir>/<kind>_<yyyy-mm-dd>.parquet/APPLICATION_FAMILY_NAME=<game>/, see CHANNEL_PARQUET_PATH and CAMPAIGN_PARQUET_PATH,
+and every snapshot holds the whole published history of its games.
+Either way a read only opens the partitions of its games, and skips the row groups outside its dates and channels by their statistics.
+Recently read slices are kept in memory, and a slice can be exported as an Arrow IPC file to be memory-mapped later.
+
+Snapshots are only written in parquet-and-table mode.
+
+Usage:
+    python Snapshot_Reader.py --save-dir /dbfs/mnt/... --game "Harry Potter" --channel Facebook --start-dt 2024-01-01 --output hp.arrow
+
+    reader = SnapshotReader("/dbfs/mnt/...")
+    table = reader.read("channel", games=["Harry Potter"], channels=["Facebook"], start_dt="2024-01-01")
+    changes = reader.read_changes("channel", since_dt="2024-06-01")
+"""
+
+import argparse
+import re
+import threading
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+from collections import OrderedDict
+from datetime import date, datetime
+from pathlib import Path
+from typing import List, Optional, Union
+
+SNAPSHOT_KINDS = ["channel", "campaign"]
+DATE_FORMAT = "%Y-%m-%d"
+# snapshots are always partitioned by game, see apply_table_layout(). The values are read as strings, whatever they look like
+SNAPSHOT_PARTITIONING = ds.HivePartitioning.discover(
+    schema=pa.schema([("APPLICATION_FAMILY_NAME", pa.string())])
+)
+SNAPSHOT_STORE_PARTITIONING = ds.HivePartitioning.discover(
+    schema=pa.schema([("SNAPSHOT_DT", pa.string()), ("APPLICATION_FAMILY_NAME", pa.string())])
+)
+CHANNEL_KEY_COLS = ["APPLICATION_FAMILY_NAME", "MARKET_CD", "SOURCE", "USER_SOURCE_TYPE_CD", "CHANNEL_NAME", "CALENDAR_DT"]
+SNAPSHOT_KEY_COLS = {"channel": CHANNEL_KEY_COLS, "campaign": CHANNEL_KEY_COLS + ["PROMOTION_NAME"]}
+DEFAULT_CACHE_BYTES = 512 * 1024 * 1024
+
+
+def to_date(value: Union[str, date, None]) -> Optional[date]:
+    if isinstance(value, str):
+        return datetime.strptime(value, DATE_FORMAT).date()
+    return value
+
+
+def and_all(exprs: List[Optional[ds.Expression]]) -> Optional[ds.Expression]:
+    """
+    Return the conjunction of the expressions of exprs that are not None, or None when there is none
+    """
+    result = None
+    for expr in exprs:
+        if expr is not None:
+            result = expr if result is None else result & expr
+    return result
+
+
+def or_all(exprs: List[ds.Expression]) -> ds.Expression:
+    result = pc.scalar(False)
+    for expr in exprs:
+        result = result | expr
+    return result
+
+
+def write_arrow_ipc(table: pa.Table, path: str) -> None:
+    """
+    Write table as an uncompressed Arrow IPC file, which open_arrow_ipc() maps without copying it into memory
+    """
+    with pa.OSFile(str(path), "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+
+
+def open_arrow_ipc(path: str) -> pa.Table:
+    """
+    Memory-map an Arrow IPC file written by write_arrow_ipc(). The table's buffers point into the file, so it is read lazily by the os
+    """
+    with pa.memory_map(str(path), "r") as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+class SnapshotReader:
+    """
+    Reader of the snapshots under save_dir, with an LRU cache of the slices it read of up to cache_bytes in total.
+    A cached slice is only reused while the part files it was read from are unchanged, since a rerun of the same day rewrites them
+    """
+
+    def __init__(self, save_dir: str, cache_bytes: int = DEFAULT_CACHE_BYTES):
+        self.save_dir = Path(save_dir)
+        self.cache_bytes = cache_bytes
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    def get_store_dataset(self, kind: str, store: str) -> Optional[ds.Dataset]:
+        """
+        Return the base or changes store of kind written in changes mode, or None when there is none
+        """
+        path = self.save_dir / "snapshots" / f"{kind}_{store}.parquet"
+        if not path.is_dir():
+            return None
+        dataset = ds.dataset(path, format="parquet", partitioning=SNAPSHOT_STORE_PARTITIONING)
+        return dataset if dataset.files else None
+
+    def get_base_dts(self, kind: str, snapshot_dt: date, games: Optional[List[str]] = None) -> dict:
+        """
+        Return the date of the latest base of kind on or before snapshot_dt of each of games, or of every game, from the partitions of the base store
+        """
+        base_dts = {}
+        base_dataset = self.get_store_dataset(kind, "base")
+        for fragment in base_dataset.get_fragments() if base_dataset else []:
+            keys = ds.get_partition_keys(fragment.partition_expression)
+            game, base_dt = keys["APPLICATION_FAMILY_NAME"], to_date(keys["SNAPSHOT_DT"])
+            if base_dt <= snapshot_dt and (games is None or game in games):
+                base_dts[game] = max(base_dts.get(game, base_dt), base_dt)
+        return base_dts
+
+    def get_snapshot_dates(self, kind: str = "channel") -> List[date]:
+        """
+        Return the dates of the snapshots of kind under save_dir, oldest first
+        """
+        if self.get_store_dataset(kind, "base") is not None:
+            return sorted(
+                {
+                    to_date(ds.get_partition_keys(fragment.partition_expression)["SNAPSHOT_DT"])
+                    for store in ["base", "changes"]
+                    if self.get_store_dataset(kind, store) is not None
+                    for fragment in self.get_store_dataset(kind, store).get_fragments()
+                }
+            )
+        pattern = re.compile(rf"{kind}_(\d{{4}}-\d{{2}}-\d{{2}})\.parquet")
+        return sorted(
+            to_date(match.group(1))
+            for match in map(pattern.fullmatch, (path.name for path in self.save_dir.iterdir()))
+            if match
+        )
+
+    def get_snapshot_path(self, kind: str = "channel", snapshot_dt: Union[str, date, None] = None) -> Path:
+        """
+        Return the path of the full-copy snapshot of kind written on snapshot_dt, or of the latest one
+        """
+        if snapshot_dt is None:
+            snapshot_dates = self.get_snapshot_dates(kind)
+            if not snapshot_dates:
+                raise FileNotFoundError(f"no {kind} snapshot under {self.save_dir}")
+            snapshot_dt = snapshot_dates[-1]
+        path = self.save_dir / f"{kind}_{to_date(snapshot_dt).strftime(DATE_FORMAT)}.parquet"
+        if not path.is_dir():
+            raise FileNotFoundError(f"no {kind} snapshot at {path}")
+        return path
+
+    def read(
+        self,
+        kind: str = "channel",
+        games: Optional[List[str]] = None,
+        start_dt: Union[str, date, None] = None,
+        end_dt: Union[str, date, None] = None,
+        channels: Optional[List[str]] = None,
+        columns: Optional[List[str]] = None,
+        snapshot_dt: Union[str, date, None] = None,
+    ) -> pa.Table:
+        """
+        Return the rows of the snapshot of kind as of snapshot_dt, the latest one by default, for the given games, channels and CALENDAR_DT range (both ends included),
+        with only the given columns. A filter left as None keeps every row
+        """
+        if kind not in SNAPSHOT_KINDS:
+            raise ValueError(f"kind must be one of {SNAPSHOT_KINDS}, not {kind}")
+        row_filter = self.get_row_filter(games, start_dt, end_dt, channels)
+        if self.get_store_dataset(kind, "base") is None:
+            dataset = ds.dataset(
+                self.get_snapshot_path(kind, snapshot_dt), format="parquet", partitioning=SNAPSHOT_PARTITIONING
+            )
+            scans = [(dataset, row_filter)]
+            snapshot_dt = None
+        else:
+            snapshot_dt = to_date(snapshot_dt) if snapshot_dt is not None else self.get_snapshot_dates(kind)[-1]
+            scans = self.get_store_scans(kind, snapshot_dt, games, row_filter)
+            if not scans:
+                raise FileNotFoundError(f"no {kind} base on or before {snapshot_dt} under {self.save_dir}")
+
+        # the part files of a partition get new names whenever it is rewritten, so they identify the data read
+        files = tuple(
+            sorted(fragment.path for dataset, scan_filter in scans for fragment in dataset.get_fragments(filter=scan_filter))
+        )
+        key = (kind, files, str(row_filter), snapshot_dt, tuple(columns) if columns is not None else None)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self._hits += 1
+                return self._cache[key]
+            self._misses += 1
+
+        if snapshot_dt is None:
+            table = scans[0][0].to_table(columns=columns, filter=row_filter)
+        else:
+            table = self.reconstruct(kind, scans)
+            table = table.select(columns if columns is not None else [col for col in table.column_names if col not in ["SNAPSHOT_DT", "CHANGE_TYPE"]])
+        self._put(key, table)
+        return table
+
+    def read_changes(
+        self,
+        kind: str = "channel",
+        since_dt: Union[str, date, None] = None,
+        until_dt: Union[str, date, None] = None,
+        games: Optional[List[str]] = None,
+        channels: Optional[List[str]] = None,
+    ) -> pa.Table:
+        """
+        Return the rows of kind written to the changes store from since_dt to until_dt (both ends included), i.e. what changed since the snapshot of the day before since_dt.
+        SNAPSHOT_DT is the day of each change, and CHANGE_TYPE is upsert for an inserted or changed row and delete for a deleted one
+        """
+        dataset = self.get_store_dataset(kind, "changes")
+        if dataset is None:
+            return pa.table({})
+        exprs = [self.get_row_filter(games, None, None, channels)]
+        if since_dt is not None:
+            exprs.append(pc.field("SNAPSHOT_DT") >= to_date(since_dt).strftime(DATE_FORMAT))
+        if until_dt is not None:
+            exprs.append(pc.field("SNAPSHOT_DT") <= to_date(until_dt).strftime(DATE_FORMAT))
+        return dataset.to_table(filter=and_all(exprs))
+
+    @staticmethod
+    def get_row_filter(
+        games: Optional[List[str]],
+        start_dt: Union[str, date, None],
+        end_dt: Union[str, date, None],
+        channels: Optional[List[str]],
+    ) -> Optional[ds.Expression]:
+        exprs = []
+        if games is not None:
+            exprs.append(pc.field("APPLICATION_FAMILY_NAME").isin(games))
+        if start_dt is not None:
+            exprs.append(pc.field("CALENDAR_DT") >= pa.scalar(to_date(start_dt)))
+        if end_dt is not None:
+            exprs.append(pc.field("CALENDAR_DT") <= pa.scalar(to_date(end_dt)))
+        if channels is not None:
+            exprs.append(pc.field("CHANNEL_NAME").isin(channels))
+        return and_all(exprs)
+
+    def get_store_scans(
+        self, kind: str, snapshot_dt: date, games: Optional[List[str]], row_filter: Optional[ds.Expression]
+    ) -> List[tuple]:
+        """
+        Return the datasets and filters to scan to reconstruct the snapshot of kind as of snapshot_dt: the partition of the latest base of each game,
+        and the changes written after it up to snapshot_dt. The row filter can be applied to both, since it only keeps or drops whole keys
+        """
+        base_dts = self.get_base_dts(kind, snapshot_dt, games)
+        if not base_dts:
+            return []
+        snapshot_str = snapshot_dt.strftime(DATE_FORMAT)
+        base_filter, changes_filter = [], []
+        for game, base_dt in base_dts.items():
+            is_game = pc.field("APPLICATION_FAMILY_NAME") == game
+            base_filter.append(is_game & (pc.field("SNAPSHOT_DT") == base_dt.strftime(DATE_FORMAT)))
+            changes_filter.append(
+                is_game
+                & (pc.field("SNAPSHOT_DT") > base_dt.strftime(DATE_FORMAT))
+                & (pc.field("SNAPSHOT_DT") <= snapshot_str)
+            )
+        scans = [(self.get_store_dataset(kind, "base"), and_all([or_all(base_filter), row_filter]))]
+        if self.get_store_dataset(kind, "changes") is not None:
+            scans.append((self.get_store_dataset(kind, "changes"), and_all([or_all(changes_filter), row_filter])))
+        return scans
+
+    @staticmethod
+    def reconstruct(kind: str, scans: List[tuple]) -> pa.Table:
+        """
+        Read the base and change rows of scans, and keep the last record of each key, unless it is a delete
+        """
+        tables = [dataset.to_table(filter=scan_filter) for dataset, scan_filter in scans]
+        table = pa.concat_tables([table.select(tables[0].column_names) for table in tables])
+        table = table.sort_by("SNAPSHOT_DT")
+        table = table.append_column("RECORD_INDEX", pa.array(np.arange(table.num_rows)))
+        latest_df = table.group_by(SNAPSHOT_KEY_COLS[kind], use_threads=False).aggregate([("RECORD_INDEX", "max")])
+        table = table.take(latest_df["RECORD_INDEX_max"]).drop_columns("RECORD_INDEX")
+        return table.filter(pc.field("CHANGE_TYPE") != "delete")
+
+    def _put(self, key: tuple, table: pa.Table) -> None:
+        """
+        Cache table under key, and evict the least recently read slices until the cache fits in cache_bytes. A slice larger than the cache is not kept
+        """
+        if table.nbytes > self.cache_bytes:
+            return
+        with self._lock:
+            if key in self._cache:
+                return
+            self._cache[key] = table
+            self._cached_bytes += table.nbytes
+            while self._cached_bytes > self.cache_bytes:
+                _, evicted_table = self._cache.popitem(last=False)
+                self._cached_bytes -= evicted_table.nbytes
+
+    def cache_info(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "slices": len(self._cache),
+                "bytes": self._cached_bytes,
+                "max_bytes": self.cache_bytes,
+            }
+
+    def clear_cache(self) -> None:
+        with self._lock:
+            self._cache.clear()
+            self._cached_bytes = 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--save-dir", required=True, help="local or mounted path of DBFS_SAVE_DIR")
+    parser.add_argument("--kind", choices=SNAPSHOT_KINDS, default="channel")
+    parser.add_argument("--snapshot-dt", help="date of the snapshot, the latest one by default")
+    parser.add_argument("--game", action="append", dest="games", help="repeat for several games")
+    parser.add_argument("--channel", action="append", dest="channels", help="repeat for several channels")
+    parser.add_argument("--start-dt")
+    parser.add_argument("--end-dt")
+    parser.add_argument("--column", action="append", dest="columns", help="repeat for several columns")
+    parser.add_argument("--output", help="arrow ipc file to write the rows to, printed when not set")
+    args = parser.parse_args()
+
+    table = SnapshotReader(args.save_dir).read(
+        args.kind, args.games, args.start_dt, args.end_dt, args.channels, args.columns, args.snapshot_dt
+    )
+    if args.output:
+        write_arrow_ipc(table, args.output)
+        print(f"{table.num_rows} rows written to {args.output}")
+    else:
+        print(table.to_pandas().to_string())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+"""
+Generate synthetic stand-ins for the four warehouse tables read by Daily_Merge_Table_Update.py:
+pr_analytics_agg.fact_promotion_expense_daily, ua.internal_individual_ltv, pr_analytics_delta.install and ua.skan_ltv.
+
+Volumes follow a Zipf-like curve over games, so the first game is the biggest title, and organic installs are
+SYNTHETIC_SCALES[scale]["organic_skew"] times a paid campaign's volume, which reproduces the few giant ORGANIC keys of production.
+All rows are generated from spark.range, so large scales do not go through the driver.
+"""
+
+import pyspark.sql.functions as F
+import pyspark.sql as ps
+from typing import Dict, List, Tuple
+from datetime import date, timedelta
+
+SYNTHETIC_SCALES = {
+    "small": {"games": 3, "channels": 4, "promotions": 3, "days": 60, "users": 50, "organic_skew": 20},
+    "medium": {"games": 6, "channels": 8, "promotions": 10, "days": 365, "users": 500, "organic_skew": 20},
+    "large": {"games": 13, "channels": 12, "promotions": 40, "days": 1000, "users": 5000, "organic_skew": 20},
+}
+# the first games carry the special revenue share rates of the pipeline
+GAME_NAMES = [
+    "Jurassic World Alive",
+    "Harry Potter",
+    "Jurassic World the Game",
+    "DC Heroes & Villains",
+    "Cookie Jam",
+    "Panda Pop",
+    "Bingo Pop",
+    "Emoji Blitz",
+    "Cookie Jam Blast",
+    "Lovelink",
+    "Genies and Gems",
+    "Mahjong",
+    "Solitaire Showtime",
+]
+# SKANUAC and SKANFB are aliases remapped by the pipeline, UNTRUSTED_NETWORK is filtered out by it
+CHANNEL_NAMES = [
+    "ADWORDS",
+    "SGNFB",
+    "SKANUAC",
+    "SKANFB",
+    "UNITY",
+    "IRONSOURCE",
+    "APPLOVIN",
+    "TIKTOK",
+    "SNAPCHAT",
+    "UNTRUSTED_NETWORK",
+]
+MARKETS = ["IT", "GO"]
+PAID_USER_SOURCE_TYPES = ["MM", "MK", "MC"]
+REVENUE_HORIZONS = [("001", 1.0), ("003", 1.6), ("007", 2.3), ("014", 3.0), ("028", 3.8)]
+SOURCE_TABLE_NAMES = {
+    "fact_promotion_expense_daily": "pr_analytics_agg.fact_promotion_expense_daily",
+    "internal_individual_ltv": "ua.internal_individual_ltv",
+    "install": "pr_analytics_delta.install",
+    "skan_ltv": "ua.skan_ltv",
+}
+
+
+def get_game_list(scale: Dict[str, int]) -> List[str]:
+    """
+    Return the names of the synthetic games
+    """
+    return [
+        GAME_NAMES[i] if i < len(GAME_NAMES) else f"Synthetic Game {i}"
+        for i in range(scale["games"])
+    ]
+
+
+def get_channel_list(scale: Dict[str, int]) -> List[str]:
+    """
+    Return the names of the synthetic channels
+    """
+    return [
+        CHANNEL_NAMES[i] if i < len(CHANNEL_NAMES) else f"CHANNEL_{i}"
+        for i in range(scale["channels"])
+    ]
+
+
+def get_date_range(scale: Dict[str, int]) -> Tuple[date, date]:
+    """
+    Return the first and last synthetic install date, ending yesterday
+    """
+    end_date = date.today() - timedelta(days=1)
+    return end_date - timedelta(days=scale["days"] - 1), end_date
+
+
+def pick(values: List[str], idx_col: ps.Column) -> ps.Column:
+    """
+    Return values[idx_col] as a column
+    """
+    return F.element_at(F.array(*[F.lit(value) for value in values]), idx_col.cast("int") + 1)
+
+
+def split_index(sizes: Dict[str, int]) -> List[ps.Column]:
+    """
+    Decompose spark.range ids into one index column per dimension of sizes, like a mixed-radix number
+    """
+    cols = []
+    divisor = 1
+    for name, size in sizes.items():
+        cols.append((F.floor(F.col("id") / divisor) % size).alias(name))
+        divisor *= size
+    return cols
+
+
+def num_rows(sizes: Dict[str, int]) -> int:
+    """
+    Return the number of combinations of all dimensions of sizes
+    """
+    n = 1
+    for size in sizes.values():
+        n *= size
+    return n
+
+
+def game_weight(game_idx_col: ps.Column) -> ps.Column:
+    """
+    Zipf-like weight of a game, 1 for the biggest title
+    """
+    return F.lit(1.0) / (game_idx_col + 1)
+
+
+def generate_fact_promotion_expense_daily(
+    spark: ps.SparkSession, scale: Dict[str, int], seed: int = 0
+) -> ps.DataFrame:
+    """
+    One row per game, market, day, paid user source type, channel and promotion, plus one organic row per game, market and day
+    """
+    start_date, _ = get_date_range(scale)
+    paid_sizes = {
+        "game_idx": scale["games"],
+        "market_idx": len(MARKETS),
+        "day_idx": scale["days"],
+        "ust_idx": len(PAID_USER_SOURCE_TYPES),
+        "channel_idx": scale["channels"],
+        "promotion_idx": scale["promotions"],
+    }
+    paid_df = spark.range(num_rows(paid_sizes)).select(*split_index(paid_sizes)).select(
+        "*",
+        pick(PAID_USER_SOURCE_TYPES, F.col("ust_idx")).alias("USER_SOURCE_TYPE_CD"),
+        pick(get_channel_list(scale), F.col("channel_idx")).alias("CHANNEL_NAME"),
+        F.concat(F.lit("PROMO_"), F.col("promotion_idx")).alias("PROMOTION_NAME"),
+        F.floor(F.rand(seed) * 40 * game_weight(F.col("game_idx"))).alias("USER_QTY"),
+    )
+    organic_sizes = {
+        "game_idx": scale["games"],
+        "market_idx": len(MARKETS),
+        "day_idx": scale["days"],
+    }
+    organic_df = spark.range(num_rows(organic_sizes)).select(*split_index(organic_sizes)).select(
+        "*",
+        F.lit("US").alias("USER_SOURCE_TYPE_CD"),
+        F.lit("ORGANIC").alias("CHANNEL_NAME"),
+        F.lit("ORGANIC").alias("PROMOTION_NAME"),
+        F.floor(
+            F.rand(seed + 1) * 40 * scale["organic_skew"] * game_weight(F.col("game_idx"))
+        ).alias("USER_QTY"),
+    )
+
+    df = paid_df.drop("ust_idx", "channel_idx", "promotion_idx").unionByName(organic_df)
+    is_paid = F.col("USER_SOURCE_TYPE_CD") != "US"
+    user_qty = F.col("USER_QTY")
+    arpu = F.rand(seed + 2) * 0.5
+    revenue_cols = []
+    for horizon, growth in REVENUE_HORIZONS:
+        revenue_cols += [
+            (user_qty * arpu * growth).alias(f"REVS_DAY_{horizon}_AMT"),
+            (user_qty * arpu * growth * 0.4).alias(f"AD_REVS_DAY_{horizon}_AMT"),
+            (user_qty * arpu * growth * 0.1).alias(f"subscriptions_revs_day_{horizon}_amt"),
+        ]
+    return df.select(
+        pick(get_game_list(scale), F.col("game_idx")).alias("APPLICATION_FAMILY_NAME"),
+        pick(MARKETS, F.col("market_idx")).alias("MARKET_CD"),
+        F.when(F.rand(seed + 3) < 0.9, F.lit("New Installs"))
+        .otherwise(F.lit("Retargeting"))
+        .alias("MVP_CAMPAIGN_TYPE"),
+        "USER_SOURCE_TYPE_CD",
+        "CHANNEL_NAME",
+        "PROMOTION_NAME",
+        F.date_add(F.lit(start_date), F.col("day_idx").cast("int")).alias("CALENDAR_DT"),
+        F.when(is_paid, user_qty * (1 + F.rand(seed + 4) * 4)).otherwise(0.0).alias("EXPENSE_AMT"),
+        user_qty.alias("USER_QTY"),
+        F.floor(user_qty * 0.4).alias("RETENTION_DAY_001_QTY"),
+        F.floor(user_qty * 0.2).alias("RETENTION_DAY_003_QTY"),
+        F.floor(user_qty * 0.1).alias("RETENTION_DAY_007_QTY"),
+        *revenue_cols,
+        (user_qty * arpu * 10).alias("LTV_365_LASTEST_VAL"),
+        (user_qty * arpu * 4).alias("AD_LTV_365_LASTEST_VAL"),
+    )
+
+
+def generate_install(
+    spark: ps.SparkSession, scale: Dict[str, int], seed: int = 0
+) -> ps.DataFrame:
+    """
+    One row per installed user. Smaller games are thinned out by their Zipf weight and 60% of the users are organic
+    """
+    start_date, _ = get_date_range(scale)
+    sizes = {
+        "game_idx": scale["games"],
+        "market_idx": len(MARKETS),
+        "day_idx": scale["days"],
+        "user_idx": scale["users"],
+    }
+    df = spark.range(num_rows(sizes)).select("id", *split_index(sizes))
+    df = df.where(F.rand(seed) < game_weight(F.col("game_idx")))
+    is_organic = F.rand(seed + 1) < 0.6
+    return df.select(
+        F.concat(F.lit("APP_"), F.col("game_idx"), F.lit("_"), pick(MARKETS, F.col("market_idx"))).alias("APPLICATION_CD"),
+        (F.col("id") % 1000).alias("ACCOUNT_ID"),
+        F.col("id").alias("USER_ID"),
+        pick(get_game_list(scale), F.col("game_idx")).alias("APPLICATION_FAMILY_NAME"),
+        pick(MARKETS, F.col("market_idx")).alias("MARKET_CD"),
+        F.when(is_organic, F.lit("US"))
+        .otherwise(pick(PAID_USER_SOURCE_TYPES, F.floor(F.rand(seed + 2) * len(PAID_USER_SOURCE_TYPES))))
+        .alias("USER_SOURCE_TYPE_CD"),
+        pick(get_channel_list(scale), F.floor(F.rand(seed + 3) * scale["channels"])).alias("CHANNEL_NAME"),
+        F.concat(F.lit("PROMO_"), F.floor(F.rand(seed + 4) * scale["promotions"])).alias("PROMOTION_NAME"),
+        F.date_add(F.lit(start_date), F.col("day_idx").cast("int")).alias("INSTALL_DT"),
+    )
+
+
+def generate_internal_individual_ltv(
+    install_df: ps.DataFrame, seed: int = 0
+) -> ps.DataFrame:
+    """
+    One to three weekly ltv projections per installed user
+    """
+    df = install_df.select(
+        "ACCOUNT_ID",
+        "USER_ID",
+        "APPLICATION_CD",
+        "INSTALL_DT",
+        F.explode(F.sequence(F.lit(0), F.floor(F.rand(seed) * 3).cast("int"))).alias("projection_idx"),
+    )
+    return df.select(
+        "ACCOUNT_ID",
+        "USER_ID",
+        "APPLICATION_CD",
+        F.date_add(F.col("INSTALL_DT"), F.col("projection_idx") * 7).alias("PROJECTION_DT"),
+        (F.rand(seed + 1) * 5).alias("IAP_PROJECTEDREVENUE_365"),
+        (F.rand(seed + 2) * 2).alias("AD_PROJECTEDREVENUE_365"),
+        F.when(F.rand(seed + 3) < 0.05, F.rand(seed + 4) * 20).otherwise(0.0).alias("SUB_PROJECTEDREVENUE_365"),
+    )
+
+
+def generate_skan_ltv(
+    spark: ps.SparkSession, scale: Dict[str, int], seed: int = 0
+) -> ps.DataFrame:
+    """
+    One row per game, day, channel and promotion, using the channel names after the pipeline's alias remapping
+    """
+    start_date, _ = get_date_range(scale)
+    sizes = {
+        "game_idx": scale["games"],
+        "day_idx": scale["days"],
+        "channel_idx": scale["channels"],
+        "promotion_idx": scale["promotions"],
+    }
+    skan_channels = [
+        {"SKANUAC": "ADWORDS", "SKANFB": "SGNFB"}.get(channel, channel)
+        for channel in get_channel_list(scale)
+    ]
+    df = spark.range(num_rows(sizes)).select(*split_index(sizes))
+    install_num = F.floor(F.rand(seed) * 30 * game_weight(F.col("game_idx")))
+    return df.select(
+        pick(get_game_list(scale), F.col("game_idx")).alias("APPLICATION_FAMILY_NAME"),
+        pick(skan_channels, F.col("channel_idx")).alias("CHANNEL_NAME"),
+        F.concat(F.lit("PROMO_"), F.col("promotion_idx")).alias("PROMOTION_CD"),
+        F.date_add(F.lit(start_date), F.col("day_idx").cast("int")).alias("INSTALL_DT"),
+        install_num.alias("INSTALL_NUM"),
+        (install_num * F.rand(seed + 1) * 6).alias("GROSS_IAP_LTV_365_LATEST_VAL"),
+        (install_num * F.rand(seed + 2) * 5).alias("NET_OVERALL_LTV_365_LATEST_VAL"),
+    )
+
+
+def generate_source_tables(
+    spark: ps.SparkSession, scale: Dict[str, int], seed: int = 0
+) -> Dict[str, int]:
+    """
+    Write all four synthetic source tables under their warehouse names and return their row counts
+    """
+    for table_name in SOURCE_TABLE_NAMES.values():
+        spark.sql(f"create database if not exists {table_name.split('.')[0]}")
+
+    install_df = generate_install(spark, scale, seed)
+    install_df.write.mode("overwrite").saveAsTable(SOURCE_TABLE_NAMES["install"])
+    install_df = spark.table(SOURCE_TABLE_NAMES["install"])
+    source_dfs = {
+        "fact_promotion_expense_daily": generate_fact_promotion_expense_daily(spark, scale, seed),
+        "internal_individual_ltv": generate_internal_individual_ltv(install_df, seed),
+        "skan_ltv": generate_skan_ltv(spark, scale, seed),
+    }
+    for name, df in source_dfs.items():
+        df.write.mode("overwrite").saveAsTable(SOURCE_TABLE_NAMES[name])
+
+    return {
+        name: spark.table(table_name).count()
+        for name, table_name in SOURCE_TABLE_NAMES.items()
+    }
@@ -0,0 +1,168 @@
+"""
+Fixtures shared by the tests: a local SparkSession over the small synthetic source tables of Synthetic_Source_Tables.py,
+and the notebook loaded on it the way Benchmark_Merge_Pipeline.py loads it.
+Spark needs a java runtime, found through JAVA_HOME
+"""
+
+import sys
+import uuid
+from functools import reduce
+from pathlib import Path
+from typing import Callable, Optional, Tuple
+
+import pyspark.sql as ps
+import pyspark.sql.functions as F
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from Benchmark_Merge_Pipeline import load_pipeline  # noqa: E402
+from Synthetic_Source_Tables import (  # noqa: E402
+    SYNTHETIC_SCALES,
+    generate_source_tables,
+    get_date_range,
+    get_game_list,
+)
+
+try:
+    from delta import configure_spark_with_delta_pip
+except ImportError:
+    # the tests that need delta lake skip without it
+    configure_spark_with_delta_pip = None
+
+SCALE = SYNTHETIC_SCALES["small"]
+# the tables the notebook writes, which load_notebook() points at the database of the test
+PUBLISHED_TABLE_NAMES = [
+    "CHANNEL_TABLE_NAME",
+    "CAMPAIGN_TABLE_NAME",
+    "QA_SUMMARY_TABLE_NAME",
+    "GAME_TABLE_NAME",
+    "CHANNEL_WEEKLY_TABLE_NAME",
+    "CHANNEL_MONTHLY_TABLE_NAME",
+    "RUN_REPORT_TABLE_NAME",
+    "SKAN_STREAM_TABLE_NAME",
+    "BACKFILL_LEDGER_TABLE_NAME",
+]
+
+
+@pytest.fixture(scope="session")
+def spark(tmp_path_factory) -> ps.SparkSession:
+    work_dir = tmp_path_factory.mktemp("spark")
+    builder = (
+        ps.SparkSession.builder.master("local[2]")
+        .appName("skan_performance_tests")
+        .config("spark.sql.warehouse.dir", str(work_dir / "warehouse"))
+        # a hive metastore, as on the cluster, so that hive serde tables can be published to
+        .config("spark.hadoop.javax.jdo.option.ConnectionURL", f"jdbc:derby:;databaseName={work_dir / 'metastore_db'};create=true")
+        .config("spark.driver.extraJavaOptions", f"-Dderby.system.home={work_dir}")
+        .enableHiveSupport()
+        .config("spark.sql.shuffle.partitions", 4)
+        .config("spark.ui.enabled", "false")
+        .config("spark.ui.showConsoleProgress", "false")
+    )
+    if configure_spark_with_delta_pip is not None:
+        builder = configure_spark_with_delta_pip(
+            builder.config("spark.sql.extensions", "io.delta.sql.DeltaSparkSessionExtension").config(
+                "spark.sql.catalog.spark_catalog", "org.apache.spark.sql.delta.catalog.DeltaCatalog"
+            )
+        )
+    spark = builder.getOrCreate()
+    spark.sparkContext.setLogLevel("ERROR")
+    generate_source_tables(spark, SCALE)
+    yield spark
+    spark.stop()
+
+
+@pytest.fixture
+def database(spark: ps.SparkSession) -> str:
+    """
+    Return a database of the test's own for the tables it writes, dropped with them once the test is over.
+    The synthetic source tables stay shared by all tests
+    """
+    database = f"test_{uuid.uuid4().hex[:12]}"
+    spark.sql(f"create database {database}")
+    yield database
+    spark.sql(f"drop database if exists {database} cascade")
+
+
+@pytest.fixture
+def load_notebook(spark: ps.SparkSession, tmp_path: Path, database: str) -> Callable[..., dict]:
+    """
+    Return a function that loads the notebook over the synthetic source tables, with its files under tmp_path and its tables in database,
+    and its top-level assignments in overrides replaced by the given python expressions
+    """
+    start_date, _ = get_date_range(SCALE)
+
+    def load(**overrides: str) -> dict:
+        return load_pipeline(
+            spark,
+            {
+                "GAME_LIST": repr(get_game_list(SCALE)),
+                "START_DT": repr(start_date.isoformat()),
+                "DBFS_SAVE_DIR": repr(str(tmp_path / "dbfs")),
+                "ARROW_SOURCE_DIR": repr(str(tmp_path / "arrow_sources")),
+                **{
+                    name: repr(f"{database}.{name.removesuffix('_TABLE_NAME').lower()}")
+                    for name in PUBLISHED_TABLE_NAMES
+                },
+                **overrides,
+            },
+        )
+
+    return load
+
+
+@pytest.fixture
+def compute_details() -> Callable[..., Tuple[ps.DataFrame, ps.DataFrame]]:
+    """
+    Return a function that chains the spark stages of a loaded notebook, as merge_skan_performance_channel_details() does,
+    and returns the campaign and channel details of run_config, or of the notebook's RUN_CONFIG
+    """
+
+    def compute(nb: dict, run_config: Optional[tuple] = None) -> Tuple[ps.DataFrame, ps.DataFrame]:
+        run_config = run_config or nb["RUN_CONFIG"]
+        campaign_details_df = nb["get_complete_campaign_details"](
+            nb["get_campaign_details"](
+                nb["get_campaign_without_sub_ltv"](run_config), nb["get_campaign_sub_ltv"](run_config)
+            ),
+            nb["get_skan_campaign_ltv"](run_config),
+        )
+        rollup_df = nb["get_rollups"](campaign_details_df, nb["DAY_ROLLUPS"], run_config)
+        return campaign_details_df, nb["get_rollup_df"](rollup_df, nb["CHANNEL_DAY_ROLLUP"])
+
+    return compute
+
+
+def replace_table(spark: ps.SparkSession, df: ps.DataFrame, table_name: str) -> None:
+    # the rows are pinned first, since the table being overwritten is one of their sources
+    df.localCheckpoint().write.mode("overwrite").saveAsTable(table_name)
+
+
+def emulate_delta_merges(spark: ps.SparkSession, nb: dict) -> None:
+    """
+    Replace the delta merges of the notebook, which need delta lake, by overwrites of the parquet tables with the same result
+    """
+
+    def merge_into_table(df, table_name, key_cols, run_config):
+        if not spark.catalog.tableExists(table_name):
+            df.write.saveAsTable(table_name)
+            return
+        target_df = spark.table(table_name)
+        is_window = (
+            F.col("APPLICATION_FAMILY_NAME").isin(run_config.game_list)
+            & F.col("MARKET_CD").isin(*run_config.market_list)
+            & F.col("CALENDAR_DT").between(run_config.compute_start_dt, run_config.skan_end_dt)
+        )
+        replace_table(spark, target_df.where(~is_window).unionByName(df.select(*target_df.columns)), table_name)
+
+    def upsert_into_table(df, table_name, key_cols):
+        if not spark.catalog.tableExists(table_name):
+            df.write.saveAsTable(table_name)
+            return
+        target_df = spark.table(table_name)
+        is_key = reduce(lambda cond, col: cond & target_df[col].eqNullSafe(df[col]), key_cols, F.lit(True))
+        kept_df = target_df.join(df, is_key, "leftanti")
+        replace_table(spark, kept_df.unionByName(df.select(*target_df.columns)), table_name)
+
+    nb["merge_into_table"] = merge_into_table
+    nb["upsert_into_table"] = upsert_into_table
@@ -0,0 +1,32 @@
+from datetime import timedelta
+from pathlib import Path
+
+from conftest import SCALE
+from Merge_Parity import get_parity_violations
+from Synthetic_Source_Tables import SOURCE_TABLE_NAMES, get_date_range
+
+
+def test_arrow_engine_matches_spark_stages(spark, load_notebook, compute_details):
+    nb = load_notebook()
+    _, end_date = get_date_range(SCALE)
+    # the skan window ends before the last day of the data, so that both engines have to cut the skan rows at skan_end_dt
+    skan_end_date = end_date - timedelta(days=5)
+    run_config = nb["RUN_CONFIG"]._replace(
+        end_dt=(skan_end_date - timedelta(days=nb["REPORT_DELAY_DAYS"])).isoformat(),
+        skan_end_dt=skan_end_date.isoformat(),
+    )
+    assert spark.table(nb["SKAN_LTV_TABLE_NAME"]).where(f"INSTALL_DT > '{run_config.skan_end_dt}'").count() > 0
+
+    for table_name in SOURCE_TABLE_NAMES.values():
+        spark.table(table_name).write.mode("overwrite").parquet(str(Path(nb["ARROW_SOURCE_DIR"], f"{table_name}.parquet")))
+    campaign_table, channel_table = nb["run_arrow_merge"](run_config)
+    campaign_details_df, channel_details_df = compute_details(nb, run_config)
+
+    for name, df, table, key_cols in [
+        ("campaign", campaign_details_df, campaign_table, nb["CAMPAIGN_KEY_COLS"]),
+        ("channel", channel_details_df, channel_table, nb["CHANNEL_KEY_COLS"]),
+    ]:
+        expected_df = nb["revise_schema"](df).toPandas()
+        assert expected_df["CALENDAR_DT"].astype(str).max() <= run_config.skan_end_dt
+        violation_df = get_parity_violations(expected_df, table.to_pandas(), key_cols)
+        assert violation_df.empty, f"{name} parity violations:\n{violation_df[[*key_cols, 'VIOLATION']].head(20)}"
@@ -0,0 +1,64 @@
+import threading
+
+import pytest
+
+
+def get_chunk_dates(chunks: list) -> list:
+    return [(chunk.compute_start_dt, chunk.end_dt, chunk.skan_end_dt) for chunk in chunks]
+
+
+def test_backfill_chunks_follow_calendar_months(load_notebook):
+    nb = load_notebook()
+    run_config = nb["RUN_CONFIG"]._replace(compute_start_dt="2024-01-15", end_dt="2024-03-05", skan_end_dt="2024-03-10")
+
+    chunks = nb["get_backfill_chunks"](run_config)
+    assert get_chunk_dates(chunks) == [
+        ("2024-01-15", "2024-01-31", "2024-01-31"),
+        ("2024-02-01", "2024-02-29", "2024-02-29"),
+        # the last chunk keeps the end dates of the run
+        ("2024-03-01", "2024-03-05", "2024-03-10"),
+    ]
+    assert all(chunk.is_backfill_chunk for chunk in chunks)
+
+    nb = load_notebook(BACKFILL_CHUNK_MONTHS="2")
+    assert get_chunk_dates(nb["get_backfill_chunks"](run_config)) == [
+        ("2024-01-15", "2024-02-29", "2024-02-29"),
+        ("2024-03-01", "2024-03-05", "2024-03-10"),
+    ]
+
+
+def test_backfill_rerun_retries_only_failed_chunks(load_notebook):
+    nb = load_notebook(SAVE_FLAG="False")
+    run_config = nb["RUN_CONFIG"]._replace(compute_start_dt="2024-01-15", end_dt="2024-03-05", skan_end_dt="2024-03-10")
+    run_chunk_dts, run_lock = [], threading.Lock()
+    failing_chunk_dts = {"2024-02-01"}
+
+    def merge_skan_performance_channel_details(chunk):
+        with run_lock:
+            run_chunk_dts.append(chunk.compute_start_dt)
+        if chunk.compute_start_dt in failing_chunk_dts:
+            raise RuntimeError("lost the executors")
+
+    nb["merge_skan_performance_channel_details"] = merge_skan_performance_channel_details
+
+    with pytest.raises(nb["BackfillError"]) as exc_info:
+        nb["run_backfill"](run_config)
+    assert sorted(run_chunk_dts) == ["2024-01-15", "2024-02-01", "2024-03-01"]
+    assert exc_info.value.failed_report_df["CHUNK_START_DT"].tolist() == ["2024-02-01"]
+    assert "RuntimeError: lost the executors" in str(exc_info.value)
+
+    # the rerun only runs the chunk that failed
+    run_chunk_dts.clear()
+    failing_chunk_dts.clear()
+    report_df = nb["run_backfill"](run_config)
+    assert run_chunk_dts == ["2024-02-01"]
+    assert report_df[["CHUNK_START_DT", "STATUS"]].values.tolist() == [["2024-02-01", "SUCCESS"]]
+    assert nb["get_completed_chunks"]() == {
+        (chunk.compute_start_dt, chunk.skan_end_dt, ", ".join(run_config.game_list))
+        for chunk in nb["get_backfill_chunks"](run_config)
+    }
+
+    # once every chunk is done, nothing runs again
+    run_chunk_dts.clear()
+    assert nb["run_backfill"](run_config).empty
+    assert run_chunk_dts == []
@@ -0,0 +1,122 @@
+from datetime import timedelta
+
+import pyspark.sql as ps
+import pyspark.sql.functions as F
+import pytest
+from conftest import SCALE
+from Merge_Parity import get_parity_violations
+from Synthetic_Source_Tables import get_date_range, get_game_list
+
+
+def adjust_ios_organic_by_joins(
+    mmp_campaign_details_df: ps.DataFrame,
+    skan_campaign_details_df: ps.DataFrame,
+    other_campaign_details_df: ps.DataFrame,
+) -> ps.DataFrame:
+    """
+    The adjustment as it was before the conditional aggregation: three group-bys, two left joins and a clamp per column
+    """
+    go_campaign_details_df = mmp_campaign_details_df.where(F.col("MARKET_CD") == "GO")
+    mmp_ios_campaign_df = mmp_campaign_details_df.where(F.col("MARKET_CD") == "IT")
+    group_cols = ["APPLICATION_FAMILY_NAME", "MARKET_CD", "CALENDAR_DT"]
+    agg_cols = list(
+        set(mmp_campaign_details_df.columns)
+        - {"APPLICATION_FAMILY_NAME", "MARKET_CD", "USER_SOURCE_TYPE_CD", "CHANNEL_NAME", "PROMOTION_NAME", "CALENDAR_DT"}
+    )
+    mmp_ios_total_df = (
+        mmp_ios_campaign_df.where(F.col("USER_SOURCE_TYPE_CD").isin(["MK", "US"]))
+        .groupby(group_cols)
+        .agg(*[F.sum(agg_col).alias("MMP_TOTAL_" + agg_col) for agg_col in agg_cols])
+    )
+    mmp_ios_paid_df = (
+        other_campaign_details_df.where((F.col("MARKET_CD") == "IT") & (F.col("USER_SOURCE_TYPE_CD") == "MK"))
+        .groupby(group_cols)
+        .agg(*[F.sum(agg_col).alias("MMP_PAID_" + agg_col) for agg_col in agg_cols])
+    )
+    skan_total_df = skan_campaign_details_df.groupby(group_cols).agg(
+        *[F.sum(agg_col).alias("SKAN_PAID_" + agg_col) for agg_col in agg_cols]
+    )
+
+    mmp_ios_organic_df = mmp_ios_total_df.join(mmp_ios_paid_df, on=group_cols, how="left").join(
+        skan_total_df, on=group_cols, how="left"
+    )
+    for agg_col in agg_cols:
+        mmp_ios_organic_df = mmp_ios_organic_df.withColumn(
+            agg_col, F.expr(f"MMP_TOTAL_{agg_col} - coalesce(MMP_PAID_{agg_col}, 0) - coalesce(SKAN_PAID_{agg_col}, 0)")
+        ).drop(*[prefix + agg_col for prefix in ["MMP_TOTAL_", "MMP_PAID_", "SKAN_PAID_"]])
+    mmp_ios_organic_df = (
+        mmp_ios_organic_df.withColumn("USER_SOURCE_TYPE_CD", F.lit("US"))
+        .withColumn("SOURCE", F.lit("Non-SKAN"))
+        .withColumn("CHANNEL_NAME", F.lit("ORGANIC"))
+        .withColumn("PROMOTION_NAME", F.lit("ORGANIC"))
+    )
+
+    ios_campaign_details_df = mmp_ios_organic_df.unionByName(
+        other_campaign_details_df.where((F.col("MARKET_CD") == "IT") & (F.col("USER_SOURCE_TYPE_CD") != "US"))
+    ).unionByName(skan_campaign_details_df)
+    go_campaign_details_df = go_campaign_details_df.withColumn("SOURCE", F.lit("Non-SKAN"))
+    campaign_details_df = ios_campaign_details_df.unionByName(go_campaign_details_df)
+    for agg_col in agg_cols:
+        tmp_col = "tmp_" + agg_col
+        campaign_details_df = (
+            campaign_details_df.withColumnRenamed(agg_col, tmp_col)
+            .withColumn(agg_col, F.when(F.col(tmp_col) >= 0, F.col(tmp_col)).otherwise(0))
+            .drop(tmp_col)
+        )
+    return campaign_details_df
+
+
+@pytest.mark.parametrize("organic_factor", [1.0, 0.05])
+def test_organic_adjustment_matches_joins(spark, load_notebook, compute_details, database, organic_factor):
+    fact_promo_table_name = f"{database}.organic_fact_promo"
+    skan_ltv_table_name = f"{database}.organic_skan_ltv"
+    start_date, _ = get_date_range(SCALE)
+    games = get_game_list(SCALE)
+    no_paid_dt, no_skan_dt, no_total_dt = (start_date + timedelta(days=day) for day in [5, 6, 7])
+
+    # organic_factor scales the organic rows, the synthetic organic_skew. Below 1 the organic installs often fall short of the
+    # SKAN installs they are adjusted by, and the adjustment is clamped to 0
+    fact_promo_df = spark.table("pr_analytics_agg.fact_promotion_expense_daily")
+    is_organic = F.col("USER_SOURCE_TYPE_CD") == "US"
+    fact_promo_df = fact_promo_df.select(
+        *[
+            F.when(is_organic, (F.col(col) * organic_factor).cast(dtype)).otherwise(F.col(col)).alias(col)
+            if dtype in ["bigint", "double"]
+            else F.col(col)
+            for col, dtype in fact_promo_df.dtypes
+        ]
+    )
+
+    def is_ios_game_day(game: str, dt) -> ps.Column:
+        return (F.col("APPLICATION_FAMILY_NAME") == game) & (F.col("MARKET_CD") == "IT") & (F.col("CALENDAR_DT") == dt)
+
+    # a day with no mmp paid installs, and a day with neither paid nor organic mmp installs but with skan installs
+    fact_promo_df = fact_promo_df.where(
+        ~(is_ios_game_day(games[0], no_paid_dt) & (F.col("USER_SOURCE_TYPE_CD") == "MK"))
+        & ~(is_ios_game_day(games[1], no_total_dt) & F.col("USER_SOURCE_TYPE_CD").isin(["MK", "US"]))
+    )
+    fact_promo_df.write.mode("overwrite").saveAsTable(fact_promo_table_name)
+    # a day with no skan installs
+    spark.table("ua.skan_ltv").where(
+        ~((F.col("APPLICATION_FAMILY_NAME") == games[0]) & (F.col("INSTALL_DT") == no_skan_dt))
+    ).write.mode("overwrite").saveAsTable(skan_ltv_table_name)
+
+    overrides = {"FACT_PROMO_TABLE_NAME": repr(fact_promo_table_name), "SKAN_LTV_TABLE_NAME": repr(skan_ltv_table_name)}
+    nb = load_notebook(**overrides)
+    joins_nb = load_notebook(**overrides)
+    joins_nb["adjust_ios_organic"] = adjust_ios_organic_by_joins
+    campaign_details_df, _ = compute_details(nb)
+    expected_df, _ = compute_details(joins_nb)
+
+    key_cols = nb["CAMPAIGN_KEY_COLS"]
+    expected_pdf = expected_df.toPandas()
+    violation_df = get_parity_violations(expected_pdf, campaign_details_df.toPandas(), key_cols)
+    assert violation_df.empty, f"organic adjustment violations:\n{violation_df[[*key_cols, 'VIOLATION']].head(20)}"
+
+    organic_pdf = expected_pdf[(expected_pdf["MARKET_CD"] == "IT") & (expected_pdf["USER_SOURCE_TYPE_CD"] == "US")]
+    organic_dts = {(row.APPLICATION_FAMILY_NAME, row.CALENDAR_DT) for row in organic_pdf.itertuples()}
+    assert (games[0], no_paid_dt) in organic_dts
+    assert (games[0], no_skan_dt) in organic_dts
+    assert (games[1], no_total_dt) not in organic_dts
+    if organic_factor < 1:
+        assert (organic_pdf["INSTALL"] == 0).any()
@@ -0,0 +1,31 @@
+from pathlib import Path
+from urllib.parse import urlparse
+
+import pytest
+
+
+@pytest.mark.parametrize("checkpoint", [False, True], ids=["persist", "checkpoint"])
+def test_run_releases_every_pinned_df(spark, load_notebook, tmp_path, checkpoint):
+    overrides = {"CHECKPOINT_DIR": repr(str(tmp_path / "checkpoints"))} if checkpoint else {}
+    nb = load_notebook(**overrides)
+    # the dfs pinned by earlier tests are released first, so that the run is the only one pinning
+    for rdd in spark.sparkContext._jsc.getPersistentRDDs().values():
+        rdd.unpersist(True)
+    materialize = nb["materialize"]
+    pinned_dfs = []
+
+    def record_materialize(df, materialized_dfs):
+        df, row_num = materialize(df, materialized_dfs)
+        pinned_dfs.append(df)
+        return df, row_num
+
+    nb["materialize"] = record_materialize
+    nb["merge_skan_performance_channel_details"](nb["RUN_CONFIG"])
+
+    # the complete campaign details and the rollups are always pinned
+    assert len(pinned_dfs) >= 2
+    assert spark.sparkContext._jsc.getPersistentRDDs().isEmpty()
+    if checkpoint:
+        checkpoint_dir = Path(urlparse(spark.sparkContext._jsc.sc().getCheckpointDir().get()).path)
+        assert checkpoint_dir.is_dir()
+        assert list(checkpoint_dir.iterdir()) == []
@@ -0,0 +1,8 @@
+def test_final_plans_within_budget(load_notebook, compute_details):
+    nb = load_notebook()
+    campaign_details_df, channel_details_df = compute_details(nb)
+
+    for name, df in [("campaign", campaign_details_df), ("channel", channel_details_df)]:
+        plan_depth, plan_node_num = nb["get_plan_stats"](nb["revise_schema"](df))
+        assert plan_depth <= nb["PLAN_DEPTH_BUDGET"], f"{name} plan depth {plan_depth}"
+        assert plan_node_num <= nb["PLAN_NODE_BUDGET"], f"{name} plan nodes {plan_node_num}"
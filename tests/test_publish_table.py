@@ -0,0 +1,92 @@
+import pyspark.sql.functions as F
+import pytest
+
+
+def test_game_republish_keeps_other_games(spark, load_notebook, compute_details, database):
+    nb = load_notebook()
+    full_config = nb["RUN_CONFIG"]._replace(compute_start_dt=nb["START_DT"])
+    channel_details_df = nb["revise_schema"](compute_details(nb, full_config)[1]).localCheckpoint()
+    table_name = f"{database}.published_channel"
+    nb["publish_table"](channel_details_df, table_name, nb["CHANNEL_KEY_COLS"], full_config, nb["TableLayout"].GAME)
+
+    # a run over one game replaces its partition only
+    game, *other_games = full_config.game_list
+    game_config = full_config._replace(game_list=[game])
+    game_df = channel_details_df.where(F.col("APPLICATION_FAMILY_NAME") == game)
+    # without one of its channels, so that the replaced partition differs from the published one
+    game_df = game_df.where(F.col("CHANNEL_NAME") != game_df.first().CHANNEL_NAME)
+    nb["publish_table"](game_df, table_name, nb["CHANNEL_KEY_COLS"], game_config, nb["TableLayout"].GAME)
+
+    published_df = spark.table(table_name)
+    for other_game in other_games:
+        expected_num = channel_details_df.where(F.col("APPLICATION_FAMILY_NAME") == other_game).count()
+        assert published_df.where(F.col("APPLICATION_FAMILY_NAME") == other_game).count() == expected_num, other_game
+    assert published_df.where(F.col("APPLICATION_FAMILY_NAME") == game).count() == game_df.count()
+
+
+def test_game_republish_into_hive_table(spark, load_notebook, compute_details, database):
+    nb = load_notebook()
+    full_config = nb["RUN_CONFIG"]._replace(compute_start_dt=nb["START_DT"])
+    channel_details_df = nb["revise_schema"](compute_details(nb, full_config)[1]).localCheckpoint()
+    table_name = f"{database}.published_hive_channel"
+    data_cols = ", ".join(
+        f"{field.name} {field.dataType.simpleString()}"
+        for field in channel_details_df.schema
+        if field.name != "APPLICATION_FAMILY_NAME"
+    )
+    spark.sql(f"create table {table_name} ({data_cols}) partitioned by (APPLICATION_FAMILY_NAME string) stored as parquet")
+    assert nb["get_table_provider"](table_name) == "hive"
+    overwrite_mode = spark.conf.get("spark.sql.sources.partitionOverwriteMode")
+
+    # every game is published by a run of its own, and one game is then republished without one of its channels
+    for game in full_config.game_list:
+        game_df = channel_details_df.where(F.col("APPLICATION_FAMILY_NAME") == game)
+        nb["publish_table"](game_df, table_name, nb["CHANNEL_KEY_COLS"], full_config._replace(game_list=[game]), nb["TableLayout"].GAME)
+    game, *other_games = full_config.game_list
+    game_df = channel_details_df.where(F.col("APPLICATION_FAMILY_NAME") == game)
+    game_df = game_df.where(F.col("CHANNEL_NAME") != game_df.first().CHANNEL_NAME)
+    nb["publish_table"](game_df, table_name, nb["CHANNEL_KEY_COLS"], full_config._replace(game_list=[game]), nb["TableLayout"].GAME)
+
+    assert nb["get_table_provider"](table_name) == "hive"
+    published_df = spark.table(table_name)
+    for other_game in other_games:
+        expected_num = channel_details_df.where(F.col("APPLICATION_FAMILY_NAME") == other_game).count()
+        assert published_df.where(F.col("APPLICATION_FAMILY_NAME") == other_game).count() == expected_num, other_game
+    assert published_df.where(F.col("APPLICATION_FAMILY_NAME") == game).count() == game_df.count()
+    assert {row[0] for row in spark.sql(f"show partitions {table_name}").collect()} == {
+        f"APPLICATION_FAMILY_NAME={published_game}" for published_game in full_config.game_list
+    }
+    # the session is left as it was
+    assert spark.conf.get("spark.sql.sources.partitionOverwriteMode") == overwrite_mode
+
+
+def test_partial_window_replaces_only_its_install_months(spark, load_notebook, compute_details, database):
+    nb = load_notebook()
+    full_config = nb["RUN_CONFIG"]._replace(compute_start_dt=nb["START_DT"])
+    channel_details_df = nb["revise_schema"](compute_details(nb, full_config)[1]).localCheckpoint()
+    table_name = f"{database}.published_month_channel"
+    layout = nb["TableLayout"].GAME_AND_INSTALL_MONTH
+    nb["publish_table"](channel_details_df, table_name, nb["CHANNEL_KEY_COLS"], full_config, layout)
+
+    # a partial window starts on the first of a month, and its recomputed rows differ from the published ones
+    window_start_date = channel_details_df.agg(F.max("CALENDAR_DT")).first()[0].replace(day=1)
+    window_config = full_config._replace(compute_start_dt=window_start_date.isoformat())
+    in_window = F.col("CALENDAR_DT") >= window_start_date
+    window_df = channel_details_df.where(in_window)
+    window_df = window_df.where(F.col("CHANNEL_NAME") != window_df.first().CHANNEL_NAME).withColumn("SPEND", F.col("SPEND") * 2)
+    nb["publish_table"](window_df, table_name, nb["CHANNEL_KEY_COLS"], window_config, layout)
+
+    published_df = spark.table(table_name)
+    assert "INSTALL_MONTH" in published_df.columns
+    for name, expected_df, actual_df in [
+        ("outside the window", channel_details_df.where(~in_window), published_df.where(~in_window)),
+        ("inside the window", window_df, published_df.where(in_window)),
+    ]:
+        expected, actual = (df.agg(F.count(F.lit(1)), F.sum("SPEND")).first() for df in [expected_df, actual_df])
+        assert actual[0] == expected[0], name
+        assert actual[1] == pytest.approx(expected[1]), name
+    published_months = {row.INSTALL_MONTH for row in published_df.select("INSTALL_MONTH").distinct().collect()}
+    assert published_months == {
+        row.INSTALL_MONTH
+        for row in channel_details_df.select(F.date_format("CALENDAR_DT", "yyyy-MM").alias("INSTALL_MONTH")).distinct().collect()
+    }
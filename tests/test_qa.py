@@ -0,0 +1,60 @@
+from datetime import date
+
+import pytest
+from Merge_Parity import get_parity_violations
+
+GAME_DETAILS_SCHEMA = "APPLICATION_FAMILY_NAME string, MARKET_CD string, SOURCE string, CALENDAR_DT date, SPEND double, INSTALL long"
+
+
+def test_qa_error_reports_every_violation(spark, load_notebook):
+    nb = load_notebook()
+    old_rows = [
+        ("Harry Potter", "IT", "SKAN", date(2024, 1, 2), 10.0, 100),
+        ("Jurassic World Alive", "GO", "Non-SKAN", date(2024, 1, 2), 10.0, 100),
+        ("Jurassic World the Game", "IT", "Non-SKAN", date(2024, 1, 2), 10.0, 100),
+    ]
+    new_rows = [
+        # a shorter history
+        ("Harry Potter", "IT", "SKAN", date(2024, 1, 1), 10.0, 100),
+        # fewer installs, beyond the tolerance of one install
+        ("Jurassic World Alive", "GO", "Non-SKAN", date(2024, 1, 2), 10.0, 98),
+        # one install less is tolerated
+        ("Jurassic World the Game", "IT", "Non-SKAN", date(2024, 1, 2), 10.0, 99),
+    ]
+    old_df, new_df = (
+        nb["aggregate_to_game_details"](spark.createDataFrame(rows, GAME_DETAILS_SCHEMA)) for rows in [old_rows, new_rows]
+    )
+
+    with pytest.raises(nb["QAError"]) as exc_info:
+        nb["qa_result"](old_df, new_df)
+
+    violation_df = exc_info.value.violation_df.set_index("APPLICATION_FAMILY_NAME")
+    assert violation_df["VIOLATION"].to_dict() == {
+        "Harry Potter": "smaller last_install_dt",
+        "Jurassic World Alive": "smaller install_num",
+    }
+    message = str(exc_info.value)
+    assert message.startswith("2 QA violations:")
+    assert "Prediction error for Harry Potter IT SKAN" in message
+    assert "Prediction error for Jurassic World Alive GO Non-SKAN" in message
+    assert "Jurassic World the Game" not in message
+
+
+def test_qa_summary_is_read_back_by_the_next_run(spark, load_notebook, compute_details):
+    nb = load_notebook()
+    run_config = nb["RUN_CONFIG"]._replace(compute_start_dt=nb["START_DT"])
+    campaign_details_df, channel_details_df = (df.localCheckpoint() for df in compute_details(nb, run_config))
+    nb["save_result"](campaign_details_df, channel_details_df, run_config)
+    assert spark.catalog.tableExists(nb["QA_SUMMARY_TABLE_NAME"])
+
+    key_cols = ["APPLICATION_FAMILY_NAME", "MARKET_CD", "SOURCE"]
+    old_df = nb["get_old_game_details_df"](run_config)
+    new_df = nb["aggregate_to_game_details"](channel_details_df)
+    violation_df = get_parity_violations(new_df.toPandas(), old_df.toPandas(), key_cols)
+    assert violation_df.empty, f"qa summary violations:\n{violation_df[[*key_cols, 'VIOLATION']]}"
+    last_install_dts = [
+        dict(df.select(*key_cols, "LAST_INSTALL_DT").toPandas().set_index(key_cols)["LAST_INSTALL_DT"]) for df in [old_df, new_df]
+    ]
+    assert last_install_dts[0] == last_install_dts[1]
+    # the next run over the same data passes qa
+    assert nb["qa_result"](old_df, new_df).empty
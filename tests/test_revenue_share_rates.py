@@ -0,0 +1,101 @@
+from datetime import date, timedelta
+
+import pyspark.sql.functions as F
+import pytest
+
+# IAP, AD, SUB first year and SUB after the first year of the CASE ladders the rate rows replaced
+LADDER_RATES = {
+    "Harry Potter": (0.616, 0.88, 0.616, 0.748),
+    "Jurassic World the Game": (0.525, 0.75, 0.525, 0.638),
+    "DC Heroes & Villains": (0.546, 0.78, 0.7, 0.85),
+}
+DEFAULT_LADDER_RATES = (0.7, 1.0, 0.7, 0.85)
+
+
+def get_ladder_rates(game: str, market: str, calendar_dt: date, run_dt: date) -> dict:
+    """
+    Return the IAP, AD, SUB and SUB_LTV rates the CASE ladders of the warehouse queries applied to a row of game, market and calendar_dt
+    """
+    iap_rate, ad_rate, sub_first_year_rate, sub_after_first_year_rate = LADDER_RATES.get(game, DEFAULT_LADDER_RATES)
+    if market == "GO":
+        sub_rate = sub_first_year_rate if calendar_dt < date(2022, 1, 1) else sub_after_first_year_rate
+        sub_ltv_rate = sub_rate
+    elif market == "IT":
+        sub_rate = sub_after_first_year_rate if calendar_dt < run_dt - timedelta(days=366) else sub_first_year_rate
+        sub_ltv_rate = sub_first_year_rate
+    else:
+        sub_rate, sub_ltv_rate = 0.0, 0.0
+    return {"IAP_RATE": iap_rate, "AD_RATE": ad_rate, "SUB_RATE": sub_rate, "SUB_LTV_RATE": sub_ltv_rate}
+
+
+def test_rate_rows_match_case_ladders(load_notebook):
+    nb = load_notebook()
+    run_dt = date(2024, 3, 1)
+    games = [*LADDER_RATES, "Cookie Jam"]
+    run_config = nb["RUN_CONFIG"]._replace(game_list=games, run_dt=run_dt)
+    rate_cols = [col.split()[0] for col in nb["REVENUE_SHARE_RATE_SCHEMA"].split(", ")]
+    rate_rows = [dict(zip(rate_cols, row)) for row in nb["get_revenue_share_rates"](run_config)]
+    calendar_dts = [
+        date(2021, 12, 31),
+        date(2022, 1, 1),
+        run_dt - timedelta(days=367),
+        run_dt - timedelta(days=366),
+        run_dt - timedelta(days=365),
+        run_dt,
+    ]
+
+    for game in games:
+        for market in nb["MARKET_LIST"]:
+            for calendar_dt in calendar_dts:
+                rows = [
+                    row
+                    for row in rate_rows
+                    if row["APPLICATION_FAMILY_NAME"] == game
+                    and row["MARKET_CD"] == market
+                    and row["START_DT"] <= calendar_dt <= row["END_DT"]
+                ]
+                assert len(rows) == 1, f"{len(rows)} rate rows for {game} {market} {calendar_dt}"
+                rates = {col: rows[0][col] for col in ["IAP_RATE", "AD_RATE", "SUB_RATE", "SUB_LTV_RATE"]}
+                assert rates == pytest.approx(get_ladder_rates(game, market, calendar_dt, run_dt)), f"{game} {market} {calendar_dt}"
+
+
+def test_dc_heroes_revenue_gets_its_own_rates(spark, load_notebook, database):
+    # the small synthetic scale has no DC Heroes & Villains, so one of its games is renamed
+    fact_promo_table_name = f"{database}.fact_promo_dc"
+    nb = load_notebook(FACT_PROMO_TABLE_NAME=repr(fact_promo_table_name))
+    dc_game = "DC Heroes & Villains"
+    renamed_game = "Jurassic World Alive"
+    spark.table("pr_analytics_agg.fact_promotion_expense_daily").withColumn(
+        "APPLICATION_FAMILY_NAME",
+        F.when(F.col("APPLICATION_FAMILY_NAME") == renamed_game, dc_game).otherwise(F.col("APPLICATION_FAMILY_NAME")),
+    ).write.mode("overwrite").saveAsTable(fact_promo_table_name)
+    run_config = nb["RUN_CONFIG"]._replace(
+        game_list=[dc_game if game == renamed_game else game for game in nb["RUN_CONFIG"].game_list]
+    )
+
+    source_df = spark.table(fact_promo_table_name).where(
+        (F.col("APPLICATION_FAMILY_NAME") == dc_game)
+        & F.col("MARKET_CD").isin(*run_config.market_list)
+        & F.expr(nb["FACT_PROMO_FILTER_COND"])
+        & F.col("CALENDAR_DT").between(run_config.compute_start_dt, run_config.end_dt)
+        & (F.col("MVP_CAMPAIGN_TYPE") == "New Installs")
+    )
+    campaign_df = nb["get_campaign_without_sub_ltv"](run_config).where(F.col("APPLICATION_FAMILY_NAME") == dc_game)
+    for day in ["014", "028"]:
+        for metric, source_col, rate in [
+            (f"IAP_REVS_DAY_{day}_AMT", f"REVS_DAY_{day}_AMT", 0.546),
+            (f"AD_REVS_DAY_{day}_AMT", f"AD_REVS_DAY_{day}_AMT", 0.78),
+        ]:
+            source_sum = source_df.agg(F.sum(source_col)).first()[0]
+            assert source_sum > 0
+            assert campaign_df.agg(F.sum(metric)).first()[0] == pytest.approx(rate * source_sum)
+
+
+def test_go_only_run_keeps_skan_rates(load_notebook):
+    nb = load_notebook()
+    run_config = nb["RUN_CONFIG"]._replace(market_list=("GO",))
+    assert {row[1] for row in nb["get_revenue_share_rates"](run_config)} == {"GO"}
+    # the skan stage joins the IT rates, which a run of GO alone has none of
+    skan_campaign_ltv_df = nb["get_skan_campaign_ltv"](run_config)
+    assert skan_campaign_ltv_df.where(F.col("IAP_LTV").isNull()).count() == 0
+    assert skan_campaign_ltv_df.agg(F.sum("IAP_LTV")).first()[0] > 0
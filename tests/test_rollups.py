@@ -0,0 +1,29 @@
+import pyspark.sql.functions as F
+from Merge_Parity import get_parity_violations
+
+
+def test_rollups_match_plain_group_by_sums(load_notebook, compute_details):
+    nb = load_notebook()
+    campaign_details_df, _ = compute_details(nb)
+    campaign_details_df = campaign_details_df.localCheckpoint()
+    rollups = nb["DAY_ROLLUPS"] + nb["PERIOD_ROLLUPS"]
+    rollup_df = nb["get_rollups"](campaign_details_df, rollups).localCheckpoint()
+    assert {row.ROLLUP for row in rollup_df.select("ROLLUP").distinct().collect()} == {rollup.name for rollup in rollups}
+
+    metric_cols = [col for col in nb["METRIC_COLS"] if col in campaign_details_df.columns]
+    periods = {
+        "CALENDAR_DT": F.col("CALENDAR_DT"),
+        "WEEK_START_DT": F.date_trunc("week", "CALENDAR_DT").cast("date"),
+        "MONTH_START_DT": F.trunc("CALENDAR_DT", "month"),
+    }
+    for rollup in rollups:
+        key_cols = list(rollup.group_cols)
+        expected_df = (
+            campaign_details_df.withColumn("CALENDAR_DT", periods[rollup.period_col])
+            .groupBy(*key_cols)
+            .agg(*[F.sum(col).alias(col) for col in metric_cols])
+        )
+        actual_df = nb["get_rollup_df"](rollup_df, rollup)
+        assert actual_df.count() > 0
+        violation_df = get_parity_violations(expected_df.toPandas(), actual_df.toPandas(), key_cols)
+        assert violation_df.empty, f"{rollup.name} violations:\n{violation_df[[*key_cols, 'VIOLATION']].head(20)}"
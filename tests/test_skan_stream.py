@@ -0,0 +1,53 @@
+from datetime import date, timedelta
+from pathlib import Path
+
+import pyspark.sql.functions as F
+from conftest import SCALE, emulate_delta_merges
+from Merge_Parity import get_parity_violations
+from Synthetic_Source_Tables import get_date_range
+
+
+def test_skan_stream_republishes_daily_content(spark, load_notebook, compute_details, tmp_path, capsys):
+    source_dir = tmp_path / "skan_ltv_drops"
+    nb = load_notebook(
+        SKAN_STREAM_SOURCE_DIR=repr(str(source_dir)),
+        PUBLISH_MODE="PublishMode.PARQUET_AND_TABLE",
+        INSTRUMENT_STAGES="False",
+    )
+    emulate_delta_merges(spark, nb)
+
+    # the daily run publishes the tables that the stream keeps up to date
+    campaign_details_df, channel_details_df = compute_details(nb)
+    campaign_details_df, channel_details_df = (df.localCheckpoint() for df in [campaign_details_df, channel_details_df])
+    nb["save_result"](campaign_details_df, channel_details_df, nb["RUN_CONFIG"])
+
+    # the postbacks land in drops, and the stream was started long before today with the run config of its start day
+    start_date, end_date = get_date_range(SCALE)
+    cut_dt = (end_date - timedelta(days=10)).isoformat()
+    stale_run_config = nb["get_run_config_as_of"](nb["RUN_CONFIG"], date.today() - timedelta(days=20))
+    skan_ltv_df = spark.table(nb["SKAN_LTV_TABLE_NAME"])
+    # the postbacks of installs of the current day are kept in the frame, and only published once the day is over
+    today_df = skan_ltv_df.where(F.col("INSTALL_DT") == end_date).withColumn("INSTALL_DT", F.lit(date.today()))
+    drop_dfs = [skan_ltv_df.where(F.col("INSTALL_DT") <= cut_dt), skan_ltv_df.where(F.col("INSTALL_DT") > cut_dt), today_df]
+    for drop_num, drop_df in enumerate(drop_dfs):
+        drop_df.write.parquet(str(Path(source_dir, f"drop_{drop_num}")))
+        nb["run_skan_stream"](stale_run_config, available_now=True)
+    assert spark.table(nb["SKAN_STREAM_TABLE_NAME"]).where(F.col("CALENDAR_DT") == date.today()).count() > 0
+
+    # postbacks landing again for an install date the watermark has passed are dropped, and reported, instead of counted twice
+    capsys.readouterr()
+    skan_ltv_df.where(F.col("INSTALL_DT") == start_date).write.parquet(str(Path(source_dir, "drop_late")))
+    nb["run_skan_stream"](stale_run_config, available_now=True)
+    dropped_row_nums = [
+        int(line.split(": ")[1].split()[0]) for line in capsys.readouterr().out.splitlines() if " rows dropped, " in line
+    ]
+    assert sum(dropped_row_nums) > 0
+
+    for name, df, table_name, key_cols in [
+        ("campaign", campaign_details_df, nb["CAMPAIGN_TABLE_NAME"], nb["CAMPAIGN_KEY_COLS"]),
+        ("channel", channel_details_df, nb["CHANNEL_TABLE_NAME"], nb["CHANNEL_KEY_COLS"]),
+    ]:
+        violation_df = get_parity_violations(
+            nb["revise_schema"](df).toPandas(), spark.table(table_name).toPandas(), key_cols
+        )
+        assert violation_df.empty, f"{name} stream violations:\n{violation_df[[*key_cols, 'VIOLATION']].head(20)}"
@@ -0,0 +1,23 @@
+from datetime import timedelta
+
+import pyspark.sql.functions as F
+from conftest import SCALE
+from Synthetic_Source_Tables import get_date_range
+
+
+def test_first_base_of_partial_window_keeps_history(load_notebook, compute_details):
+    nb = load_notebook(SNAPSHOT_MODE="SnapshotMode.CHANGES")
+    full_config = nb["RUN_CONFIG"]._replace(compute_start_dt=nb["START_DT"])
+    campaign_details_df = nb["revise_schema"](compute_details(nb, full_config)[0]).localCheckpoint()
+    # previous runs published the whole history, before any snapshot was written
+    campaign_details_df.write.mode("overwrite").saveAsTable(nb["CAMPAIGN_TABLE_NAME"])
+
+    _, end_date = get_date_range(SCALE)
+    window_config = full_config._replace(compute_start_dt=(end_date - timedelta(days=10)).isoformat())
+    window_df = campaign_details_df.where(F.col("CALENDAR_DT") >= window_config.compute_start_dt)
+    nb["write_snapshot_changes"](window_df, "campaign", nb["CAMPAIGN_KEY_COLS"], window_config)
+
+    snapshot_df = nb["get_changes_snapshot_df"]("campaign", window_config.run_dt, nb["CAMPAIGN_KEY_COLS"])
+    snapshot_df = snapshot_df.select(*campaign_details_df.columns)
+    assert snapshot_df.count() == campaign_details_df.count()
+    assert snapshot_df.exceptAll(campaign_details_df).count() == 0
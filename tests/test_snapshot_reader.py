@@ -0,0 +1,98 @@
+from datetime import date
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from Snapshot_Reader import SnapshotReader
+
+# SNAPSHOT_DT, game, channel, SPEND, CHANGE_TYPE
+BASE_ROWS = [
+    ("2024-01-01", "HP", "X", 1.0, "base"),
+    ("2024-01-01", "HP", "Y", 2.0, "base"),
+    ("2024-01-01", "HP", "Z", 3.0, "base"),
+    ("2024-01-01", "JWA", "X", 10.0, "base"),
+    # a later base replaces the base and changes before it
+    ("2024-01-03", "JWA", "X", 20.0, "base"),
+]
+CHANGE_ROWS = [
+    ("2024-01-02", "HP", "X", 5.0, "upsert"),
+    ("2024-01-02", "HP", "Y", 2.0, "delete"),
+    ("2024-01-02", "HP", "W", 7.0, "upsert"),
+    ("2024-01-03", "HP", "X", 6.0, "upsert"),
+    ("2024-01-02", "JWA", "X", 15.0, "upsert"),
+]
+
+
+def write_store(save_dir: Path, store: str, rows: list) -> None:
+    snapshot_dts, games, channels, spends, change_types = zip(*rows)
+    table = pa.table(
+        {
+            "SNAPSHOT_DT": list(snapshot_dts),
+            "APPLICATION_FAMILY_NAME": list(games),
+            "MARKET_CD": ["IT"] * len(rows),
+            "SOURCE": ["Non-SKAN"] * len(rows),
+            "USER_SOURCE_TYPE_CD": ["MK"] * len(rows),
+            "CHANNEL_NAME": list(channels),
+            "CALENDAR_DT": [date(2023, 12, 31)] * len(rows),
+            "SPEND": list(spends),
+            "CHANGE_TYPE": list(change_types),
+        }
+    )
+    pq.write_to_dataset(
+        table, str(save_dir / "snapshots" / f"channel_{store}.parquet"), partition_cols=["SNAPSHOT_DT", "APPLICATION_FAMILY_NAME"]
+    )
+
+
+def get_spends(table: pa.Table) -> dict:
+    return dict(zip(table["CHANNEL_NAME"].to_pylist(), table["SPEND"].to_pylist()))
+
+
+def test_reconstruct_applies_changes_over_the_latest_base(tmp_path):
+    write_store(tmp_path, "base", BASE_ROWS)
+    write_store(tmp_path, "changes", CHANGE_ROWS)
+    reader = SnapshotReader(str(tmp_path))
+
+    assert get_spends(reader.read("channel", games=["HP"], snapshot_dt="2024-01-01")) == {"X": 1.0, "Y": 2.0, "Z": 3.0}
+    assert get_spends(reader.read("channel", games=["HP"], snapshot_dt="2024-01-02")) == {"X": 5.0, "Z": 3.0, "W": 7.0}
+    assert get_spends(reader.read("channel", games=["HP"], snapshot_dt="2024-01-03")) == {"X": 6.0, "Z": 3.0, "W": 7.0}
+    assert get_spends(reader.read("channel", games=["JWA"], snapshot_dt="2024-01-02")) == {"X": 15.0}
+    assert get_spends(reader.read("channel", games=["JWA"], snapshot_dt="2024-01-03")) == {"X": 20.0}
+
+    scans = reader.get_store_scans("channel", date(2024, 1, 2), None, None)
+    table = SnapshotReader.reconstruct("channel", scans)
+    assert sorted(zip(table["APPLICATION_FAMILY_NAME"].to_pylist(), table["CHANNEL_NAME"].to_pylist())) == [
+        ("HP", "W"),
+        ("HP", "X"),
+        ("HP", "Z"),
+        ("JWA", "X"),
+    ]
+    assert set(table["CHANGE_TYPE"].to_pylist()) <= {"base", "upsert"}
+
+
+def test_cache_evicts_least_recently_read_slice(tmp_path):
+    write_store(tmp_path, "base", BASE_ROWS)
+    write_store(tmp_path, "changes", CHANGE_ROWS)
+    snapshot_dts = ["2024-01-01", "2024-01-02", "2024-01-03"]
+
+    def read(reader: SnapshotReader, snapshot_dt: str) -> pa.Table:
+        return reader.read("channel", games=["HP"], columns=["CHANNEL_NAME", "SPEND"], snapshot_dt=snapshot_dt)
+
+    sizes = [read(SnapshotReader(str(tmp_path)), snapshot_dt).nbytes for snapshot_dt in snapshot_dts]
+    # room for any two consecutive slices of the three, but not for all of them
+    reader = SnapshotReader(str(tmp_path), cache_bytes=max(sizes[0] + sizes[1], sizes[1] + sizes[2]))
+    for snapshot_dt in snapshot_dts:
+        read(reader, snapshot_dt)
+    assert reader.cache_info()["misses"] == 3
+    assert reader.cache_info()["slices"] == 2
+
+    # the second slice is read again, so the third one is now the least recently read
+    read(reader, snapshot_dts[1])
+    assert reader.cache_info()["hits"] == 1
+    # the first slice was evicted, and reading it again evicts the third one
+    read(reader, snapshot_dts[0])
+    assert reader.cache_info()["misses"] == 4
+    read(reader, snapshot_dts[1])
+    assert reader.cache_info()["hits"] == 2
+    read(reader, snapshot_dts[2])
+    assert reader.cache_info()["misses"] == 5
+    assert reader.cache_info()["bytes"] <= reader.cache_info()["max_bytes"]
@@ -0,0 +1,30 @@
+from datetime import date, timedelta
+
+import pytest
+
+
+def test_snapshot_of_today_and_later_days(spark, load_notebook, database):
+    pytest.importorskip("delta")
+    nb = load_notebook(PUBLISH_MODE="PublishMode.VERSIONED_TABLE")
+    table_name = f"{database}.versioned_snapshot"
+
+    def write_version(run_dt: str, user_metadata: str) -> None:
+        with nb["commit_user_metadata"](user_metadata):
+            df = spark.createDataFrame([(run_dt,)], "RUN_DT string")
+            df.write.format("delta").mode("overwrite").saveAsTable(table_name)
+
+    today = date.today()
+    two_days_ago = (today - timedelta(days=2)).isoformat()
+    write_version(two_days_ago, f"{nb['RUN_DT_METADATA_PREFIX']}{two_days_ago}")
+    write_version(today.isoformat(), f"{nb['RUN_DT_METADATA_PREFIX']}{today.isoformat()}")
+    # a commit that is not tagged by a run is never a snapshot
+    write_version("untagged", "manual fix")
+
+    def read_run_dt(snapshot_dt: date) -> str:
+        return nb["get_snapshot_df"](table_name, snapshot_dt.isoformat()).first().RUN_DT
+
+    assert read_run_dt(today) == today.isoformat()
+    assert read_run_dt(today + timedelta(days=1)) == today.isoformat()
+    assert read_run_dt(today - timedelta(days=1)) == two_days_ago
+    with pytest.raises(ValueError):
+        read_run_dt(today - timedelta(days=3))
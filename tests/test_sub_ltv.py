@@ -0,0 +1,87 @@
+import pyspark.sql.functions as F
+from Merge_Parity import get_parity_violations
+from pyspark.sql import Window
+
+SUB_LTV_KEY_COLS = ["APPLICATION_FAMILY_NAME", "MARKET_CD", "USER_SOURCE_TYPE_CD", "CHANNEL_NAME", "PROMOTION_NAME", "CALENDAR_DT"]
+USER_KEY_COLS = ["ACCOUNT_ID", "USER_ID", "APPLICATION_CD"]
+
+
+def get_sub_ltv_by_self_join_sql(nb: dict, run_config: tuple) -> str:
+    """
+    The sub ltv query as it was before the cohort pruning: the latest projection date of every user, joined back to the individual ltv,
+    and the revenue share applied by its CASE ladder
+    """
+    return f"""
+with indi_max_project_dt as (
+  select ACCOUNT_ID, USER_ID, APPLICATION_CD, max(PROJECTION_DT) as MAX_PROJECTION_DT
+  from {nb["INDIVIDUAL_LTV_TABLE_NAME"]}
+  group by 1, 2, 3
+),
+latest_sub_ltv as (
+  select a.ACCOUNT_ID, a.USER_ID, a.APPLICATION_CD, SUB_PROJECTEDREVENUE_365 as SUB_LTV
+  from {nb["INDIVIDUAL_LTV_TABLE_NAME"]} a inner join indi_max_project_dt b
+  on a.ACCOUNT_ID = b.ACCOUNT_ID and a.USER_ID = b.USER_ID and a.APPLICATION_CD = b.APPLICATION_CD and a.PROJECTION_DT = b.MAX_PROJECTION_DT
+),
+indi_sub_ltv as (
+  select a.APPLICATION_FAMILY_NAME, a.MARKET_CD, a.USER_SOURCE_TYPE_CD, a.CHANNEL_NAME, a.PROMOTION_NAME, a.INSTALL_DT as CALENDAR_DT, b.SUB_LTV
+  from {nb["INSTALL_TABLE_NAME"]} a inner join latest_sub_ltv b
+  on a.APPLICATION_CD = b.APPLICATION_CD and a.ACCOUNT_ID = b.ACCOUNT_ID and a.USER_ID = b.USER_ID
+)
+select
+  APPLICATION_FAMILY_NAME,
+  MARKET_CD,
+  USER_SOURCE_TYPE_CD,
+  case when USER_SOURCE_TYPE_CD in ('MM', 'MK', 'MC') then CHANNEL_NAME else 'ORGANIC' end as CHANNEL_NAME,
+  case when USER_SOURCE_TYPE_CD in ('MM', 'MK', 'MC') then PROMOTION_NAME else 'ORGANIC' end as PROMOTION_NAME,
+  CALENDAR_DT,
+  count(1) as INDIVIDUAL_INSTALLS,
+  sum(
+       ifnull(case when MARKET_CD = 'GO' and CALENDAR_DT < '2022-01-01' and APPLICATION_FAMILY_NAME = 'Harry Potter' then SUB_LTV*0.616
+             when MARKET_CD = 'GO' and CALENDAR_DT < '2022-01-01' and APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then SUB_LTV*0.525
+             when MARKET_CD = 'GO' and CALENDAR_DT < '2022-01-01' then SUB_LTV *0.7
+             when MARKET_CD = 'GO' and CALENDAR_DT >= '2022-01-01' and APPLICATION_FAMILY_NAME = 'Harry Potter' then SUB_LTV*0.748
+             when MARKET_CD = 'GO' and CALENDAR_DT >= '2022-01-01' and APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then SUB_LTV*0.638
+             when MARKET_CD = 'GO' and CALENDAR_DT >= '2022-01-01' then SUB_LTV *0.85
+             when MARKET_CD = 'IT' and APPLICATION_FAMILY_NAME = 'Harry Potter' then SUB_LTV*0.616
+             when MARKET_CD = 'IT' and APPLICATION_FAMILY_NAME = 'Jurassic World the Game' then SUB_LTV*0.525
+             when MARKET_CD = 'IT' then SUB_LTV*0.7
+             else 0 end, 0)
+  ) as SUB_LTV
+from indi_sub_ltv
+where APPLICATION_FAMILY_NAME in {nb["to_sql_list"](run_config.game_list)} and MARKET_CD in {nb["to_sql_list"](run_config.market_list)}
+  and CALENDAR_DT between '{run_config.compute_start_dt}' and '{run_config.end_dt}'
+group by 1, 2, 3, 4, 5, 6
+"""
+
+
+def test_sub_ltv_matches_self_join(spark, load_notebook, database):
+    individual_ltv_table_name = f"{database}.tied_individual_ltv"
+    nb = load_notebook(INDIVIDUAL_LTV_TABLE_NAME=repr(individual_ltv_table_name))
+    run_config = nb["RUN_CONFIG"]
+    ltv_df = spark.table("ua.internal_individual_ltv")
+
+    # a user with a subscription whose latest projection date has a second projection, and a projection without a date
+    cohort_df = spark.table(nb["INSTALL_TABLE_NAME"]).where(
+        F.col("APPLICATION_FAMILY_NAME").isin(run_config.game_list)
+        & F.col("INSTALL_DT").between(run_config.compute_start_dt, run_config.end_dt)
+    )
+    latest_window = Window.partitionBy(*USER_KEY_COLS).orderBy(F.desc("PROJECTION_DT"))
+    latest_row = (
+        ltv_df.join(cohort_df.select(*USER_KEY_COLS), on=USER_KEY_COLS, how="leftsemi")
+        .withColumn("PROJECTION_NUM", F.row_number().over(latest_window))
+        .where((F.col("PROJECTION_NUM") == 1) & (F.col("SUB_PROJECTEDREVENUE_365") > 0))
+        .drop("PROJECTION_NUM")
+        .orderBy(*USER_KEY_COLS)
+        .first()
+    )
+    tied_row = latest_row.asDict()
+    tied_row["SUB_PROJECTEDREVENUE_365"] += 7.0
+    undated_row = {**latest_row.asDict(), "PROJECTION_DT": None, "SUB_PROJECTEDREVENUE_365": 100.0}
+    extra_df = spark.createDataFrame([tied_row, undated_row], ltv_df.schema)
+    ltv_df.unionByName(extra_df).write.mode("overwrite").saveAsTable(individual_ltv_table_name)
+
+    expected_df = spark.sql(get_sub_ltv_by_self_join_sql(nb, run_config))
+    actual_df = nb["get_campaign_sub_ltv"](run_config)
+    violation_df = get_parity_violations(expected_df.toPandas(), actual_df.toPandas(), SUB_LTV_KEY_COLS)
+    assert violation_df.empty, f"sub ltv violations:\n{violation_df[[*SUB_LTV_KEY_COLS, 'VIOLATION']].head(20)}"
+